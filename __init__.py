@@ -1,3 +1,7 @@
+import time
+
+startup_start_time = time.perf_counter()
+
 from typing import Callable
 
 from aqt import mw
@@ -9,18 +13,26 @@ from aqt.gui_hooks import (
 )
 from aqt.qt import QAction, qconnect, QMenu
 
-from .configuration import Config, run_on_configuration_change
+from .card_history import init_card_history_cache_hook
+from .configuration import config, init_config_hook, run_on_configuration_change
+from .custom_data_index import init_marker_index_hook, rebuild_marker_index_command
 from .ease import init_ease_adjust_review_hook
-from .ease.auto_ease_factor import adjust_ease
-from .ease.export import export_ease_factors, import_ease_factors
+from .lazy import lazy
 from .schedule import init_schedule_review_hook
-from .schedule.advance import advance
-from .schedule.disperse_siblings import disperse_siblings
-from .schedule.free_days import free_days
-from .schedule.postpone import postpone
-from .schedule.reschedule import reschedule
 from .sync_hook import init_sync_hook
 
+# The modules of the commands are imported when a command is first used
+adjust_ease = lazy(".ease.auto_ease_factor", "adjust_ease", __name__)
+export_ease_factors = lazy(".ease.export", "export_ease_factors", __name__)
+import_ease_factors = lazy(".ease.export", "import_ease_factors", __name__)
+optimize_ease = lazy(".ease.optimizer", "optimize_ease", __name__)
+restore_journal_command = lazy(".journal", "restore_journal_command", __name__)
+advance = lazy(".schedule.advance", "advance", __name__)
+disperse_siblings = lazy(".schedule.disperse_siblings", "disperse_siblings", __name__)
+free_days = lazy(".schedule.free_days", "free_days", __name__)
+postpone = lazy(".schedule.postpone", "postpone", __name__)
+reschedule = lazy(".schedule.reschedule", "reschedule", __name__)
+
 """
 Acknowledgement to Arthur Milchior, Carlos Duarte and oakkitten.
 I learnt a lot from their add-ons.
@@ -30,9 +42,6 @@ https://github.com/oakkitten/anki-delay-siblings
 https://github.com/hgiesel/anki_straight_reward
 """
 
-config = Config()
-config.load()
-
 
 # A tiny helper for menu items, since type checking is broken there
 def checkable(title: str, on_click: Callable[[bool], None]) -> QAction:
@@ -57,10 +66,8 @@ def add_action_to_gear(fun, get_text):
     text -- what's written in the gear."""
 
     def aux(m, did):
-        config.load()
-        # Use function to get so that it occurs after config is loaded
-        # in case the text uses a config value
-        # This the text gets updated when the config changes
+        # Use function to get the text when the menu is shown, in case it uses a config value,
+        # so it's up to date with the config, which is reloaded when it changes
         a = m.addAction(get_text())
         a.triggered.connect(lambda b, did=did: fun(did))
 
@@ -97,6 +104,16 @@ menu_auto_disperse_after_sync = checkable(
 )
 
 
+def set_auto_adjust_ease_after_sync(checked):
+    config.auto_adjust_ease_after_sync = checked
+
+
+menu_auto_adjust_ease_after_sync = checkable(
+    title="Auto adjust ease of cards reviewed on other devices after sync",
+    on_click=set_auto_adjust_ease_after_sync,
+)
+
+
 def set_auto_disperse_when_review(checked):
     config.auto_disperse = checked
 
@@ -154,12 +171,19 @@ add_action_to_gear(
     adjust_ease_recent,
     lambda: f"Adjust ease factors for cards reviewed in the last {config.days_to_reschedule} days",
 )
+menu_optimize_ease = build_action(optimize_ease, "Recommend ease params from review history")
+add_action_to_gear(optimize_ease, lambda: "Recommend ease params from review history")
 
 menu_disperse_siblings = build_action(disperse_siblings, "Disperse all siblings")
 
+menu_rebuild_marker_index = build_action(rebuild_marker_index_command, "Rebuild custom data index")
+
+menu_restore_journal = build_action(restore_journal_command, "Restore schedule from journal")
+
 menu_for_helper = mw.form.menuTools.addMenu("Custom Schedule Helper")
 menu_for_helper.addAction(menu_auto_reschedule_after_sync)
 menu_for_helper.addAction(menu_auto_disperse_after_sync)
+menu_for_helper.addAction(menu_auto_adjust_ease_after_sync)
 menu_for_helper.addAction(menu_auto_disperse)
 menu_for_helper.addAction(menu_load_balance)
 menu_for_free_days = menu_for_helper.addMenu("No Anki on Free Days (requires Load Balancing)")
@@ -172,6 +196,10 @@ menu_for_helper.addAction(menu_disperse_siblings)
 menu_for_helper.addSeparator()
 menu_for_helper.addAction(menu_adjust_ease)
 menu_for_helper.addAction(menu_adjust_ease_recent)
+menu_for_helper.addAction(menu_optimize_ease)
+menu_for_helper.addSeparator()
+menu_for_helper.addAction(menu_rebuild_marker_index)
+menu_for_helper.addAction(menu_restore_journal)
 
 menu_apply_free_days = build_action(free_days, "Apply free days now")
 
@@ -205,15 +233,16 @@ def adjust_menu():
         )
         menu_auto_reschedule_after_sync.setChecked(config.auto_reschedule_after_sync)
         menu_auto_disperse_after_sync.setChecked(config.auto_disperse_after_sync)
+        menu_auto_adjust_ease_after_sync.setChecked(config.auto_adjust_ease_after_sync)
         menu_auto_disperse.setChecked(config.auto_disperse)
         menu_load_balance.setChecked(config.load_balance)
-        menu_for_free_0.setChecked(0 in config.free_days)
-        menu_for_free_1.setChecked(1 in config.free_days)
-        menu_for_free_2.setChecked(2 in config.free_days)
-        menu_for_free_3.setChecked(3 in config.free_days)
-        menu_for_free_4.setChecked(4 in config.free_days)
-        menu_for_free_5.setChecked(5 in config.free_days)
-        menu_for_free_6.setChecked(6 in config.free_days)
+        menu_for_free_0.setChecked(0 in config.free_weekdays)
+        menu_for_free_1.setChecked(1 in config.free_weekdays)
+        menu_for_free_2.setChecked(2 in config.free_weekdays)
+        menu_for_free_3.setChecked(3 in config.free_weekdays)
+        menu_for_free_4.setChecked(4 in config.free_weekdays)
+        menu_for_free_5.setChecked(5 in config.free_weekdays)
+        menu_for_free_6.setChecked(6 in config.free_weekdays)
 
 
 def on_browser_will_show_context_menu(browser: Browser, menu: QMenu):
@@ -242,10 +271,18 @@ def state_did_change(_next_state, _previous_state):
 
 @run_on_configuration_change
 def configuration_changed():
-    config.load()
     adjust_menu()
 
 
+init_config_hook()
 init_sync_hook()
+init_card_history_cache_hook()
+init_marker_index_hook()
 init_schedule_review_hook()
-# init_ease_adjust_review_hook()
+init_ease_adjust_review_hook()
+
+if config.debug_notify:
+    print(
+        "Custom Schedule Helper: started in"
+        f" {(time.perf_counter() - startup_start_time) * 1000:.1f} ms"
+    )
@@ -0,0 +1,265 @@
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from anki.consts import REVLOG_LRN, REVLOG_REV, REVLOG_RELRN, REVLOG_CRAM
+from aqt import mw
+from aqt.gui_hooks import profile_will_close
+
+from .id_sets import id_set
+
+# Revlog types of answers, the other types are manual changes to the card
+ANSWER_TYPES = (REVLOG_LRN, REVLOG_REV, REVLOG_RELRN, REVLOG_CRAM)
+
+# Number of card histories the review hooks keep cached
+CARD_HISTORY_CACHE_SIZE = 256
+
+
+def get_deck_starting_ease(deck_id: int) -> int:
+    try:
+        return mw.col.decks.config_dict_for_deck_id(deck_id)["new"]["initialFactor"]
+    except KeyError:
+        return 2500
+
+
+class CardHistory(NamedTuple):
+    """
+    A card's revlog and the starting ease of its deck, loaded with a single revlog query.
+    As it doesn't change after loading, it can be cached and used off the main thread while the
+    card itself gets answered.
+    """
+
+    card_id: int
+    deck_id: int
+    deck_starting_ease: int
+    # The id, ease, factor, type and interval of every revlog entry of the card, oldest first
+    rep_ids: tuple[int, ...]
+    eases: tuple[int, ...]
+    factors: tuple[int, ...]
+    types: tuple[int, ...]
+    ivls: tuple[int, ...]
+
+    @classmethod
+    def load(cls, card_id: int, deck_id: int) -> "CardHistory":
+        """
+        :param deck_id: The deck of the card, or its original deck if it's in a filtered deck.
+        """
+        reps = mw.col.db.all(f"""
+            select id, ease, factor, type, ivl
+            from revlog
+            where cid = {card_id}
+            order by id
+            """)
+        rep_ids, eases, factors, types, ivls = (
+            zip(*reps) if len(reps) > 0 else ((), (), (), (), ())
+        )
+        return cls(
+            card_id,
+            deck_id,
+            get_deck_starting_ease(deck_id),
+            rep_ids,
+            eases,
+            factors,
+            types,
+            ivls,
+        )
+
+    @classmethod
+    def load_many(cls, deck_ids: dict[int, int]) -> dict[int, "CardHistory"]:
+        """
+        The histories of many cards, loaded with a single revlog query.
+        :param deck_ids: The deck of each card id, as for load.
+        """
+        reps = {card_id: [] for card_id in deck_ids}
+        with id_set(deck_ids.keys()) as card_id_list:
+            for card_id, *rep in mw.col.db.execute(f"""
+                select cid, id, ease, factor, type, ivl
+                from revlog
+                where cid in {card_id_list}
+                order by cid, id
+                """):
+                reps[card_id].append(rep)
+        starting_eases = {}
+        histories = {}
+        for card_id, deck_id in deck_ids.items():
+            if deck_id not in starting_eases:
+                starting_eases[deck_id] = get_deck_starting_ease(deck_id)
+            card_reps = reps[card_id]
+            rep_ids, eases, factors, types, ivls = (
+                zip(*card_reps) if len(card_reps) > 0 else ((), (), (), (), ())
+            )
+            histories[card_id] = cls(
+                card_id,
+                deck_id,
+                starting_eases[deck_id],
+                rep_ids,
+                eases,
+                factors,
+                types,
+                ivls,
+            )
+        return histories
+
+    @property
+    def last_id(self) -> Optional[int]:
+        return self.rep_ids[-1] if len(self.rep_ids) > 0 else None
+
+    def reps(self) -> list[tuple[int, int, int]]:
+        """The ease, factor and type of the answers, same as get_reps_with_factors."""
+        return [
+            (ease, factor, rep_type)
+            for ease, factor, rep_type in zip(self.eases, self.factors, self.types)
+            if rep_type in ANSWER_TYPES
+        ]
+
+    def rep_list(self, new_answer: Optional[int] = None) -> list[int]:
+        """Same as get_all_reps, with the new answer appended."""
+        rep_list = [
+            ease for ease, rep_type in zip(self.eases, self.types) if rep_type in ANSWER_TYPES
+        ]
+        if new_answer:
+            rep_list.append(new_answer)
+        return rep_list
+
+    def review_list(self, reviews_only: bool, new_answer: Optional[int] = None) -> list[int]:
+        """The reps suggested_factor uses, get_reviews_only if reviews_only else get_all_reps."""
+        if not reviews_only:
+            return self.rep_list(new_answer)
+        review_list = [
+            ease for ease, rep_type in zip(self.eases, self.types) if rep_type == REVLOG_REV
+        ]
+        if new_answer is not None:
+            review_list.append(new_answer)
+        return review_list
+
+    def ease_factors(self) -> list[int]:
+        """Same as get_ease_factors."""
+        return [
+            factor
+            for factor, rep_type in zip(self.factors, self.types)
+            if factor > 0 and rep_type in ANSWER_TYPES
+        ]
+
+    def factor_list(
+        self, new_answer: Optional[int] = None, prev_card_factor: Optional[int] = None
+    ) -> list[int]:
+        """The factors suggested_factor uses."""
+        factor_list = self.ease_factors()
+        if len(factor_list) > 0 and prev_card_factor is not None:
+            factor_list[-1] = prev_card_factor
+        # Ignore latest ease if you are applying algorithm from deck settings
+        if new_answer is None and len(factor_list) > 1:
+            factor_list = factor_list[:-1]
+        return factor_list
+
+    def last_rated_id(self) -> Optional[int]:
+        """Id of the latest rated review, the one LAST_REVIEW_ID_SQL selects."""
+        for rep_id, ease in zip(reversed(self.rep_ids), reversed(self.eases)):
+            if ease >= 1:
+                return rep_id
+        return None
+
+    def last_elapsed_days(self) -> int:
+        """
+        Days between the latest two revlog entries, leaving out filtered deck reschedules,
+        same as from filter_revlogs of card_stats_data. 0 if there aren't two entries.
+        """
+        times = [
+            rep_id // 1000
+            for rep_id, ease, rep_type in zip(self.rep_ids, self.eases, self.types)
+            if rep_type != REVLOG_CRAM or ease != 0
+        ]
+        if len(times) < 2:
+            return 0
+        return int((times[-1] - times[-2]) / 86400)
+
+
+class CardHistoryCache:
+    """
+    LRU cache of card histories for the review hooks, as the same cards and their siblings are
+    often seen several times in a session. A cached history is only used while the card's
+    latest revlog id and deck are still the ones it was loaded with, which costs one indexed
+    lookup instead of reading the card's revlog. Anything rewriting revlog entries in place
+    must clear the cache.
+    """
+
+    def __init__(self, size: int = CARD_HISTORY_CACHE_SIZE) -> None:
+        self.size = size
+        self.histories: OrderedDict[int, CardHistory] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # The hooks run on the main thread, but jobs in the background can use it too
+        self.lock = threading.Lock()
+
+    def get(self, card_id: int, deck_id: int) -> CardHistory:
+        last_id = mw.col.db.scalar(f"select max(id) from revlog where cid = {card_id}")
+        with self.lock:
+            history = self.histories.get(card_id)
+            if history is not None and history.last_id == last_id and history.deck_id == deck_id:
+                self.histories.move_to_end(card_id)
+                self.hits += 1
+                return history
+            self.misses += 1
+        history = CardHistory.load(card_id, deck_id)
+        with self.lock:
+            self.histories[card_id] = history
+            self.histories.move_to_end(card_id)
+            while len(self.histories) > self.size:
+                self.histories.popitem(last=False)
+        return history
+
+    def preload(self, deck_ids: dict[int, int]):
+        """
+        Load the histories of the cards that aren't cached with one revlog query, for jobs
+        that go through many cards. The cache should be big enough to hold them all.
+        :param deck_ids: The deck of each card id, as for get.
+        """
+        with self.lock:
+            missing = {
+                card_id: deck_id
+                for card_id, deck_id in deck_ids.items()
+                if card_id not in self.histories or self.histories[card_id].deck_id != deck_id
+            }
+        if len(missing) == 0:
+            return
+        histories = CardHistory.load_many(missing)
+        with self.lock:
+            self.histories.update(histories)
+            while len(self.histories) > self.size:
+                self.histories.popitem(last=False)
+
+    def put(self, history: CardHistory):
+        """Cache a history that was changed along with the revlog, like rewritten factors."""
+        with self.lock:
+            self.histories[history.card_id] = history
+            self.histories.move_to_end(history.card_id)
+            while len(self.histories) > self.size:
+                self.histories.popitem(last=False)
+
+    def get_for_card(self, card) -> CardHistory:
+        return self.get(card.id, card.odid if card.odid else card.did)
+
+    def clear(self):
+        with self.lock:
+            self.histories.clear()
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0
+        return (
+            f"{self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate),"
+            f" {len(self.histories)}/{self.size} histories cached"
+        )
+
+
+card_histories = CardHistoryCache()
+
+
+def report_card_history_cache():
+    # Printed to the debug console, to see how well the cache size fits a session
+    print(f"Custom Schedule Helper card history cache: {card_histories.stats()}")
+    card_histories.clear()
+
+
+def init_card_history_cache_hook():
+    profile_will_close.append(report_card_history_cache)
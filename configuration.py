@@ -1,12 +1,23 @@
+import copy
+from datetime import date
+from typing import Callable, List, Tuple
+
 from aqt import mw
+from aqt.gui_hooks import profile_will_close
+from aqt.qt import QTimer
+from aqt.utils import showWarning
+
+from .day_calendar import parse_free_dates
 
 tag = mw.addonManager.addonFromModule(__name__)
 
 LOAD_BALANCE = "load_balance"
 FREE_DAYS = "free_days"
+FREE_DATES = "free_dates"
 DAYS_TO_RESCHEDULE = "days_to_reschedule"
 AUTO_RESCHEDULE_AFTER_SYNC = "auto_reschedule_after_sync"
 AUTO_DISPERSE_AFTER_SYNC = "auto_disperse_after_sync"
+AUTO_ADJUST_EASE_AFTER_SYNC = "auto_adjust_ease_after_sync"
 AUTO_DISPERSE = "auto_disperse"
 MATURE_IVL = "mature_ivl"
 DEBUG_NOTIFY = "debug_notify"
@@ -21,7 +32,11 @@ TARGET_RATIO = "target_ratio"
 REVIEWS_ONLY = "reviews_only"
 AUTO_ADJUST_EASE_ON_REVIEW = "auto_adjust_ease_on_review"
 AUTO_ADJUST_EASE_AFTER_REVIEW = "auto_adjust_ease_after_review"
+EASE_OPTIMIZER_WORKERS = "ease_optimizer_workers"
 
+# Changes made through the setters are written this long after the last one, so that toggling
+# several menu items in a row writes the config file once
+SAVE_DELAY_MS = 1000
 
 def load_config():
     return mw.addonManager.getConfig(tag)
@@ -31,19 +46,74 @@ def save_config(data):
     mw.addonManager.writeConfig(tag, data)
 
 
-def run_on_configuration_change(function):
-    mw.addonManager.setConfigUpdatedAction(__name__, lambda *_: function())
-
-
 class Config:
+    """
+    The add-on's config, read once into memory. The add-on uses the single instance config,
+    which is reloaded when the config is changed in the config editor, instead of reading the
+    config for every hook and job.
+    """
+
+    def __init__(self) -> None:
+        self.data = {}
+        # The config as it was last read or written, to tell the changes of the setters apart
+        self.saved_data = {}
+        self.free_weekdays: frozenset[int] = frozenset()
+        # free_dates parsed into inclusive date ranges, the last valid ones if it's malformed
+        self.free_date_ranges: List[Tuple[date, date]] = []
+        self.free_dates_error = None
+        self.save_pending = False
+        self.save_timer = None
+
     def load(self):
-        self.data = load_config()
+        """
+        Read the config. Changes of the setters that weren't written yet are kept and still
+        written after the save delay, unless the key was changed in the read config too, like
+        in the config editor, which then takes its value.
+        """
+        data = load_config()
+        saved_data = copy.deepcopy(data)
+        merged = False
+        if self.save_pending:
+            for key, value in self.data.items():
+                if value != self.saved_data.get(key) and data.get(key) == self.saved_data.get(key):
+                    data[key] = value
+                    merged = True
+        self.data = data
+        self.saved_data = saved_data
+        self.save_pending = merged
+        self.precompute()
+
+    def precompute(self):
+        self.free_weekdays = frozenset(self.data[FREE_DAYS])
+        try:
+            self.free_date_ranges = parse_free_dates(self.data[FREE_DATES])
+            self.free_dates_error = None
+        except ValueError as err:
+            # Reported once here, the jobs and hooks keep using the last valid free dates
+            self.free_dates_error = str(err)
+            message = f"Custom Schedule Helper: {err}"
+            mw.taskman.run_on_main(lambda: showWarning(message))
 
     def save(self):
-        save_config(self.data)
+        """Write the config after SAVE_DELAY_MS, along with the changes made until then."""
+        if self.save_timer is None:
+            self.save_timer = QTimer(mw)
+            self.save_timer.setSingleShot(True)
+            self.save_timer.timeout.connect(self.flush)
+        self.save_pending = True
+        self.save_timer.start(SAVE_DELAY_MS)
+
+    def flush(self):
+        """Write the changes waiting for the save delay now."""
+        if self.save_timer is not None:
+            self.save_timer.stop()
+        if self.save_pending:
+            self.save_pending = False
+            save_config(self.data)
+            self.saved_data = copy.deepcopy(self.data)
 
     @property
-    def load_balance(self):
+    def load_balance(self) -> bool:
         return self.data[LOAD_BALANCE]
 
     @load_balance.setter
@@ -52,7 +122,7 @@ class Config:
         self.save()
 
     @property
-    def free_days(self):
+    def free_days(self) -> List[int]:
         return self.data[FREE_DAYS]
 
     @free_days.setter
@@ -61,12 +131,24 @@ class Config:
         if enable:
             self.data[FREE_DAYS] = sorted(set(self.data[FREE_DAYS] + [day]))
         else:
-            if day in self.data[FREE_DAYS]:
-                self.data[FREE_DAYS].remove(day)
+            self.data[FREE_DAYS] = [
+                free_day for free_day in self.data[FREE_DAYS] if free_day != day
+            ]
+        self.precompute()
+        self.save()
+
+    @property
+    def free_dates(self) -> list:
+        return self.data[FREE_DATES]
+
+    @free_dates.setter
+    def free_dates(self, value):
+        self.data[FREE_DATES] = value
+        self.precompute()
         self.save()
 
     @property
-    def days_to_reschedule(self):
+    def days_to_reschedule(self) -> int:
         return self.data[DAYS_TO_RESCHEDULE]
 
     @days_to_reschedule.setter
@@ -75,7 +157,7 @@ class Config:
         self.save()
 
     @property
-    def auto_reschedule_after_sync(self):
+    def auto_reschedule_after_sync(self) -> bool:
         return self.data[AUTO_RESCHEDULE_AFTER_SYNC]
 
     @auto_reschedule_after_sync.setter
@@ -84,7 +166,7 @@ class Config:
         self.save()
 
     @property
-    def auto_disperse_after_sync(self):
+    def auto_disperse_after_sync(self) -> bool:
         return self.data[AUTO_DISPERSE_AFTER_SYNC]
 
     @auto_disperse_after_sync.setter
@@ -93,7 +175,16 @@ class Config:
         self.save()
 
     @property
-    def auto_disperse(self):
+    def auto_adjust_ease_after_sync(self) -> bool:
+        return self.data[AUTO_ADJUST_EASE_AFTER_SYNC]
+
+    @auto_adjust_ease_after_sync.setter
+    def auto_adjust_ease_after_sync(self, value):
+        self.data[AUTO_ADJUST_EASE_AFTER_SYNC] = value
+        self.save()
+
+    @property
+    def auto_disperse(self) -> bool:
         return self.data[AUTO_DISPERSE]
 
     @auto_disperse.setter
@@ -102,7 +193,7 @@ class Config:
         self.save()
 
     @property
-    def mature_ivl(self):
+    def mature_ivl(self) -> int:
         return self.data[MATURE_IVL]
 
     @mature_ivl.setter
@@ -111,7 +202,7 @@ class Config:
         self.save()
 
     @property
-    def debug_notify(self):
+    def debug_notify(self) -> bool:
         return self.data[DEBUG_NOTIFY]
 
     @debug_notify.setter
@@ -120,7 +211,7 @@ class Config:
         self.save()
 
     @property
-    def scheduler_stats(self):
+    def scheduler_stats(self) -> bool:
         return self.data[SCHEDULER_STATS]
 
     @scheduler_stats.setter
@@ -129,7 +220,7 @@ class Config:
         self.save()
 
     @property
-    def leash(self):
+    def leash(self) -> int:
         return self.data[LEASH]
 
     @leash.setter
@@ -138,7 +229,7 @@ class Config:
         self.save()
 
     @property
-    def max_ease(self):
+    def max_ease(self) -> int:
         return self.data[MAX_EASE]
 
     @max_ease.setter
@@ -147,7 +238,7 @@ class Config:
         self.save()
 
     @property
-    def min_ease(self):
+    def min_ease(self) -> int:
         return self.data[MIN_EASE]
 
     @min_ease.setter
@@ -156,7 +247,7 @@ class Config:
         self.save()
 
     @property
-    def moving_average_weight(self):
+    def moving_average_weight(self) -> float:
         return self.data[MOVING_AVERAGE_WEIGHT]
 
     @moving_average_weight.setter
@@ -165,7 +256,7 @@ class Config:
         self.save()
 
     @property
-    def stats_enabled(self):
+    def stats_enabled(self) -> bool:
         return self.data[STATS_ENABLED]
 
     @stats_enabled.setter
@@ -174,7 +265,7 @@ class Config:
         self.save()
 
     @property
-    def stats_duration(self):
+    def stats_duration(self) -> int:
         return self.data[STATS_DURATION]
 
     @stats_duration.setter
@@ -183,7 +274,7 @@ class Config:
         self.save()
 
     @property
-    def target_ratio(self):
+    def target_ratio(self) -> float:
         return self.data[TARGET_RATIO]
 
     @target_ratio.setter
@@ -192,7 +283,7 @@ class Config:
         self.save()
 
     @property
-    def reviews_only(self):
+    def reviews_only(self) -> bool:
         return self.data[REVIEWS_ONLY]
 
     @reviews_only.setter
@@ -201,7 +292,7 @@ class Config:
         self.save()
 
     @property
-    def auto_adjust_ease_on_review(self):
+    def auto_adjust_ease_on_review(self) -> bool:
         return self.data[AUTO_ADJUST_EASE_ON_REVIEW]
 
     @auto_adjust_ease_on_review.setter
@@ -210,10 +301,43 @@ class Config:
         self.save()
 
     @property
-    def auto_adjust_ease_after_review(self):
+    def auto_adjust_ease_after_review(self) -> bool:
         return self.data[AUTO_ADJUST_EASE_AFTER_REVIEW]
 
     @auto_adjust_ease_after_review.setter
     def auto_adjust_ease_after_review(self, value):
         self.data[AUTO_ADJUST_EASE_AFTER_REVIEW] = value
         self.save()
+
+    @property
+    def ease_optimizer_workers(self) -> int:
+        return self.data[EASE_OPTIMIZER_WORKERS]
+
+    @ease_optimizer_workers.setter
+    def ease_optimizer_workers(self, value):
+        self.data[EASE_OPTIMIZER_WORKERS] = value
+        self.save()
+
+
+config = Config()
+config.load()
+
+configuration_change_listeners: List[Callable[[], None]] = []
+
+
+def configuration_changed():
+    config.load()
+    for function in configuration_change_listeners:
+        function()
+
+
+def run_on_configuration_change(function):
+    """Run function after the config is changed in the config editor and config is reloaded."""
+    configuration_change_listeners.append(function)
+    return function
+
+
+def init_config_hook():
+    mw.addonManager.setConfigUpdatedAction(__name__, lambda *_: configuration_changed())
+    # Changes waiting for the save delay are written before Anki closes
+    profile_will_close.append(config.flush)
@@ -0,0 +1,129 @@
+import time
+
+from anki.utils import int_time
+from aqt import mw
+from aqt.gui_hooks import state_did_undo
+from aqt.utils import tooltip
+
+from .job_queue import run_job
+
+# Temp tables with the custom data markers of each card, so that filtering on them doesn't need
+# json_extract on the data of every card. They belong to the collection's connection and not to
+# the collection file, so nothing is added to the collection's schema, and they're built again
+# by the first refresh after the collection is opened.
+MARKERS_TABLE_NAME = "csh_markers"
+MARKERS_TABLE = f"temp.{MARKERS_TABLE_NAME}"
+MARKERS_META_TABLE = "temp.csh_markers_meta"
+
+# The markers, as the columns of the table and how they're extracted from cards.data,
+# which is empty instead of a JSON object for cards without data
+MARKER_COLUMNS = {
+    "v": "CASE WHEN data != '' THEN json_extract(json_extract(data, '$.cd'), '$.v') END",
+    "e": "CASE WHEN data != '' THEN json_extract(json_extract(data, '$.cd'), '$.e') END",
+    "sr": "CASE WHEN data != '' THEN json_extract(json_extract(data, '$.cd'), '$.sr') END",
+    "has_cd": "CASE WHEN data != '' THEN json_extract(data, '$.cd') IS NOT NULL ELSE 0 END",
+}
+
+
+def create_marker_index():
+    # The marker columns have no type, so that 0 and '0' stay different like in the JSON
+    mw.col.db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MARKERS_TABLE} (
+            cid INTEGER PRIMARY KEY,
+            {", ".join(MARKER_COLUMNS)}
+        )
+    """)
+    mw.col.db.execute(
+        f"CREATE INDEX IF NOT EXISTS {MARKERS_TABLE}_v ON {MARKERS_TABLE_NAME} (v)"
+    )
+    mw.col.db.execute(
+        f"CREATE INDEX IF NOT EXISTS {MARKERS_TABLE}_e ON {MARKERS_TABLE_NAME} (e)"
+    )
+    mw.col.db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MARKERS_META_TABLE} (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+
+
+def _index_cards(where: str = ""):
+    mw.col.db.execute(f"""
+        INSERT OR REPLACE INTO {MARKERS_TABLE} (cid, {", ".join(MARKER_COLUMNS)})
+        SELECT id, {", ".join(MARKER_COLUMNS.values())}
+        FROM cards
+        {where}
+    """)
+
+
+def _set_watermark(mod: int, usn: int):
+    mw.col.db.executemany(
+        f"INSERT OR REPLACE INTO {MARKERS_META_TABLE} (key, value) VALUES (?, ?)",
+        [("mod", mod), ("usn", usn)],
+    )
+
+
+def refresh_marker_index() -> None:
+    """
+    Bring the marker index up to date with the custom data of the cards, which stays the
+    source of truth. Only the cards changed since the last refresh are read again: the ones
+    modified since then, which includes writes through write_custom_data and the scheduler,
+    and the ones with a newer usn, which came in with a sync. The first refresh after the
+    collection is opened indexes every card.
+    """
+    create_marker_index()
+    watermark = dict(mw.col.db.all(f"SELECT key, value FROM {MARKERS_META_TABLE}"))
+    # Read before indexing, so that cards changed while indexing are read again next time
+    mod = int_time()
+    usn = mw.col.db.scalar("SELECT max(usn) FROM cards") or 0
+    if "mod" not in watermark or "usn" not in watermark:
+        mw.col.db.execute(f"DELETE FROM {MARKERS_TABLE}")
+        _index_cards()
+    else:
+        # The mod is in seconds, so cards modified in the second of the last refresh are
+        # read again in case they changed after it
+        _index_cards(f"WHERE mod >= {watermark['mod']} OR usn > {watermark['usn']}")
+    _set_watermark(mod, usn)
+
+
+def invalidate_marker_index(*args):
+    """
+    Make the next refresh index every card again. Undo restores cards with their old mod, so
+    the cards it changed can't be found by mod.
+    """
+    create_marker_index()
+    mw.col.db.execute(f"DELETE FROM {MARKERS_META_TABLE}")
+
+
+def rebuild_marker_index() -> None:
+    """Drop the marker index and index every card again."""
+    mw.col.db.execute(f"DROP TABLE IF EXISTS {MARKERS_TABLE}")
+    mw.col.db.execute(f"DROP TABLE IF EXISTS {MARKERS_META_TABLE}")
+    refresh_marker_index()
+
+
+def marker_query(condition: str) -> str:
+    """
+    SQL condition on cards, for the cards whose markers match the condition on the columns of
+    MARKER_COLUMNS. Refresh the index with refresh_marker_index before running the query.
+    """
+    return f"id IN (SELECT cid FROM {MARKERS_TABLE} WHERE {condition})"
+
+
+def rebuild_marker_index_command(did=None):
+    start_time = time.time()
+
+    def on_done(future):
+        future.result()
+        tooltip(f"Custom data index rebuilt in {time.time() - start_time:.2f} seconds")
+
+    run_job(
+        "rebuild_marker_index",
+        lambda _: rebuild_marker_index(),
+        on_done,
+        whole_collection=True,
+    )
+
+
+def init_marker_index_hook():
+    state_did_undo.append(invalidate_marker_index)
@@ -0,0 +1,215 @@
+from array import array
+from datetime import date, datetime, timedelta
+from typing import Iterable, Iterator, List, Sequence, Tuple, Union
+
+from aqt import mw
+
+# Number of days the lookup tables grow by when a day outside of them is requested
+CHUNK_DAYS = 366
+
+# FreeDayBitmap.weekday_mask with every weekday free
+ALL_WEEKDAYS_MASK = 0b1111111
+
+# A free date is either a single date or an inclusive [start, end] range of dates
+FreeDate = Union[date, str, Sequence[Union[date, str]]]
+
+
+def parse_free_dates(free_dates: Iterable[FreeDate]) -> List[Tuple[date, date]]:
+    """
+    Parse the free_dates config value into inclusive (start, end) date ranges.
+    :raises ValueError: If a date isn't in YYYY-MM-DD format or a range ends before it starts.
+    """
+
+    def to_date(value):
+        if isinstance(value, date):
+            return value
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Free date {value!r} is not a date in YYYY-MM-DD format")
+
+    ranges = []
+    for free_date in free_dates:
+        if isinstance(free_date, (date, str)):
+            start = end = to_date(free_date)
+        elif len(free_date) == 2:
+            start, end = to_date(free_date[0]), to_date(free_date[1])
+            if end < start:
+                raise ValueError(f"Free date range {free_date!r} ends before it starts")
+        else:
+            raise ValueError(f"Free date range {free_date!r} should be [start, end]")
+        ranges.append((start, end))
+    return ranges
+
+
+class FreeDayBitmap:
+    """
+    Free days compiled into a bitmap over day numbers, so checking a day is O(1).
+    Weekdays repeat, so they are kept as a 7 bit mask and only the holidays take a bit per day,
+    from the first to the last holiday.
+    """
+
+    def __init__(
+        self,
+        today: int,
+        today_weekday: int,
+        free_weekdays: Iterable[int],
+        holiday_ranges: Iterable[Tuple[int, int]],
+    ) -> None:
+        """
+        :param holiday_ranges: Inclusive (start, end) day number ranges of holidays.
+        """
+        self.today = today
+        self.today_weekday = today_weekday
+        self.weekday_mask = 0
+        for weekday in free_weekdays:
+            self.weekday_mask |= 1 << weekday
+        self.holiday_ranges = sorted(holiday_ranges)
+        self.first_day = min((start for start, _ in self.holiday_ranges), default=0)
+        last_day = max((end for _, end in self.holiday_ranges), default=-1)
+        self.bits = bytearray((last_day - self.first_day) // 8 + 1 if self.holiday_ranges else 0)
+        for start, end in self.holiday_ranges:
+            for day in range(start - self.first_day, end - self.first_day + 1):
+                self.bits[day >> 3] |= 1 << (day & 7)
+
+    def is_free_weekday(self, day: int) -> bool:
+        return (self.weekday_mask >> ((self.today_weekday + day - self.today) % 7)) & 1 == 1
+
+    def is_holiday(self, day: int) -> bool:
+        index = day - self.first_day
+        if index < 0 or index >> 3 >= len(self.bits):
+            return False
+        return (self.bits[index >> 3] >> (index & 7)) & 1 == 1
+
+    def __contains__(self, day: int) -> bool:
+        return self.is_free_weekday(day) or self.is_holiday(day)
+
+    def __bool__(self) -> bool:
+        return self.weekday_mask != 0 or len(self.holiday_ranges) > 0
+
+    def holidays_from(self, first_day: int) -> Iterator[Tuple[int, int]]:
+        """Inclusive day number ranges of the holidays ending on or after first_day."""
+        for start, end in self.holiday_ranges:
+            if end >= first_day:
+                yield max(start, first_day), end
+
+
+class DayCalendar:
+    """
+    Lookup tables from Anki day numbers (the unit of mw.col.sched.today and of card.due for
+    review cards) to weekday and ISO date string, plus the bitmap of free days.
+    Build one per job, so that weekday and date conversions are done once per day instead of
+    with datetime arithmetic for every card.
+    """
+
+    today: int
+    today_date: date
+    first_day: int
+    weekdays: array
+    iso_dates: list[str]
+    free: FreeDayBitmap
+
+    def __init__(
+        self,
+        today: int,
+        day_cutoff: int,
+        free_weekdays: Iterable[int] = (),
+        holidays: Iterable[FreeDate] = (),
+    ) -> None:
+        """
+        :param today: The day number of today, mw.col.sched.today.
+        :param day_cutoff: The timestamp when the next day starts, mw.col.sched.day_cutoff.
+        :param free_weekdays: Weekdays that are free, 0 is Monday.
+        :param holidays: Specific dates that are free, as dates or ISO date strings, or
+                         inclusive [start, end] ranges of them.
+        """
+        self.today = today
+        # The day number counts from the day cutoff, so today's date is the date before the cutoff
+        self.today_date = datetime.fromtimestamp(day_cutoff - 86400).date()
+        self.free_weekdays = frozenset(free_weekdays)
+        self.free = FreeDayBitmap(
+            today,
+            self.today_weekday,
+            self.free_weekdays,
+            [
+                (self.date_to_day(start), self.date_to_day(end))
+                for start, end in parse_free_dates(holidays)
+            ],
+        )
+        self.first_day = today
+        self.weekdays = array("b")
+        self.iso_dates = []
+        self._extend_end(today + CHUNK_DAYS)
+
+    @classmethod
+    def for_collection(cls, free_weekdays: Iterable[int] = (), holidays=()) -> "DayCalendar":
+        return cls(mw.col.sched.today, mw.col.sched.day_cutoff, free_weekdays, holidays)
+
+    @classmethod
+    def for_config(cls, config) -> "DayCalendar":
+        """The calendar with the free days of the config, which only apply with load balancing."""
+        if not config.load_balance:
+            return cls.for_collection()
+        return cls.for_collection(config.free_weekdays, config.free_date_ranges)
+
+    @property
+    def today_weekday(self) -> int:
+        return self.today_date.weekday()
+
+    def date_to_day(self, day_date: Union[date, str]) -> int:
+        if isinstance(day_date, str):
+            day_date = date.fromisoformat(day_date)
+        return self.today + (day_date - self.today_date).days
+
+    def _build(self, start: int, end: int):
+        weekdays = array("b")
+        iso_dates = []
+        start_date = self.today_date + timedelta(days=start - self.today)
+        start_weekday = start_date.weekday()
+        ordinal = start_date.toordinal()
+        for offset in range(end - start):
+            weekdays.append((start_weekday + offset) % 7)
+            iso_dates.append(date.fromordinal(ordinal + offset).isoformat())
+        return weekdays, iso_dates
+
+    def _extend_end(self, end: int):
+        start = self.first_day + len(self.weekdays)
+        weekdays, iso_dates = self._build(start, end)
+        self.weekdays.extend(weekdays)
+        self.iso_dates.extend(iso_dates)
+
+    def _extend_start(self, start: int):
+        weekdays, iso_dates = self._build(start, self.first_day)
+        self.weekdays = weekdays + self.weekdays
+        self.iso_dates = iso_dates + self.iso_dates
+        self.first_day = start
+
+    def _index(self, day: int) -> int:
+        # Grows the tables to cover the day, callers must get the index before reading a table
+        # as growing at the start replaces them
+        index = day - self.first_day
+        if index < 0:
+            self._extend_start(day - CHUNK_DAYS)
+            index = day - self.first_day
+        elif index >= len(self.weekdays):
+            self._extend_end(day + CHUNK_DAYS)
+        return index
+
+    def weekday(self, day: int) -> int:
+        index = self._index(day)
+        return self.weekdays[index]
+
+    def date_str(self, day: int) -> str:
+        index = self._index(day)
+        return self.iso_dates[index]
+
+    def is_free(self, day: int) -> bool:
+        return day in self.free
+
+    def next_non_free_day(self, day: int, step: int = 1) -> int:
+        """The first day from day onwards, or backwards with step=-1, that isn't free."""
+        # With every weekday free there is no such day
+        if self.free.weekday_mask != ALL_WEEKDAYS_MASK:
+            while day in self.free:
+                day += step
+        return day
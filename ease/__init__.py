@@ -1,8 +1,22 @@
-import aqt
 from aqt.gui_hooks import reviewer_will_answer_card, reviewer_did_answer_card
-from .auto_ease_factor import adjust_factor_when_review, adjust_factor_after_review
+
+from ..configuration import config
+from ..lazy import lazy
 
 
 def init_ease_adjust_review_hook():
-    reviewer_will_answer_card.append(adjust_factor_when_review)
-    reviewer_did_answer_card.append(adjust_factor_after_review)
+    adjust_factor_when_review = lazy(".auto_ease_factor", "adjust_factor_when_review", __name__)
+    adjust_factor_after_review = lazy(".auto_ease_factor", "adjust_factor_after_review", __name__)
+
+    # The flags are checked before the stubs, so that the module isn't imported while they're off
+    def when_review(ease_tuple, reviewer, card):
+        if not config.auto_adjust_ease_on_review:
+            return ease_tuple
+        return adjust_factor_when_review(ease_tuple, reviewer, card)
+
+    def after_review(reviewer, card, ease):
+        if config.auto_adjust_ease_after_review:
+            adjust_factor_after_review(reviewer, card, ease)
+
+    reviewer_will_answer_card.append(when_review)
+    reviewer_did_answer_card.append(after_review)
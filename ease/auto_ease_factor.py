@@ -1,6 +1,11 @@
 # inspired by https://eshapard.github.io/
+import base64
+import copy
 import math
+import struct
 import time
+import zlib
+from typing import Callable, Optional
 
 from anki.consts import (
     REVLOG_LRN,
@@ -12,20 +17,54 @@ from anki.consts import (
     QUEUE_TYPE_REV,
 )
 from anki.decks import DeckManager
-from anki.utils import ids2str
+from anki.utils import ids2str, int_time
 from aqt import mw
 
 # anki interfaces
 from aqt import reviewer
 from aqt.utils import tooltip
 
-from ..configuration import Config
-from ..utils import write_custom_data
+from ..card_history import ANSWER_TYPES, CardHistory, card_histories, get_deck_starting_ease
+from ..configuration import config
+from ..custom_data_index import marker_query, refresh_marker_index
+from ..id_sets import id_set
+from ..job_queue import run_job
+from ..journal import journal_before_job
+from ..utils import (
+    BackgroundProgress,
+    card_snapshot,
+    read_custom_data,
+    updated_card_data,
+    updated_card_data_batch,
+    write_custom_data,
+)
+
+# Number of revlog factors written with one executemany during deck adjustment
+REVLOG_CHUNK_SIZE = 20000
+
+# Number of cards read, replayed and written at a time in adjust_ease_factors_background
+ADJUST_CHUNK_SIZE = 2000
+
+# Custom data key of the ease state the review hook continues from
+EASE_STATE_KEY = "es"
 
-LOG = True
+# The ease state is stored packed in this struct format, as base64 without the padding: the
+# success rate in millionths, factor sum, factor count, factor tail in hundredths, last factor,
+# config fingerprint and reps. That's 27 characters, where the JSON list of the values takes
+# around 45.
+EASE_STATE_FORMAT = "<IIHiHHH"
 
 # add on utilities
-from .ease_calculator import calculate_ease, get_success_rate, moving_average
+from .ease_calculator import (
+    EaseState,
+    calculate_ease,
+    get_success_rate,
+    moving_average,
+    moving_averages,
+    replay_ease,
+    replay_ease_batch,
+    suggest_factor,
+)
 
 
 def get_all_reps(card=mw.reviewer.card) -> list[int]:
@@ -37,9 +76,9 @@ def get_all_reps(card=mw.reviewer.card) -> list[int]:
         """)
 
 
-def get_all_reps_with_ids(card=mw.reviewer.card) -> list[tuple[int, int]]:
+def get_all_reps_with_ids(card=mw.reviewer.card) -> list[tuple[int, int, int]]:
     return mw.col.db.all(f"""
-        select id, ease
+        select id, ease, type
         from revlog
         where cid = {card.id}
         and type IN ({REVLOG_LRN}, {REVLOG_REV}, {REVLOG_RELRN}, {REVLOG_CRAM})
@@ -56,6 +95,23 @@ def get_reviews_only(card=mw.reviewer.card, rids: list[int] = None) -> list[int]
         """)
 
 
+def get_reps_with_factors(card=mw.reviewer.card, limit: Optional[int] = None):
+    """
+    The ease, factor and type of the card's reps, oldest first.
+    :param limit: Only get this many of the latest reps.
+    """
+    reps = mw.col.db.all(f"""
+        select ease, factor, type
+        from revlog
+        where cid = {card.id}
+        and type IN ({REVLOG_LRN}, {REVLOG_REV}, {REVLOG_RELRN}, {REVLOG_CRAM})
+        {f"order by id desc limit {limit}" if limit is not None else ""}
+        """)
+    if limit is not None:
+        reps.reverse()
+    return reps
+
+
 def get_ease_factors(card=mw.reviewer.card) -> list[int]:
     return mw.col.db.list(f"""
         select factor
@@ -70,11 +126,190 @@ def get_starting_ease(card=mw.reviewer.card) -> int:
     deck_id = card.did
     if card.odid:
         deck_id = card.odid
+    return get_deck_starting_ease(deck_id)
+
+
+def write_ease_custom_data(card, success_rate: float):
+    """Mark the card as adjusted and cache its success rate for the scheduler."""
+    write_custom_data(
+        card,
+        key_values=[
+            {"key": "e", "value": "a"},
+            {"key": "sr", "value": round(success_rate, 3)},
+        ],
+    )
+
+
+def ease_state_fingerprint(config) -> int:
+    """
+    A short check value of the config values the ease state depends on, stored with the state so
+    that a state stored before they changed is recomputed instead of continued.
+    """
+    values = (config.target_ratio, config.moving_average_weight, config.reviews_only)
+    return zlib.crc32(repr(values).encode()) & 0xFFFF
+
+
+def pack_ease_state(config, ease_state: EaseState, reps: int) -> Optional[str]:
+    """
+    The ease state with the config fingerprint and number of reps, packed in EASE_STATE_FORMAT.
+    :return: None if a value doesn't fit in its field, like a card with over 65535 reps.
+    """
+    success_rate, factor_sum, factor_count, factor_tail, last_factor = ease_state.dump()
+    try:
+        packed = struct.pack(
+            EASE_STATE_FORMAT,
+            round(success_rate * 1e6),
+            factor_sum,
+            factor_count,
+            round(factor_tail * 100),
+            last_factor,
+            ease_state_fingerprint(config),
+            reps,
+        )
+    except struct.error:
+        return None
+    return base64.b64encode(packed).decode().rstrip("=")
+
+
+def unpack_ease_state(config, value, reps: int) -> Optional[EaseState]:
+    """
+    The ease state packed by pack_ease_state, or None if the value isn't one, like the list
+    older versions stored, or it's stale, see load_ease_state.
+    """
+    if not isinstance(value, str):
+        return None
     try:
-        deck_starting_ease = mw.col.decks.config_dict_for_deck_id(deck_id)["new"]["initialFactor"]
-    except KeyError:
-        deck_starting_ease = 2500
-    return deck_starting_ease
+        fields = struct.unpack(EASE_STATE_FORMAT, base64.b64decode(value + "=" * (-len(value) % 4)))
+    except (ValueError, struct.error):
+        return None
+    success_rate, factor_sum, factor_count, factor_tail, last_factor, fingerprint, state_reps = (
+        fields
+    )
+    if fingerprint != ease_state_fingerprint(config) or state_reps != reps:
+        return None
+    return EaseState.load(
+        config.target_ratio,
+        config.moving_average_weight,
+        [success_rate / 1e6, factor_sum, factor_count, factor_tail / 100, last_factor],
+    )
+
+
+def write_ease_state(config, card, ease_state: Optional[EaseState]):
+    """
+    Store the ease state of the card, along with the config fingerprint and its number of reps,
+    in its custom data so the review hook can continue from it. If ease_state is None, any
+    stored state is removed.
+    """
+    value = None if ease_state is None else pack_ease_state(config, ease_state, card.reps)
+    # A state that can't be packed, or doesn't fit with the rest of the custom data and is
+    # dropped by write_custom_data, is recomputed on the next answer
+    write_custom_data(card, EASE_STATE_KEY, value)
+
+
+def load_ease_state(config, card, reps: int) -> Optional[EaseState]:
+    """
+    The ease state stored in the card's custom data, or None if there isn't one or it's stale,
+    as it was stored when the card had a different number of reps than given or with different
+    config values, see ease_state_fingerprint.
+    """
+    return unpack_ease_state(config, read_custom_data(card.custom_data, EASE_STATE_KEY), reps)
+
+
+def ease_state_from_reps(config, reps) -> EaseState:
+    """
+    The ease state of all the reps, with the factors of all but the latest rep that has one,
+    as the latest factor is ignored when suggesting the factor after a review.
+    :param reps: (ease, factor, type) of the card's reps, from get_reps_with_factors.
+    """
+    state = EaseState(config.target_ratio, config.moving_average_weight)
+    for ease, _, rep_type in reps:
+        if not config.reviews_only or rep_type == REVLOG_REV:
+            state.add_review(ease)
+    factors = [factor for _, factor, _ in reps if factor > 0]
+    for factor in factors[:-1]:
+        state.add_factor(factor)
+    return state
+
+
+def factor_from_ease_state(config, card, ease_state: EaseState, latest_factor: Optional[int]):
+    """Suggested factor after a review from the ease state, same as suggested_factor."""
+    # The latest factor is only used when it's the only one
+    if ease_state.factor_count == 0 and latest_factor:
+        ease_state = copy.copy(ease_state)
+        ease_state.add_factor(latest_factor)
+    return ease_state.next_factor(config, get_starting_ease(card))
+
+
+def suggested_factor_after_review(config, card=mw.reviewer.card) -> int:
+    """
+    Suggested factor for a card that was just answered, same as suggested_factor(config, card).
+    The ease state stored on the previous answer is updated with the new answer, so only the
+    latest two reps are read. The whole revlog of the card is only read when there's no stored
+    state for the previous number of reps, and then the state is stored for the next answer.
+    """
+    ease_state = load_ease_state(config, card, card.reps - 1)
+    if ease_state is not None:
+        reps = get_reps_with_factors(card, limit=2)
+        if len(reps) < 2 or reps[-1][1] <= 0:
+            ease_state = None
+    if ease_state is not None:
+        (_, prev_factor, _), (ease, latest_factor, rep_type) = reps
+        if prev_factor > 0:
+            ease_state.add_factor(prev_factor)
+        if not config.reviews_only or rep_type == REVLOG_REV:
+            ease_state.add_review(ease)
+    else:
+        reps = card_histories.get_for_card(card).reps()
+        ease_state = ease_state_from_reps(config, reps)
+        factors = [factor for _, factor, _ in reps if factor > 0]
+        latest_factor = factors[-1] if len(factors) > 0 else None
+
+    new_factor, success_rate = factor_from_ease_state(config, card, ease_state, latest_factor)
+    write_ease_custom_data(card, success_rate)
+    # The state leaves out the factor of the latest rep, which is only known to be the one
+    # read from the latest two reps on the next answer if the latest rep has a factor
+    if len(reps) > 0 and reps[-1][1] > 0:
+        write_ease_state(config, card, ease_state)
+    else:
+        write_ease_state(config, card, None)
+    return new_factor
+
+
+def suggested_factor_when_review(config, card, new_answer, prev_card_factor) -> int:
+    """
+    Suggested factor for a card about to be answered, same as suggested_factor with new_answer.
+    Uses a copy of the ease state stored on the previous answer, if there is one for the card's
+    current number of reps, instead of reading the revlog.
+    """
+    ease_state = load_ease_state(config, card, card.reps)
+    if ease_state is None or not prev_card_factor:
+        return suggested_factor(config, card, new_answer, prev_card_factor)
+    # The stored state leaves out the latest factor, which is replaced by the card's factor
+    ease_state.add_factor(prev_card_factor)
+    ease_state.add_review(new_answer)
+    new_factor, success_rate = ease_state.next_factor(config, get_starting_ease(card))
+    write_ease_custom_data(card, success_rate)
+    return new_factor
+
+
+def write_revlog_factors(
+    revlog_factors: list[tuple[int, int]],
+    on_progress: Optional[Callable[[int, int], None]] = None,
+):
+    """
+    Rewrite the factor of revlog entries in chunks, one executemany per chunk.
+    This breaks undo history, so no undoing is possible after this.
+    :param revlog_factors: (revlog id, factor) pairs.
+    :param on_progress: Called with the number of entries written and the total after each chunk.
+    """
+    for start in range(0, len(revlog_factors), REVLOG_CHUNK_SIZE):
+        chunk = revlog_factors[start : start + REVLOG_CHUNK_SIZE]
+        mw.col.db.executemany(
+            "update revlog set factor = ? where id = ?",
+            [(factor, rep_id) for rep_id, factor in chunk],
+        )
+        if on_progress is not None:
+            on_progress(start + len(chunk), len(revlog_factors))
 
 
 def suggested_factor(
@@ -85,8 +320,14 @@ def suggested_factor(
     leashed=True,
     is_deck_adjustment=False,
     set_custom_data=True,
+    revlog_factors: Optional[list[tuple[int, int]]] = None,
 ) -> int:
-    """Loads card history from anki and returns suggested factor"""
+    """
+    Loads card history from anki, or the card history cache, and returns suggested factor
+    :param revlog_factors: For a deck adjustment, the (revlog id, factor) pairs of the card's
+                rewritten past factors are appended to this list, to be written in bulk with
+                write_revlog_factors. If None, they are written right away.
+    """
 
     deck_starting_ease = get_starting_ease(card)
 
@@ -97,32 +338,29 @@ def suggested_factor(
     # If doing deck adjustment, rewrite all past factors in revlog
     if is_deck_adjustment:
         all_reps = get_all_reps_with_ids(card)
-        card_settings["factor_list"] = [deck_starting_ease]
-        for i in range(len(all_reps)):
-            rep_id = all_reps[i][0]
-            card_settings["review_list"] = (
-                get_reviews_only(card, rids=[r[0] for r in all_reps[0:i]])
-                if config.reviews_only
-                else [r[1] for r in all_reps[0:i]]
-            )
-            new_factor, _ = calculate_ease(config, deck_starting_ease, card_settings, leashed)
-            # This breaks undo history, so no undoing is possible when doing deck adjustment
-            mw.col.db.execute("update revlog set factor = ? where id = ?", new_factor, rep_id)
-            card_settings["factor_list"].append(new_factor)
-    if config.reviews_only:
-        card_settings["review_list"] = get_reviews_only(card)
-    else:
-        card_settings["review_list"] = get_all_reps(card)
-    if new_answer is not None:
-        append_answer = new_answer
-        card_settings["review_list"].append(append_answer)
-    factor_list = get_ease_factors(card)
-    if factor_list is not None and len(factor_list) > 0 and prev_card_factor is not None:
-        factor_list[-1] = prev_card_factor
-    card_settings["factor_list"] = factor_list
-    # Ignore latest ease if you are applying algorithm from deck settings
-    if new_answer is None and len(card_settings["factor_list"]) > 1:
-        card_settings["factor_list"] = card_settings["factor_list"][:-1]
+        rep_factors, new_factor, success_rate = replay_ease(
+            config,
+            deck_starting_ease,
+            answers=[ease for _, ease, _ in all_reps],
+            is_review=[rep_type == REVLOG_REV for _, _, rep_type in all_reps],
+            leashed=leashed,
+        )
+        card_revlog_factors = [
+            (rep_id, rep_factor) for (rep_id, _, _), rep_factor in zip(all_reps, rep_factors)
+        ]
+        if revlog_factors is None:
+            write_revlog_factors(card_revlog_factors)
+            card_histories.clear()
+        else:
+            revlog_factors.extend(card_revlog_factors)
+        if set_custom_data:
+            write_ease_custom_data(card, success_rate)
+            # The stored state no longer matches the rewritten revlog factors
+            write_ease_state(config, card, None)
+        return new_factor
+    history = card_histories.get_for_card(card)
+    card_settings["review_list"] = history.review_list(config.reviews_only, new_answer)
+    card_settings["factor_list"] = history.factor_list(new_answer, prev_card_factor)
     new_factor, success_rate = calculate_ease(
         config=config,
         deck_starting_ease=deck_starting_ease,
@@ -130,24 +368,27 @@ def suggested_factor(
         leashed=leashed,
     )
     if set_custom_data:
-        write_custom_data(
-            card,
-            key_values=[
-                {"key": "e", "value": "a"},
-                {"key": "sr", "value": round(success_rate, 3)},
-            ],
-        )
+        write_ease_custom_data(card, success_rate)
     return new_factor
 
 
-def get_stats(config, card=mw.reviewer.card, new_answer=None, prev_card_factor=None):
-    rep_list = get_all_reps(card)
-    if new_answer:
-        rep_list.append(new_answer)
-    factor_list = get_ease_factors(card)
+def get_stats(
+    config,
+    history: CardHistory,
+    card_queue: int,
+    card_type: int,
+    new_answer=None,
+    prev_card_factor=None,
+):
+    """
+    Build the stats tooltip of a card from its history and its queue and type before the
+    answer. Doesn't touch the collection, so it can run in the background.
+    """
+    rep_list = history.rep_list(new_answer)
+    factor_list = history.ease_factors()
     weight = config.moving_average_weight
     target = config.target_ratio
-    starting_ease_factor = get_starting_ease(card)
+    starting_ease_factor = history.deck_starting_ease
 
     if rep_list is None or len(rep_list) < 1:
         success_rate = target
@@ -184,8 +425,9 @@ def get_stats(config, card=mw.reviewer.card, new_answer=None, prev_card_factor=N
         -3: "manually buried",
     }
 
-    msg = f"card ID: {card.id}<br>"
-    msg += f"Card Queue (Type): {queue_types[card.queue]} ({card_types[card.type]})<br>"
+    msg = f"card ID: {history.card_id}<br>"
+    msg += "Card Queue (Type): "
+    msg += f"{queue_types[card_queue]} ({card_types[card_type]})<br>"
     msg += f"MAvg success rate: {round(success_rate, 4)}<br>"
     msg += f"MAvg factor: {round(average_ease, 2)}<br>"
     msg += f""" (delta: {round(delta_ratio, 2)})<br>"""
@@ -195,20 +437,26 @@ def get_stats(config, card=mw.reviewer.card, new_answer=None, prev_card_factor=N
         msg += f"Last rev factor: {last_rev_factor}"
         msg += f" (actual: {prev_card_factor})<br>"
 
-    if card.queue != 2 and config.reviews_only:
+    if card_queue != 2 and config.reviews_only:
         msg += "New factor: NONREVIEW, NO CHANGE<br>"
     else:
-        new_factor = suggested_factor(
-            config, card, new_answer, prev_card_factor, set_custom_data=False
+        # Same as suggested_factor, with the leashed and unleashed factor suggested from the
+        # same moving averages
+        current_ease_factor, suggest_success_rate, suggest_average_ease = moving_averages(
+            config,
+            starting_ease_factor,
+            history.review_list(config.reviews_only, new_answer),
+            history.factor_list(new_answer, prev_card_factor),
         )
-        unleashed_factor = suggested_factor(
+        suggest_args = (
             config,
-            card,
-            new_answer,
-            prev_card_factor,
-            leashed=False,
-            set_custom_data=False,
+            starting_ease_factor,
+            current_ease_factor,
+            suggest_success_rate,
+            suggest_average_ease,
         )
+        new_factor, _ = suggest_factor(*suggest_args, leashed=True)
+        unleashed_factor, _ = suggest_factor(*suggest_args, leashed=False)
         if new_factor == unleashed_factor:
             msg += f"New factor: {new_factor}<br>"
         else:
@@ -220,22 +468,30 @@ def get_stats(config, card=mw.reviewer.card, new_answer=None, prev_card_factor=N
 
 def display_stats(config, new_answer=None, prev_card_factor=None):
     card = mw.reviewer.card
-    msg = get_stats(config, card, new_answer, prev_card_factor)
-    tooltip_args = {"msg": msg, "period": config.stats_duration}
-    tooltip(**tooltip_args)
+    # Load the history before the answer is written to the revlog, the tooltip is built in the
+    # background so it doesn't hold up answering
+    history = card_histories.get_for_card(card)
+    card_queue = card.queue
+    card_type = card.type
 
+    def on_done(future):
+        tooltip_args = {"msg": future.result(), "period": config.stats_duration}
+        tooltip(**tooltip_args)
+
+    mw.taskman.run_in_background(
+        lambda: get_stats(config, history, card_queue, card_type, new_answer, prev_card_factor),
+        on_done,
+    )
 
-def adjust_factor_when_review(ease_tuple, reviewer=reviewer.Reviewer, card=mw.reviewer.card):
-    config = Config()
-    config.load()
 
+def adjust_factor_when_review(ease_tuple, reviewer=reviewer.Reviewer, card=mw.reviewer.card):
     if not config.auto_adjust_ease_on_review:
         return ease_tuple
     assert card is not None
     new_answer = ease_tuple[1]
     prev_card_factor = card.factor
     if card.queue == 2 or not config.reviews_only:
-        card.factor = suggested_factor(
+        card.factor = suggested_factor_when_review(
             config=config,
             card=card,
             new_answer=new_answer,
@@ -247,9 +503,6 @@ def adjust_factor_when_review(ease_tuple, reviewer=reviewer.Reviewer, card=mw.re
 
 
 def adjust_factor_after_review(reviewer: reviewer.Reviewer, card: mw.reviewer.card, ease: int):
-    config = Config()
-    config.load()
-
     if not config.auto_adjust_ease_after_review:
         return
 
@@ -258,24 +511,51 @@ def adjust_factor_after_review(reviewer: reviewer.Reviewer, card: mw.reviewer.ca
         # Merge undo entry for the review
         undo_status = mw.col.undo_status()
         undo_entry = undo_status.last_step
-        card.factor = suggested_factor(config, card)
+        snapshot = card_snapshot(card)
+        card.factor = suggested_factor_after_review(config, card)
+        if card_snapshot(card) == snapshot:
+            return
         # Update card with the new custom_data
         mw.col.update_card(card)
         mw.col.merge_undo_entries(undo_entry)
 
 
+def get_deck_starting_eases(cards) -> list[int]:
+    """
+    get_starting_ease for (did, odid) rows of cards, looking up each deck's config only once.
+    """
+    starting_eases = {}
+    result = []
+    for did, odid in cards:
+        deck_id = odid if odid else did
+        if deck_id not in starting_eases:
+            try:
+                starting_eases[deck_id] = mw.col.decks.config_dict_for_deck_id(deck_id)["new"][
+                    "initialFactor"
+                ]
+            except KeyError:
+                starting_eases[deck_id] = 2500
+        result.append(starting_eases[deck_id])
+    return result
+
+
 def adjust_ease_factors_background(
     did=None,
     recent=False,
     marked_only=False,
     card_ids=None,
 ):
-    config = Config()
-    config.load()
-
-    mw.taskman.run_on_main(lambda: mw.progress.start(label="Adjusting ease", immediate=False))
+    """
+    Deck adjustment of the matching cards, streamed in chunks of ADJUST_CHUNK_SIZE cards.
+    Each chunk's cards and their reps are read with one query each, paginated by card id,
+    the factors are replayed for the whole chunk with replay_ease_batch and then the revlog
+    factors and the cards' factors and custom data are written with one executemany each.
+    Cancelling is checked between chunks, so each card and its revlog are either fully adjusted
+    or untouched.
+    """
 
     cnt = 0
+    skipped = 0
     DM = DeckManager(mw.col)
 
     if did is not None:
@@ -287,43 +567,171 @@ def adjust_ease_factors_background(
         day_before_cutoff = today_cutoff - (config.days_to_reschedule + 1) * 86400
         recent_query = f"AND id IN (SELECT cid FROM revlog WHERE id >= {day_before_cutoff * 1000})"
 
-    if card_ids:
-        card_ids_query = f"AND id IN {ids2str(card_ids)}"
-
-    if marked_only:
-        marked_query = "AND json_extract(json_extract(data, '$.cd'), '$.e') = 0"
-
-    card_ids = mw.col.db.list(f"""
-        SELECT
-            id
-        FROM cards
-        WHERE queue IN ({QUEUE_TYPE_LRN}, {QUEUE_TYPE_REV}, {QUEUE_TYPE_DAY_LEARN_RELEARN})
-        {did_query if did is not None else ""}
-        {recent_query if recent else ""}
-        {card_ids_query if card_ids else ""}
-        {marked_query if marked_only else ""}
-    """)
-
-    for card_id in card_ids:
-        card = mw.col.get_card(card_id)
-        if LOG:
-            print("old factor", card.factor)
-        card.factor = suggested_factor(config=config, card=card, is_deck_adjustment=True)
-        if LOG:
-            print("new factor", card.factor)
+    # The browser selection can be any number of cards
+    with id_set(card_ids if card_ids else ()) as card_id_list:
+        if card_ids:
+            card_ids_query = f"AND id IN {card_id_list}"
+
+        if marked_only:
+            refresh_marker_index()
+            marked_query = f"AND {marker_query('e = 0')}"
+
+        card_filter = f"""
+            queue IN ({QUEUE_TYPE_LRN}, {QUEUE_TYPE_REV}, {QUEUE_TYPE_DAY_LEARN_RELEARN})
+            {did_query if did is not None else ""}
+            {recent_query if recent else ""}
+            {card_ids_query if card_ids else ""}
+            {marked_query if marked_only else ""}
+        """
+        # The revlog factors are rewritten too, so they are saved with the cards
+        journal_before_job("Adjust ease", revlog=True, card_filter=card_filter)
+        total = mw.col.db.scalar(f"SELECT count() FROM cards WHERE {card_filter}")
+        progress = BackgroundProgress("Adjusting ease", max=total)
+
+        last_id = 0
+        while not progress.cancelled:
+            cards = mw.col.db.all(f"""
+                SELECT
+                    id,
+                    did,
+                    odid,
+                    factor,
+                    data
+                FROM cards
+                WHERE id > {last_id}
+                AND {card_filter}
+                ORDER BY id
+                LIMIT {ADJUST_CHUNK_SIZE}
+            """)
+            if len(cards) == 0:
+                break
+            last_id = cards[-1][0]
+
+            reps = mw.col.db.all(f"""
+                SELECT
+                    cid,
+                    id,
+                    ease,
+                    type,
+                    factor
+                FROM revlog
+                WHERE cid IN {ids2str(card[0] for card in cards)}
+                AND type IN ({REVLOG_LRN}, {REVLOG_REV}, {REVLOG_RELRN}, {REVLOG_CRAM})
+                ORDER BY cid, id
+            """)
+            # The reps are ordered by card like the cards, so each card's reps are the next ones
+            offsets = [0]
+            rep_index = 0
+            for card in cards:
+                while rep_index < len(reps) and reps[rep_index][0] == card[0]:
+                    rep_index += 1
+                offsets.append(rep_index)
+
+            rep_factors, new_factors, success_rates = replay_ease_batch(
+                config,
+                get_deck_starting_eases((card_did, odid) for _, card_did, odid, _, _ in cards),
+                [ease for _, _, ease, _, _ in reps],
+                offsets,
+                [rep_type == REVLOG_REV for _, _, _, rep_type, _ in reps],
+            )
 
-        mw.col.update_card(card)
-        # This is a deck adjustment, so mergin undo entries is not possible due to the
-        # db.execute() call in suggested_factor
-        cnt += 1
-        if cnt % 200 == 0:
-            mw.taskman.run_on_main(
-                lambda: mw.progress.update(value=cnt, label=f"{cnt} cards adjusted")
+            # Only the factors that change are written, on repeat runs most stay the same
+            mw.col.db.executemany(
+                "UPDATE revlog SET factor = ? WHERE id = ?",
+                [
+                    (int(factor), rep[1])
+                    for rep, factor in zip(reps, rep_factors)
+                    if int(factor) != rep[4]
+                ],
+            )
+            mod = int_time()
+            usn = mw.col.usn()
+            # Same custom data as write_ease_custom_data and
+            # write_ease_state(config, card, None)
+            new_datas = updated_card_data_batch(
+                [data for _, _, _, _, data in cards],
+                [
+                    [
+                        {"key": "e", "value": "a"},
+                        {"key": "sr", "value": round(float(success_rate), 3)},
+                        {"key": EASE_STATE_KEY, "value": None},
+                    ]
+                    for success_rate in success_rates
+                ],
+            )
+            card_updates = []
+            for (cid, _, _, factor, data), new_factor, new_data in zip(
+                cards, new_factors, new_datas
+            ):
+                if new_data == data:
+                    # Like write_ease_state, the stale state is removed even when the rest
+                    # doesn't fit, as the revlog factors it was computed from were rewritten
+                    new_data = updated_card_data(data, [{"key": EASE_STATE_KEY, "value": None}])
+                if int(new_factor) == factor and new_data == data:
+                    skipped += 1
+                    continue
+                card_updates.append((int(new_factor), new_data, mod, usn, cid))
+            # This is a deck adjustment, so undoing is not possible as the cards and revlog are
+            # written directly
+            mw.col.db.executemany(
+                "UPDATE cards SET factor = ?, data = ?, mod = ?, usn = ? WHERE id = ?",
+                card_updates,
             )
-        if mw.progress.want_cancel():
-            break
 
-    return f"Adjusted ease for {cnt} cards"
+            cnt += len(cards)
+            progress.update(value=cnt, label=f"{cnt}/{total} cards adjusted")
+
+    # The cached histories have the old revlog factors
+    card_histories.clear()
+    return f"Adjusted ease for {cnt - skipped} cards, {skipped} unchanged"
+
+
+def adjust_ease_of_cards(config, cards: list, histories: list[CardHistory]) -> list[CardHistory]:
+    """
+    Deck adjustment of cards that are already loaded, same as adjust_ease_factors_background
+    does for them, replayed in one batch from their histories. The revlog factors are written
+    right away, the factors and custom data are set on the cards for the caller to write.
+    :param histories: The history of each card, in the same order.
+    :return: The histories with the rewritten revlog factors.
+    """
+    if len(cards) == 0:
+        return []
+    rep_indexes = []
+    offsets = [0]
+    for history in histories:
+        rep_indexes.append(
+            [index for index, rep_type in enumerate(history.types) if rep_type in ANSWER_TYPES]
+        )
+        offsets.append(offsets[-1] + len(rep_indexes[-1]))
+    rep_factors, new_factors, success_rates = replay_ease_batch(
+        config,
+        [history.deck_starting_ease for history in histories],
+        [history.eases[i] for history, indexes in zip(histories, rep_indexes) for i in indexes],
+        offsets,
+        [
+            history.types[i] == REVLOG_REV
+            for history, indexes in zip(histories, rep_indexes)
+            for i in indexes
+        ],
+    )
+
+    revlog_factors = []
+    new_histories = []
+    for card_index, (card, history, indexes) in enumerate(zip(cards, histories, rep_indexes)):
+        factors = list(history.factors)
+        for offset, rep_index in enumerate(indexes):
+            factor = int(rep_factors[offsets[card_index] + offset])
+            factors[rep_index] = factor
+            revlog_factors.append((history.rep_ids[rep_index], factor))
+        new_histories.append(history._replace(factors=tuple(factors)))
+        card.factor = int(new_factors[card_index])
+        write_ease_custom_data(card, float(success_rates[card_index]))
+        # The stored state no longer matches the rewritten revlog factors
+        write_ease_state(config, card, None)
+    write_revlog_factors(revlog_factors)
+    # The cached histories have the old revlog factors
+    card_histories.clear()
+    return new_histories
 
 
 def adjust_ease(
@@ -339,14 +747,16 @@ def adjust_ease(
         mw.progress.finish()
         tooltip(f"{future.result()} in {time.time() - start_time:.2f} seconds")
 
-    fut = mw.taskman.run_in_background(
-        lambda: adjust_ease_factors_background(
+    run_job(
+        "adjust_ease",
+        lambda cids: adjust_ease_factors_background(
             did=did,
             recent=recent,
             marked_only=marked_only,
-            card_ids=card_ids,
+            card_ids=cids,
         ),
         on_done,
+        card_ids=card_ids if card_ids else None,
+        key=(did, recent, marked_only),
+        whole_collection=did is None and not recent and not marked_only and not card_ids,
     )
-
-    return fut
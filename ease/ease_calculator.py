@@ -1,4 +1,11 @@
 import math
+from typing import NamedTuple, Optional, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError:
+    # Anki doesn't bundle numpy, the batch functions fall back to plain python without it
+    np = None
 
 
 def moving_average(value_list, weight, init=None) -> float:
@@ -33,21 +40,28 @@ def calculate_ease(
     config: dict, deck_starting_ease: int, card_settings: dict, leashed: bool = True
 ) -> tuple[int, float]:
     """Return next ease factor based on config and card performance."""
-    leash = config.leash
+    current_ease_factor, success_rate, average_ease = moving_averages(
+        config, deck_starting_ease, card_settings["review_list"], card_settings["factor_list"]
+    )
+    return suggest_factor(
+        config, deck_starting_ease, current_ease_factor, success_rate, average_ease, leashed
+    )
+
+
+def moving_averages(
+    config, deck_starting_ease: int, review_list, factor_list
+) -> tuple[Optional[int], float, float]:
+    """
+    Return the current ease factor and the moving averages of the success rate and the ease
+    factor, which suggest_factor turns into the next ease factor.
+    """
     target = config.target_ratio
-    max_ease = config.max_ease
-    min_ease = config.min_ease
     weight = config.moving_average_weight
 
-    review_list = card_settings["review_list"]
-    factor_list = card_settings["factor_list"]
     valid_factor_list = [x for x in factor_list if x is not None] if factor_list else []
     current_ease_factor = None
     if len(valid_factor_list) > 0:
         current_ease_factor = valid_factor_list[-1]
-    # If value wasn't set or was set to zero for some reason, use starting ease
-    if not current_ease_factor:
-        current_ease_factor = deck_starting_ease
 
     # if no reviews, just assume we're on target
     if review_list is None or len(review_list) < 1:
@@ -55,6 +69,35 @@ def calculate_ease(
     else:
         success_rate = get_success_rate(review_list, weight, init=target)
 
+    if len(valid_factor_list) > 0:
+        average_ease = moving_average(valid_factor_list, weight)
+    else:
+        average_ease = deck_starting_ease
+
+    return current_ease_factor, success_rate, average_ease
+
+
+def suggest_factor(
+    config,
+    deck_starting_ease: int,
+    current_ease_factor,
+    success_rate: float,
+    average_ease: float,
+    leashed: bool = True,
+) -> tuple[int, float]:
+    """
+    Return next ease factor from the moving averages of the success rate and the ease factor.
+    This is the part of calculate_ease after the moving averages have been computed.
+    """
+    leash = config.leash
+    target = config.target_ratio
+    max_ease = config.max_ease
+    min_ease = config.min_ease
+
+    # If value wasn't set or was set to zero for some reason, use starting ease
+    if not current_ease_factor:
+        current_ease_factor = deck_starting_ease
+
     # Ebbinghaus formula
     if success_rate > 0.99:
         success_rate = 0.99  # ln(1) = 0; avoid divide by zero error
@@ -62,10 +105,6 @@ def calculate_ease(
         success_rate = 0.01
     delta_ratio = math.log(target) / math.log(success_rate)
 
-    if len(valid_factor_list) > 0:
-        average_ease = moving_average(valid_factor_list, weight)
-    else:
-        average_ease = deck_starting_ease
     suggested_factor = average_ease * delta_ratio
 
     # Prevent divide by zero
@@ -105,16 +144,488 @@ def calculate_ease(
     return min(max(int(round(suggested_factor)), min_ease), max_ease), success_rate
 
 
-def calculate_all(config_settings, card_settings) -> dict:
-    """Recalculate all ease factors based on config and answers."""
-    new_factor_list = [config_settings["starting_ease_factor"]]
-    print(new_factor_list)
-    for count in range(1, 1 + len(card_settings["review_list"])):
-        tmp_review_list = card_settings["review_list"][:count]
-        tmp_card_settings = {
-            "review_list": tmp_review_list,
-            "factor_list": new_factor_list,
-        }
-        new_factor_list.append(calculate_ease(config_settings, tmp_card_settings)[0])
-    card_settings["factor_list"] = new_factor_list
-    return card_settings
+def _map_exact(func, values):
+    # Apply a math function to every element in python, numpy's vectorized log and pow can be
+    # off by an ulp from libm, which would make the batch results differ from calculate_ease
+    return np.fromiter((func(value) for value in values.tolist()), np.float64, len(values))
+
+
+def suggest_factor_batch(
+    config,
+    deck_starting_ease,
+    current_ease_factor,
+    success_rate,
+    average_ease,
+    leashed: bool = True,
+    exact: bool = True,
+):
+    """
+    suggest_factor for many cards at once, taking arrays with one element per card.
+    :param exact: Compute the logs and powers element by element in python so the results are
+                  bit-identical to suggest_factor, instead of with numpy which is faster.
+    :return: The suggested factors as an int array and the clamped success rates.
+    """
+    leash = config.leash
+    target = config.target_ratio
+    max_ease = config.max_ease
+    min_ease = config.min_ease
+
+    deck_starting_ease = np.broadcast_to(
+        np.asarray(deck_starting_ease, dtype=np.int64), np.shape(success_rate)
+    )
+    current_ease_factor = np.asarray(current_ease_factor, dtype=np.int64)
+    # If value wasn't set or was set to zero for some reason, use starting ease
+    current_ease_factor = np.where(
+        current_ease_factor == 0, deck_starting_ease, current_ease_factor
+    )
+    success_rate = np.clip(np.asarray(success_rate, dtype=np.float64), 0.01, 0.99)
+    if exact:
+        log_success_rate = _map_exact(math.log, success_rate)
+    else:
+        log_success_rate = np.log(success_rate)
+    delta_ratio = math.log(target) / log_success_rate
+
+    suggested_factor = np.asarray(average_ease, dtype=np.float64) * delta_ratio
+    # Prevent divide by zero
+    unchanged = suggested_factor == 0
+    if leashed:
+        if exact:
+            cube_root = lambda values: _map_exact(lambda value: value ** (1 / 3), values)
+        else:
+            cube_root = lambda values: values ** (1 / 3)
+        # factor will increase
+        up_leash_multiplier = (
+            cube_root(max_ease / current_ease_factor)
+            * (1 - current_ease_factor / max_ease)
+            * (deck_starting_ease / current_ease_factor)
+        )
+        increase = suggested_factor > current_ease_factor
+        up_leash_multiplier[increase] *= cube_root(
+            suggested_factor[increase] / current_ease_factor[increase]
+        )
+
+        # factor will decrease
+        down_leash_multiplier = (current_ease_factor / min_ease - 1) * (
+            current_ease_factor / deck_starting_ease
+        )
+
+        ease_cap = np.minimum(max_ease, current_ease_factor + leash * up_leash_multiplier)
+        suggested_factor = np.where(suggested_factor > ease_cap, ease_cap, suggested_factor)
+        ease_floor = np.maximum(min_ease, current_ease_factor - leash * down_leash_multiplier)
+        suggested_factor = np.where(suggested_factor < ease_floor, ease_floor, suggested_factor)
+
+    # np.rint rounds halves to even like round()
+    new_factor = np.clip(np.rint(suggested_factor).astype(np.int64), min_ease, max_ease)
+    new_factor = np.where(unchanged, current_ease_factor, new_factor)
+    return new_factor, success_rate
+
+
+class EaseState:
+    """
+    The moving averages calculate_ease uses, carried forward one answer or factor at a time,
+    so that replaying a card's history is a single pass instead of recomputing every prefix.
+
+    The factor average of calculate_ease starts from the mean of the whole factor list, which
+    changes with every factor, so it's kept as the factor sum and count plus the weighted sum of
+    the factors: mean * (1 - weight) ** count + tail. This is the same value moving_average
+    computes, up to float rounding.
+    """
+
+    success_rate: float
+    review_count: int
+    factor_sum: int
+    factor_count: int
+    factor_tail: float
+    last_factor: Optional[int]
+
+    def __init__(self, target: float, weight: float) -> None:
+        self.weight = weight
+        self.success_rate = target
+        self.review_count = 0
+        self.factor_sum = 0
+        self.factor_count = 0
+        self.factor_tail = 0.0
+        self.last_factor = None
+
+    def add_review(self, ease: int):
+        self.success_rate = self.success_rate * (1 - self.weight)
+        self.success_rate += REV_SUCCESS_MAP[ease] * self.weight
+        self.review_count += 1
+
+    def add_factor(self, factor: Optional[int]):
+        if factor is None:
+            return
+        self.factor_sum += factor
+        self.factor_count += 1
+        self.factor_tail = self.factor_tail * (1 - self.weight)
+        self.factor_tail += factor * self.weight
+        self.last_factor = factor
+
+    def dump(self) -> list:
+        """The state as a compact list, to be stored in the card's custom data."""
+        return [
+            round(self.success_rate, 6),
+            self.factor_sum,
+            self.factor_count,
+            round(self.factor_tail, 2),
+            self.last_factor or 0,
+        ]
+
+    @classmethod
+    def load(cls, target: float, weight: float, values: Sequence) -> "EaseState":
+        """The state from a list made by dump."""
+        state = cls(target, weight)
+        state.success_rate, state.factor_sum, state.factor_count, state.factor_tail, last = values
+        state.last_factor = last or None
+        return state
+
+    def average_ease(self, deck_starting_ease: int) -> float:
+        if self.factor_count == 0:
+            return deck_starting_ease
+        mean = self.factor_sum / self.factor_count
+        return mean * (1 - self.weight) ** self.factor_count + self.factor_tail
+
+    def next_factor(self, config, deck_starting_ease: int, leashed: bool = True):
+        """Same as calculate_ease for the reviews and factors added so far."""
+        return suggest_factor(
+            config,
+            deck_starting_ease,
+            self.last_factor,
+            self.success_rate,
+            self.average_ease(deck_starting_ease),
+            leashed,
+        )
+
+
+def replay_ease(
+    config,
+    deck_starting_ease: int,
+    answers: Sequence[int],
+    is_review: Optional[Sequence[bool]] = None,
+    leashed: bool = True,
+) -> tuple[list[int], int, float]:
+    """
+    Replay a card's whole history for a deck adjustment in one pass.
+    Each rep gets the factor calculate_ease suggests from the reps before it, starting from the
+    deck's starting ease, and then the card gets the factor suggested from all of its reps.
+    :param answers: The ease of every rep of the card, oldest first.
+    :param is_review: Whether each rep is a review, only those are counted if config.reviews_only.
+    :return: The factor of every rep, the new factor of the card and its success rate.
+    """
+    weight = config.moving_average_weight
+    state = EaseState(config.target_ratio, weight)
+    state.add_factor(deck_starting_ease)
+    # The card's factor is suggested from the factors of the reps except the last one,
+    # which is tracked separately as it doesn't include the starting ease
+    card_state = EaseState(config.target_ratio, weight)
+
+    rep_factors = []
+    for i, ease in enumerate(answers):
+        factor, _ = state.next_factor(config, deck_starting_ease, leashed)
+        rep_factors.append(factor)
+        state.add_factor(factor)
+        if i > 0:
+            card_state.add_factor(rep_factors[i - 1])
+        if not config.reviews_only or (is_review is not None and is_review[i]):
+            state.add_review(ease)
+            card_state.add_review(ease)
+    if len(rep_factors) == 1:
+        card_state.add_factor(rep_factors[0])
+
+    new_factor, success_rate = card_state.next_factor(config, deck_starting_ease, leashed)
+    return rep_factors, new_factor, success_rate
+
+
+class EaseStateArrays:
+    """
+    EaseState for many cards at once, with each field kept in an array indexed by card.
+    The methods update or read the states of the given card indexes.
+    """
+
+    def __init__(self, target: float, weight: float, card_count: int, max_factor_count: int):
+        """
+        :param max_factor_count: The most factors any of the states will have.
+        """
+        self.weight = weight
+        self.success_rate = np.full(card_count, target, dtype=np.float64)
+        self.factor_sum = np.zeros(card_count, dtype=np.int64)
+        self.factor_count = np.zeros(card_count, dtype=np.int64)
+        self.factor_tail = np.zeros(card_count, dtype=np.float64)
+        self.last_factor = np.zeros(card_count, dtype=np.int64)
+        # (1 - weight) ** count for every count a state can reach, computed in python like
+        # EaseState.average_ease does
+        self.decay = np.array([(1 - weight) ** count for count in range(max_factor_count + 1)])
+
+    def add_review(self, cards, successes):
+        """:param successes: REV_SUCCESS_MAP of the answer of each card."""
+        self.success_rate[cards] = self.success_rate[cards] * (1 - self.weight)
+        self.success_rate[cards] += successes * self.weight
+
+    def add_factor(self, cards, factors):
+        self.factor_sum[cards] += factors
+        self.factor_count[cards] += 1
+        self.factor_tail[cards] = self.factor_tail[cards] * (1 - self.weight)
+        self.factor_tail[cards] += factors * self.weight
+        self.last_factor[cards] = factors
+
+    def average_ease(self, cards, deck_starting_ease):
+        counts = self.factor_count[cards]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.factor_sum[cards] / counts
+        return np.where(
+            counts > 0, mean * self.decay[counts] + self.factor_tail[cards], deck_starting_ease
+        )
+
+    def next_factor(self, config, cards, deck_starting_ease, leashed=True, exact=True):
+        """:param deck_starting_ease: The starting ease of each of the cards."""
+        return suggest_factor_batch(
+            config,
+            deck_starting_ease,
+            self.last_factor[cards],
+            self.success_rate[cards],
+            self.average_ease(cards, deck_starting_ease),
+            leashed,
+            exact,
+        )
+
+
+def _positions(lengths):
+    """
+    Yield each position and the indexes of the lists longer than it, for stepping through
+    ragged lists position by position. The longest lists come first, so that the lists still
+    going at each position are a prefix of the order.
+    """
+    order = np.argsort(-lengths, kind="stable")
+    sorted_lengths = lengths[order]
+    for position in range(int(sorted_lengths[0]) if len(order) > 0 else 0):
+        yield position, order[: np.searchsorted(-sorted_lengths, -position, side="left")]
+
+
+def replay_ease_batch(
+    config,
+    deck_starting_ease: Union[int, Sequence[int]],
+    answers: Sequence[int],
+    offsets: Sequence[int],
+    is_review: Optional[Sequence[bool]] = None,
+    leashed: bool = True,
+    exact: bool = True,
+):
+    """
+    replay_ease for many cards at once, stepping through the reps of all cards position by
+    position with the EaseState kept in arrays.
+    :param answers: The answers of the cards concatenated into one array.
+    :param offsets: Where each card's answers start, followed by len(answers).
+    :param is_review: Same layout as answers.
+    :param exact: See suggest_factor_batch.
+    :return: The factor of every rep, in the same layout as answers, and the new factor and
+             success rate of each card.
+    """
+    card_count = len(offsets) - 1
+    if np is None:
+        if isinstance(deck_starting_ease, int):
+            deck_starting_ease = [deck_starting_ease] * card_count
+        rep_factors = []
+        new_factors = []
+        success_rates = []
+        for i in range(card_count):
+            start, end = offsets[i], offsets[i + 1]
+            card_rep_factors, new_factor, success_rate = replay_ease(
+                config,
+                deck_starting_ease[i],
+                answers[start:end],
+                is_review[start:end] if is_review is not None else None,
+                leashed,
+            )
+            rep_factors.extend(card_rep_factors)
+            new_factors.append(new_factor)
+            success_rates.append(success_rate)
+        return rep_factors, new_factors, success_rates
+
+    weight = config.moving_average_weight
+    answers = np.asarray(answers, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    deck_starting_ease = np.broadcast_to(
+        np.asarray(deck_starting_ease, dtype=np.int64), card_count
+    )
+    counted = np.ones(len(answers), dtype=bool)
+    if config.reviews_only:
+        counted = np.asarray(is_review, dtype=bool) if is_review is not None else ~counted
+    success_map = np.array([REV_SUCCESS_MAP[ease] for ease in range(len(REV_SUCCESS_MAP))])
+    successes = success_map[answers]
+    max_length = int(lengths.max()) if card_count > 0 else 0
+
+    cards = np.arange(card_count)
+    # The state of the reps, which starts with the starting ease as its first factor
+    state = EaseStateArrays(config.target_ratio, weight, card_count, max_length + 1)
+    state.add_factor(cards, deck_starting_ease)
+    # The state of the card, with the factors of all reps except the last one
+    card_state = EaseStateArrays(config.target_ratio, weight, card_count, max_length + 1)
+
+    rep_factors = np.zeros(len(answers), dtype=np.int64)
+    for position, active in _positions(lengths):
+        factors, _ = state.next_factor(
+            config, active, deck_starting_ease[active], leashed, exact
+        )
+        rep_factors[starts[active] + position] = factors
+        state.add_factor(active, factors)
+        if position > 0:
+            card_state.add_factor(active, rep_factors[starts[active] + position - 1])
+        reviewed = active[counted[starts[active] + position]]
+        state.add_review(reviewed, successes[starts[reviewed] + position])
+        card_state.add_review(reviewed, successes[starts[reviewed] + position])
+
+    single = np.nonzero(lengths == 1)[0]
+    card_state.add_factor(single, rep_factors[starts[single]])
+    new_factors, success_rates = card_state.next_factor(
+        config, cards, deck_starting_ease, leashed, exact
+    )
+    return rep_factors, new_factors, success_rates
+
+
+class EaseParams(NamedTuple):
+    """
+    The config values the ease calculation depends on. Can be passed in place of the config to
+    calculate factors with other values than the configured ones.
+    """
+
+    target_ratio: float
+    moving_average_weight: float
+    leash: int
+    min_ease: int
+    max_ease: int
+    reviews_only: bool
+
+    @classmethod
+    def from_config(cls, config) -> "EaseParams":
+        return cls(
+            config.target_ratio,
+            config.moving_average_weight,
+            config.leash,
+            config.min_ease,
+            config.max_ease,
+            config.reviews_only,
+        )
+
+
+def ease_log_losses(
+    params_list: Sequence[EaseParams],
+    deck_starting_ease,
+    answers,
+    offsets,
+    is_review,
+    scored_reps,
+    scaled_elapsed,
+    passed,
+) -> list[float]:
+    """
+    Score ease params by how well the factors they give predict whether reviews were passed.
+    The history is replayed with each params, and a review is predicted to pass with
+    probability target_ratio ** (elapsed days / interval), where the interval is the one the
+    replayed factor would have given on the previous review answered good. That is, retention
+    reaches target_ratio on the day the card would have been due.
+    Needs numpy.
+    :param deck_starting_ease, answers, offsets, is_review: As for replay_ease_batch.
+    :param scored_reps: For each scored review, the index in answers of the previous rep.
+    :param scaled_elapsed: For each scored review, the days elapsed since the previous rep
+                           divided by the interval before the previous rep, so that the
+                           interval given on the previous rep was factor / 1000 of it.
+    :param passed: For each scored review, whether it was passed.
+    :return: The mean log loss of each params, lower is better.
+    """
+    passed = np.asarray(passed, dtype=bool)
+    losses = []
+    for params in params_list:
+        rep_factors, _, _ = replay_ease_batch(
+            params, deck_starting_ease, answers, offsets, is_review, exact=False
+        )
+        interval_ratio = scaled_elapsed * 1000 / rep_factors[scored_reps]
+        pass_probability = np.clip(params.target_ratio**interval_ratio, 1e-6, 1 - 1e-6)
+        log_likelihood = np.where(passed, np.log(pass_probability), np.log1p(-pass_probability))
+        losses.append(float(-log_likelihood.mean()) if len(passed) > 0 else math.nan)
+    return losses
+
+
+def calculate_all(
+    config, deck_starting_ease: int, review_list: Sequence[int], leashed: bool = True
+) -> list[int]:
+    """
+    Simulate the factor of a card through its answers, in one pass.
+    The card starts with the starting ease, and after each answer gets the factor
+    calculate_ease suggests from the answers so far and the factors it had before.
+    :param review_list: The answers, oldest first. All are counted, filter them beforehand
+                        for config.reviews_only.
+    :return: The factors of the card, the starting ease followed by the factor after each answer.
+    """
+    state = EaseState(config.target_ratio, config.moving_average_weight)
+    state.add_factor(deck_starting_ease)
+    factor_list = [deck_starting_ease]
+    for ease in review_list:
+        state.add_review(ease)
+        factor, _ = state.next_factor(config, deck_starting_ease, leashed)
+        state.add_factor(factor)
+        factor_list.append(factor)
+    return factor_list
+
+
+def calculate_all_batch(
+    config,
+    deck_starting_ease: Union[int, Sequence[int]],
+    answers: Sequence[int],
+    offsets: Sequence[int],
+    leashed: bool = True,
+    exact: bool = True,
+):
+    """
+    calculate_all for many answer lists at once, such as real card histories or synthetic ones
+    for comparing ease settings.
+    :param answers: The answer lists concatenated into one array.
+    :param offsets: Where each list starts in answers, followed by len(answers).
+    :param exact: See suggest_factor_batch.
+    :return: The factor lists concatenated, and where each starts followed by the total length.
+             As each factor list is one longer than its answer list, list i starts at
+             offsets[i] + i.
+    """
+    card_count = len(offsets) - 1
+    if np is None:
+        if isinstance(deck_starting_ease, int):
+            deck_starting_ease = [deck_starting_ease] * card_count
+        factors = []
+        factor_offsets = [0]
+        for i in range(card_count):
+            factors.extend(
+                calculate_all(
+                    config, deck_starting_ease[i], answers[offsets[i] : offsets[i + 1]], leashed
+                )
+            )
+            factor_offsets.append(len(factors))
+        return factors, factor_offsets
+
+    answers = np.asarray(answers, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    deck_starting_ease = np.broadcast_to(
+        np.asarray(deck_starting_ease, dtype=np.int64), card_count
+    )
+    success_map = np.array([REV_SUCCESS_MAP[ease] for ease in range(len(REV_SUCCESS_MAP))])
+    successes = success_map[answers]
+    max_length = int(lengths.max()) if card_count > 0 else 0
+
+    factor_offsets = offsets + np.arange(card_count + 1)
+    factors = np.zeros(factor_offsets[-1], dtype=np.int64)
+    factors[factor_offsets[:-1]] = deck_starting_ease
+
+    state = EaseStateArrays(
+        config.target_ratio, config.moving_average_weight, card_count, max_length + 1
+    )
+    state.add_factor(np.arange(card_count), deck_starting_ease)
+    for position, active in _positions(lengths):
+        state.add_review(active, successes[starts[active] + position])
+        new_factors, _ = state.next_factor(
+            config, active, deck_starting_ease[active], leashed, exact
+        )
+        state.add_factor(active, new_factors)
+        factors[factor_offsets[active] + position + 1] = new_factors
+    return factors, factor_offsets
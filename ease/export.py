@@ -1,29 +1,74 @@
 from __future__ import annotations
 
+import csv
 import datetime
+import time
+from ast import literal_eval
+from typing import Iterable, Iterator
 
 # anki interfaces
+from anki.utils import ids2str
 from aqt import mw
-from aqt import gui_hooks
-from aqt.qt import QMessageBox
 from anki.lang import _
 
-from aqt.utils import getFile, getSaveFile
-from ast import literal_eval
+from aqt.utils import getFile, getSaveFile, showWarning, tooltip
+
+from ..job_queue import run_job
+from ..journal import journal_before_job
+from ..utils import BackgroundProgress
+
+# Number of cards read or written at a time when exporting and importing
+EXPORT_CHUNK_SIZE = 20000
+
+EXPORT_HEADER = ["card_id", "factor"]
+
+IMPORT_TABLE = "temp.csh_ease_import"
 
 
-def announce(announcement):
-    msg = QMessageBox(mw)
-    msg.setStandardButtons(QMessageBox.Ok)
-    msg.setText(_(announcement))
-    msg.exec_()
+def deck_cards_query(deck_id) -> str:
+    """Condition on cards for the cards of the deck and its subdecks, same as deck:"name"."""
+    dids = ids2str(mw.col.decks.deck_and_child_ids(deck_id))
+    return f"(did IN {dids} OR odid IN {dids})"
+
+
+def export_ease_factors_background(deck_id, export_file: str) -> str:
+    """
+    Write the card id and ease factor of each card of the deck as CSV, reading the cards a
+    chunk at a time by card id so that the whole deck is never in memory.
+    """
+    deck_query = deck_cards_query(deck_id)
+    total = mw.col.db.scalar(f"SELECT count() FROM cards WHERE {deck_query}")
+    progress = BackgroundProgress("Exporting ease factors", max=total)
+    cnt = 0
+    last_id = 0
+    with open(export_file, "w", newline="") as export_file_object:
+        writer = csv.writer(export_file_object)
+        writer.writerow(EXPORT_HEADER)
+        while not progress.cancelled:
+            rows = mw.col.db.all(f"""
+                SELECT id, factor
+                FROM cards
+                WHERE id > {last_id}
+                AND {deck_query}
+                ORDER BY id
+                LIMIT {EXPORT_CHUNK_SIZE}
+            """)
+            if len(rows) == 0:
+                break
+            last_id = rows[-1][0]
+            writer.writerows(rows)
+            cnt += len(rows)
+            progress.update(value=cnt, label=f"{cnt}/{total} ease factors exported")
+    if progress.cancelled:
+        return f"Export cancelled after {cnt} ease factors"
+    return f"Exported {cnt} ease factors"
 
 
 def export_ease_factors(deck_id):
     """Saves a deck's ease factors using file picker.
 
-    For some deck `deck_id`, prompts to save a file containing a
-    dictionary that links card id keys to ease factors.
+    For some deck `deck_id`, prompts to save a CSV file with the card id and ease factor of
+    each card of the deck.
     """
     deck_name = mw.col.decks.name_if_exists(deck_id)
     if deck_name is None:
@@ -33,19 +78,107 @@ def export_ease_factors(deck_id):
     dt_now_str = str(datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
     suggested_filename = "ease_factors_" + str(deck_id) + dt_now_str
     export_file = getSaveFile(
-        mw, _("Export"), "export", key="", ext="", fname=suggested_filename
+        mw, _("Export"), "export", key="", ext=".csv", fname=suggested_filename
     )
     if not export_file:
         return
 
-    factors = {}
-    card_ids = mw.col.find_cards(f'deck:"{deck_name}"')
-    for card_id in card_ids:
-        card = mw.col.getCard(card_id)
-        factors[card_id] = card.factor
-    with open(export_file, "w") as export_file_object:
-        export_file_object.write(str(factors))
-    announce("Export complete!")
+    start_time = time.time()
+
+    def on_done(future):
+        mw.progress.finish()
+        tooltip(f"{future.result()} in {time.time() - start_time:.2f} seconds")
+
+    return mw.taskman.run_in_background(
+        lambda: export_ease_factors_background(deck_id, export_file), on_done
+    )
+
+
+def read_ease_factors(import_file: str) -> Iterator[tuple[int, int]]:
+    """
+    The (card id, factor) pairs of a file saved by export_ease_factors, read row by row.
+    Files saved as a dictionary by older versions are read whole.
+    :raises ValueError: If a row isn't a card id and a factor.
+    """
+    with open(import_file, "r", newline="") as import_file_object:
+        first_line = import_file_object.readline()
+        if first_line.startswith("{"):
+            factors = literal_eval(first_line + import_file_object.read())
+            yield from ((int(card_id), int(factor)) for card_id, factor in factors.items())
+            return
+        if first_line.strip() != ",".join(EXPORT_HEADER):
+            raise ValueError(f"Not an ease factor export, the first line is {first_line!r}")
+        for row in csv.reader(import_file_object):
+            if len(row) == 0:
+                continue
+            if len(row) != 2:
+                raise ValueError(f"Expected a card id and a factor, got {row!r}")
+            yield int(row[0]), int(row[1])
+
+
+def chunks(items: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def import_ease_factors_background(deck_id, factors: Iterable[tuple[int, int]]) -> str:
+    """
+    Load the factors into a temp table and set them on the cards of the deck that have a
+    different factor, found with a join on it, under a single undo entry. Cards of the deck that
+    aren't in the factors keep their factor.
+    """
+    progress = BackgroundProgress("Reading ease factors")
+    mw.col.db.execute(f"DROP TABLE IF EXISTS {IMPORT_TABLE}")
+    mw.col.db.execute(f"CREATE TABLE {IMPORT_TABLE} (id INTEGER PRIMARY KEY, factor INTEGER)")
+    try:
+        read = 0
+        for chunk in chunks(factors, EXPORT_CHUNK_SIZE):
+            mw.col.db.executemany(
+                f"INSERT OR REPLACE INTO {IMPORT_TABLE} (id, factor) VALUES (?, ?)", chunk
+            )
+            read += len(chunk)
+            progress.update(value=0, label=f"{read} ease factors read")
+            if progress.cancelled:
+                return "Import cancelled, no ease factors were changed"
+
+        matched = mw.col.db.scalar(f"""
+            SELECT count()
+            FROM cards
+            JOIN {IMPORT_TABLE} AS imported ON imported.id = cards.id
+            WHERE {deck_cards_query(deck_id)}
+        """)
+        # Only the cards whose factor changes are loaded and written
+        changed = mw.col.db.all(f"""
+            SELECT cards.id, imported.factor
+            FROM cards
+            JOIN {IMPORT_TABLE} AS imported ON imported.id = cards.id
+            WHERE {deck_cards_query(deck_id)}
+            AND cards.factor != imported.factor
+        """)
+    finally:
+        mw.col.db.execute(f"DROP TABLE IF EXISTS {IMPORT_TABLE}")
+
+    journal_before_job("Import ease factors", [cid for cid, _ in changed])
+    progress.max = len(changed)
+    undo_entry = mw.col.add_custom_undo_entry("Import ease factors")
+    cnt = 0
+    for chunk in chunks(changed, EXPORT_CHUNK_SIZE):
+        cards = []
+        for cid, factor in chunk:
+            card = mw.col.get_card(cid)
+            card.factor = factor
+            cards.append(card)
+        mw.col.update_cards(cards)
+        mw.col.merge_undo_entries(undo_entry)
+        cnt += len(cards)
+        progress.update(value=cnt, label=f"{cnt}/{len(changed)} ease factors imported")
+    return f"Imported ease factors, {cnt} cards changed, {matched - cnt} unchanged"
 
 
 def import_ease_factors(deck_id, factors=None):
@@ -66,15 +199,28 @@ def import_ease_factors(deck_id, factors=None):
     if factors is None:
         # open file picker to load factors
         import_file = getFile(mw, _("Import"), None, filter="*", key="import")
-        if import_file == []:
+        if not import_file:
             # no file selected
             return
-        with open(import_file, "r") as import_file_object:
-            factors = literal_eval(import_file_object.read())
-
-    card_ids = mw.col.find_cards(f'deck:"{deck_name}"')
-    for card_id in card_ids:
-        card = mw.col.getCard(card_id)
-        card.factor = factors.get(card_id, card.factor)
-        card.flush()
-    announce("Import complete!")
+        factor_pairs = read_ease_factors(import_file)
+    else:
+        factor_pairs = factors.items()
+
+    start_time = time.time()
+
+    def on_done(future):
+        mw.progress.finish()
+        try:
+            result = future.result()
+        except (OSError, ValueError, SyntaxError) as err:
+            showWarning(f"Ease factors could not be imported: {err}")
+            return
+        tooltip(f"{result} in {time.time() - start_time:.2f} seconds")
+        mw.reset()
+
+    run_job(
+        "import_ease_factors",
+        lambda _: import_ease_factors_background(deck_id, factor_pairs),
+        on_done,
+        key=None,
+    )
@@ -0,0 +1,345 @@
+import itertools
+import multiprocessing
+import os
+import runpy
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, Optional
+
+from anki.consts import REVLOG_LRN, REVLOG_REV, REVLOG_RELRN, REVLOG_CRAM
+from anki.utils import ids2str
+from aqt import mw
+from aqt.utils import showText, showWarning, tooltip
+
+from ..configuration import config
+from ..utils import BackgroundProgress
+from . import ease_calculator
+from .ease_calculator import EaseParams
+
+try:
+    import numpy as np
+except ImportError:
+    # Anki doesn't bundle numpy, the optimizer isn't available without it
+    np = None
+
+# The values tried for each searched parameter, every combination of them is scored
+TARGET_RATIOS = (0.75, 0.8, 0.825, 0.85, 0.875, 0.9, 0.925, 0.95)
+LEASHES = (50, 100, 150, 200, 300)
+MOVING_AVERAGE_WEIGHTS = (0.1, 0.15, 0.2, 0.25, 0.3)
+
+# Presets with fewer scored reviews don't get a recommendation
+MIN_SCORED_REVIEWS = 100
+
+# Number of batches each preset's candidates are scored in without worker processes, so that
+# progress is reported and cancelling is checked while a preset is scored
+IN_PROCESS_BATCHES = 8
+
+EASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Run in each worker process with runpy.run_path before the tasks are unpickled, under this run
+# name so that it registers the packages, see worker_setup.py
+WORKER_SETUP_PATH = os.path.join(EASE_DIR, "worker_setup.py")
+WORKER_SETUP_RUN_NAME = "__csh_worker_setup__"
+
+NUMPY_MISSING_MSG = (
+    "Recommending ease params needs numpy, which Anki doesn't include."
+    " Install numpy for the Python that runs Anki, for example with pip when Anki is installed"
+    " with pip, and restart Anki."
+)
+
+
+class PresetHistories(NamedTuple):
+    """
+    The revlog of the cards of a deck preset packed into arrays for ease_log_losses.
+    Only numpy arrays and plain values, so that it can be sent to a worker process.
+    """
+
+    name: str
+    review_count: int
+    deck_starting_ease: int
+    answers: "np.ndarray"
+    offsets: "np.ndarray"
+    is_review: "np.ndarray"
+    scored_reps: "np.ndarray"
+    scaled_elapsed: "np.ndarray"
+    passed: "np.ndarray"
+
+
+class PresetResult(NamedTuple):
+    name: str
+    review_count: int
+    current: EaseParams
+    current_loss: float
+    best: EaseParams
+    best_loss: float
+
+
+def worker_setup_globals() -> dict:
+    """The init_globals worker_setup.py is run with, the add-on package and its ease package."""
+    ease_package = __name__.rsplit(".", 1)[0]
+    addon_package = ease_package.rsplit(".", 1)[0]
+    return {
+        "PACKAGES": [(addon_package, os.path.dirname(EASE_DIR)), (ease_package, EASE_DIR)]
+    }
+
+
+def worker_executable() -> Optional[str]:
+    """
+    The Python interpreter to spawn worker processes with, or None if there isn't one.
+    When Anki is run by a Python interpreter, like when it's installed with pip, that's
+    sys.executable. Anki builds whose sys.executable is the Anki program, which would start
+    another Anki instead of a worker, can still have the interpreter of their Python
+    environment next to it, like the builds installed by the launcher. Frozen builds have none.
+    """
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    if getattr(sys, "frozen", False):
+        return None
+    for candidate in (
+        os.path.join(sys.exec_prefix, "bin", "python3"),
+        os.path.join(sys.exec_prefix, "Scripts", "python.exe"),
+        os.path.join(sys.exec_prefix, "python.exe"),
+    ):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def load_preset_histories(did=None) -> list[PresetHistories]:
+    """
+    Read the revlog of every card, or of the cards of the deck and its subdecks, grouped by the
+    deck preset of the card. Only reads.
+    """
+    presets = {}
+    deck_presets = {}
+    card_presets = {}
+    deck_query = ""
+    revlog_deck_query = ""
+    if did is not None:
+        dids = ids2str(mw.col.decks.deck_and_child_ids(did))
+        deck_query = f"WHERE did IN {dids} OR odid IN {dids}"
+        revlog_deck_query = f"AND cid IN (SELECT id FROM cards {deck_query})"
+    for cid, card_did, odid in mw.col.db.execute(f"SELECT id, did, odid FROM cards {deck_query}"):
+        deck_id = odid if odid else card_did
+        if deck_id not in deck_presets:
+            deck_config = mw.col.decks.config_dict_for_deck_id(deck_id)
+            presets.setdefault(
+                deck_config["id"],
+                (deck_config["name"], deck_config["new"].get("initialFactor", 2500)),
+            )
+            deck_presets[deck_id] = deck_config["id"]
+        card_presets[cid] = deck_presets[deck_id]
+
+    revlog = np.array(
+        mw.col.db.all(f"""
+            SELECT
+                cid,
+                id,
+                ease,
+                type,
+                lastIvl
+            FROM revlog
+            WHERE type IN ({REVLOG_LRN}, {REVLOG_REV}, {REVLOG_RELRN}, {REVLOG_CRAM})
+            {revlog_deck_query}
+            ORDER BY cid, id
+        """),
+        dtype=np.int64,
+    ).reshape(-1, 5)
+    cids, rep_ids, answers, types, last_ivls = revlog.T
+
+    # A review is scored against the previous rep of the card if that was a review answered
+    # good, as then its interval was the interval before it times the factor
+    scored_reps = np.nonzero(
+        (cids[1:] == cids[:-1])
+        & (types[1:] == REVLOG_REV)
+        & (types[:-1] == REVLOG_REV)
+        & (answers[:-1] == 3)
+        & (last_ivls[:-1] > 0)
+    )[0]
+    scaled_elapsed = (
+        (rep_ids[scored_reps + 1] - rep_ids[scored_reps]) / 86400000 / last_ivls[scored_reps]
+    )
+    passed = answers[scored_reps + 1] > 1
+
+    card_ids, card_starts = np.unique(cids, return_index=True)
+    card_lengths = np.diff(np.append(card_starts, len(cids)))
+    card_preset_ids = np.array([card_presets.get(int(cid), -1) for cid in card_ids])
+    rep_preset_ids = np.repeat(card_preset_ids, card_lengths)
+
+    histories = []
+    for preset_id, (name, starting_ease) in presets.items():
+        in_preset = rep_preset_ids == preset_id
+        if not in_preset.any():
+            continue
+        # Index of each rep among the reps of the preset
+        preset_index = np.cumsum(in_preset) - 1
+        scored_in_preset = in_preset[scored_reps]
+        histories.append(
+            PresetHistories(
+                name=name,
+                review_count=int(scored_in_preset.sum()),
+                deck_starting_ease=starting_ease,
+                answers=answers[in_preset],
+                offsets=np.append(0, np.cumsum(card_lengths[card_preset_ids == preset_id])),
+                is_review=types[in_preset] == REVLOG_REV,
+                scored_reps=preset_index[scored_reps[scored_in_preset]],
+                scaled_elapsed=scaled_elapsed[scored_in_preset],
+                passed=passed[scored_in_preset],
+            )
+        )
+    return histories
+
+
+def optimize_ease_params(
+    histories: list[PresetHistories],
+    current: EaseParams,
+    progress: BackgroundProgress,
+) -> Optional[list[PresetResult]]:
+    """
+    Score every combination of the searched parameter values for each preset and pick the one
+    with the lowest log loss. The other parameters are kept at their current values.
+    The scoring runs in this process, or in the number of worker processes set by
+    ease_optimizer_workers when they can be started.
+    :return: The results of the presets with enough reviews, or None if cancelled.
+    """
+    candidates = [current] + [
+        current._replace(target_ratio=target, leash=leash, moving_average_weight=weight)
+        for target, leash, weight in itertools.product(
+            TARGET_RATIOS, LEASHES, MOVING_AVERAGE_WEIGHTS
+        )
+    ]
+    histories = [h for h in histories if h.review_count >= MIN_SCORED_REVIEWS]
+    executable = worker_executable() if config.ease_optimizer_workers > 0 else None
+    workers = config.ease_optimizer_workers if executable is not None else 0
+    # Split the candidates so that each worker gets a share of every preset
+    chunk_size = -(-len(candidates) // (workers if workers > 0 else IN_PROCESS_BATCHES))
+    tasks = [
+        (preset_index, start)
+        for preset_index in range(len(histories))
+        for start in range(0, len(candidates), chunk_size)
+    ]
+    losses = [[None] * len(candidates) for _ in histories]
+    progress.max = len(tasks)
+
+    def task_args(preset_index, start):
+        h = histories[preset_index]
+        return (
+            candidates[start : start + chunk_size],
+            h.deck_starting_ease,
+            h.answers,
+            h.offsets,
+            h.is_review,
+            h.scored_reps,
+            h.scaled_elapsed,
+            h.passed,
+        )
+
+    def report(done):
+        progress.update(value=done, label=f"Scored {done}/{len(tasks)} batches of ease params")
+
+    done = 0
+    if workers > 0:
+        try:
+            context = multiprocessing.get_context("spawn")
+            if executable != sys.executable:
+                context.set_executable(executable)
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=runpy.run_path,
+                initargs=(WORKER_SETUP_PATH, worker_setup_globals(), WORKER_SETUP_RUN_NAME),
+            ) as executor:
+                futures = {
+                    executor.submit(ease_calculator.ease_log_losses, *task_args(*task)): task
+                    for task in tasks
+                }
+                for future in as_completed(futures):
+                    preset_index, start = futures[future]
+                    result = future.result()
+                    losses[preset_index][start : start + len(result)] = result
+                    done += 1
+                    report(done)
+                    if progress.cancelled:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        return None
+        except (OSError, BrokenProcessPool) as err:
+            # Score the rest in this process if the workers can't be started after all
+            print(f"Custom Schedule Helper: scoring ease params without worker processes: {err}")
+
+    for preset_index, start in tasks:
+        if losses[preset_index][start] is not None:
+            continue
+        result = ease_calculator.ease_log_losses(*task_args(preset_index, start))
+        losses[preset_index][start : start + len(result)] = result
+        done += 1
+        report(done)
+        if progress.cancelled:
+            return None
+
+    results = []
+    for h, preset_losses in zip(histories, losses):
+        best_index = min(range(len(candidates)), key=lambda i: preset_losses[i])
+        results.append(
+            PresetResult(
+                h.name,
+                h.review_count,
+                current,
+                preset_losses[0],
+                candidates[best_index],
+                preset_losses[best_index],
+            )
+        )
+    return results
+
+
+def format_results(results: list[PresetResult]) -> str:
+    def describe(params: EaseParams) -> str:
+        return (
+            f"target_ratio {params.target_ratio}, leash {params.leash},"
+            f" moving_average_weight {params.moving_average_weight}"
+        )
+
+    if len(results) == 0:
+        return f"No deck preset has at least {MIN_SCORED_REVIEWS} reviews to score ease params."
+    lines = [
+        "Ease params that best predict whether reviews were passed, by deck preset.",
+        "Lower log loss is better. The config applies to all presets,"
+        " so pick the values of the presets you review most.",
+        "",
+    ]
+    for result in results:
+        lines.append(f"{result.name} ({result.review_count} reviews scored)")
+        lines.append(f"  current: {describe(result.current)}, log loss {result.current_loss:.4f}")
+        lines.append(f"  recommended: {describe(result.best)}, log loss {result.best_loss:.4f}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def optimize_ease(did=None):
+    """
+    Recommend ease params for each deck preset, from the reviews of all cards or of the cards
+    of the deck and its subdecks. Only reads the collection.
+    """
+    if np is None:
+        showWarning(NUMPY_MISSING_MSG, title="Ease params")
+        return
+    current = EaseParams.from_config(config)
+    start_time = time.time()
+
+    def optimize_background():
+        progress = BackgroundProgress("Reading revlog")
+        histories = load_preset_histories(did)
+        return optimize_ease_params(histories, current, progress)
+
+    def on_done(future):
+        mw.progress.finish()
+        results = future.result()
+        if results is None:
+            tooltip("Optimizing ease params cancelled")
+            return
+        tooltip(f"Optimized ease params in {time.time() - start_time:.2f} seconds")
+        showText(format_results(results), title="Ease params")
+
+    return mw.taskman.run_in_background(optimize_background, on_done)
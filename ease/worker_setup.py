@@ -0,0 +1,23 @@
+"""
+Run in each worker process of the ease optimizer with runpy.run_path, before the tasks are
+unpickled, with the packages to register in PACKAGES. The add-on package and its ease package
+are registered as bare packages, so that ease_calculator is imported under its name in the
+add-on without running their __init__, which imports aqt. The add-on itself doesn't import
+this module.
+"""
+
+import sys
+import types
+
+
+def register_packages(packages: list[tuple[str, str]]):
+    """:param packages: The name and directory of each package."""
+    for name, path in packages:
+        package = types.ModuleType(name)
+        package.__path__ = [path]
+        sys.modules[name] = package
+
+
+# The WORKER_SETUP_RUN_NAME of optimizer.py
+if __name__ == "__csh_worker_setup__":
+    register_packages(PACKAGES)  # noqa: F821, given in the init_globals of run_path
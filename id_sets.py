@@ -0,0 +1,42 @@
+import itertools
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+from anki.utils import ids2str
+from aqt import mw
+
+# Id sets up to this size are inlined into the SQL with ids2str, bigger ones are loaded into a
+# temp table so the SQL stays short
+INLINE_IDS_LIMIT = 1000
+
+# Number of ids inserted into the temp table with one executemany
+ID_SET_CHUNK_SIZE = 10000
+
+# Each id set gets its own table, so that they can be nested or used from several jobs
+_table_numbers = itertools.count()
+
+
+@contextmanager
+def id_set(ids: Iterable[int]) -> Iterator[str]:
+    """
+    SQL for a set of ids, to use after IN, like ids2str but without building a huge SQL string
+    for big sets. Sets bigger than INLINE_IDS_LIMIT are loaded into a temp table of the
+    collection's connection, which is dropped when the context exits, and selected from it.
+    The queries using the SQL must run inside the context.
+    """
+    ids = ids if isinstance(ids, (list, tuple, set, frozenset)) else list(ids)
+    if len(ids) <= INLINE_IDS_LIMIT:
+        yield ids2str(ids)
+        return
+    table = f"temp.csh_ids_{next(_table_numbers)}"
+    mw.col.db.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY)")
+    try:
+        id_list = list(ids)
+        for start in range(0, len(id_list), ID_SET_CHUNK_SIZE):
+            mw.col.db.executemany(
+                f"INSERT OR IGNORE INTO {table} (id) VALUES (?)",
+                [(int(id_),) for id_ in id_list[start : start + ID_SET_CHUNK_SIZE]],
+            )
+        yield f"(SELECT id FROM {table})"
+    finally:
+        mw.col.db.execute(f"DROP TABLE IF EXISTS {table}")
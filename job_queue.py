@@ -0,0 +1,104 @@
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+from aqt import mw
+
+
+class Job:
+    """
+    A background job that changes the collection, run through the job queue.
+    Jobs waiting in the queue are merged with the jobs of the same kind queued after them:
+    - A job over the whole collection replaces the waiting jobs of its kind.
+    - A job of a kind with a waiting whole collection job is dropped, as that job covers it.
+    - Jobs with the same kind and key over sets of cards are merged into one job over the union
+      of their cards. A job with the key but no card set covers all the cards of the key.
+    - Jobs with the key None are never merged.
+    A merged job runs once with the task and on_done of the job that was queued first, or of
+    the job that replaced it.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        task: Callable[[Optional[set[int]]], Any],
+        on_done: Callable[[Future], None],
+        card_ids: Optional[Iterable[int]] = None,
+        key: Hashable = (),
+        whole_collection: bool = False,
+    ) -> None:
+        """
+        :param task: Runs in the background, with the ids of the cards to work on, or None for
+                     all the cards of the job.
+        :param on_done: Runs on the main thread with the future of the task, as with
+                        mw.taskman.run_in_background.
+        :param card_ids: The cards the job works on, or None for all cards of its key.
+        :param key: The parameters jobs of the kind must share to be merged, like the deck,
+                    or None if the job is never merged.
+        :param whole_collection: Whether the job works on every card the kind can work on.
+        """
+        self.kind = kind
+        self.task = task
+        self.on_done = on_done
+        self.card_ids = set(card_ids) if card_ids is not None else None
+        self.key = key
+        self.whole_collection = whole_collection
+
+    def covers(self, job: "Job") -> bool:
+        return self.kind == job.kind and (
+            self.whole_collection
+            or (self.key is not None and self.key == job.key and self.card_ids is None)
+        )
+
+
+class JobQueue:
+    """
+    Runs the collection changing jobs of the add-on one at a time, so that jobs started while
+    another is running, like after two quick syncs or a manual reschedule during the automatic
+    one after a sync, don't work on the same cards at the same time.
+    Only used from the main thread, where the jobs are queued and their on_done runs.
+    """
+
+    def __init__(self) -> None:
+        self.pending: list[Job] = []
+        self.running: Optional[Job] = None
+
+    def add(self, job: Job):
+        if any(pending.covers(job) for pending in self.pending):
+            return
+        # Queued jobs the new one covers are stale
+        self.pending = [pending for pending in self.pending if not job.covers(pending)]
+        for pending in self.pending:
+            if pending.kind == job.kind and job.key is not None and pending.key == job.key:
+                pending.card_ids |= job.card_ids
+                return
+        self.pending.append(job)
+        self._run_next()
+
+    def _run_next(self):
+        if self.running is not None or len(self.pending) == 0:
+            return
+        job = self.running = self.pending.pop(0)
+
+        def on_done(future: Future):
+            try:
+                job.on_done(future)
+            finally:
+                self.running = None
+                self._run_next()
+
+        mw.taskman.run_in_background(lambda: job.task(job.card_ids), on_done)
+
+
+job_queue = JobQueue()
+
+
+def run_job(
+    kind: str,
+    task: Callable[[Optional[set[int]]], Any],
+    on_done: Callable[[Future], None],
+    card_ids: Optional[Iterable[int]] = None,
+    key: Hashable = (),
+    whole_collection: bool = False,
+):
+    """Queue a job on the add-on's job queue, see Job for the parameters."""
+    job_queue.add(Job(kind, task, on_done, card_ids, key, whole_collection))
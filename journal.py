@@ -0,0 +1,319 @@
+import csv
+import gzip
+import json
+import os
+import re
+import time
+from typing import Iterable, Optional
+
+from anki.utils import ids2str, int_time
+from aqt import mw
+from aqt.utils import askUser, getFile, showWarning, tooltip
+
+from .card_history import card_histories
+from .job_queue import run_job
+
+# Journals are kept in user_files, which Anki keeps when the add-on is updated, in a folder for
+# each profile, as the add-on is shared by the profiles
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "user_files", "journals")
+# Subfolder of a profile's journals for the ones of jobs that run on their own, like after a
+# sync, which are pruned separately so that they don't push out the journals of the commands
+AUTOMATIC_JOURNAL_DIR = "automatic"
+JOURNAL_EXT = ".csv.gz"
+JOURNAL_VERSION = 1
+
+# Number of cards read or restored at a time
+JOURNAL_CHUNK_SIZE = 20000
+
+# Only the newest journals of each folder are kept, and none older than the number of days
+JOURNAL_KEEP_COUNT = 20
+JOURNAL_KEEP_DAYS = 30
+
+# The first column of a row tells what it's the old state of
+CARD_ROW = "c"
+REVLOG_ROW = "r"
+
+JOURNAL_CARDS_TABLE = "temp.csh_journal_cards"
+JOURNAL_REVLOG_TABLE = "temp.csh_journal_revlog"
+
+
+def journal_dir(automatic: bool = False) -> str:
+    """The journal folder of the current profile, or its folder of automatic journals."""
+    path = os.path.join(JOURNAL_DIR, mw.pm.name)
+    return os.path.join(path, AUTOMATIC_JOURNAL_DIR) if automatic else path
+
+
+def _journal_path(directory: str, label: str, created: int) -> str:
+    name = time.strftime("%Y%m%d-%H%M%S", time.localtime(created))
+    name += "-" + re.sub(r"[^a-z0-9]+", "-", label.lower()).strip("-")
+    path = os.path.join(directory, name + JOURNAL_EXT)
+    number = 1
+    while os.path.exists(path):
+        number += 1
+        path = os.path.join(directory, f"{name}-{number}{JOURNAL_EXT}")
+    return path
+
+
+def _journal_card_rows(card_ids: Iterable[int], card_filter: Optional[str]):
+    """The journal's card rows, a chunk at a time."""
+    if card_filter is not None:
+        # Paged by id, so that the ids of all the cards aren't loaded at once
+        last_id = 0
+        while True:
+            rows = mw.col.db.all(f"""
+                SELECT id, due, odue, ivl, factor, data
+                FROM cards
+                WHERE id > {last_id}
+                AND {card_filter}
+                ORDER BY id
+                LIMIT {JOURNAL_CHUNK_SIZE}
+            """)
+            if len(rows) == 0:
+                return
+            last_id = rows[-1][0]
+            yield rows
+    card_ids = sorted(card_ids)
+    for start in range(0, len(card_ids), JOURNAL_CHUNK_SIZE):
+        chunk = ids2str(card_ids[start : start + JOURNAL_CHUNK_SIZE])
+        yield mw.col.db.all(
+            f"SELECT id, due, odue, ivl, factor, data FROM cards WHERE id IN {chunk}"
+        )
+
+
+def write_journal(
+    label: str,
+    card_ids: Iterable[int] = (),
+    revlog: bool = False,
+    card_filter: Optional[str] = None,
+    automatic: bool = False,
+) -> str:
+    """
+    Save the scheduling state of the cards before a bulk job changes them, so that it can be
+    restored with restore_journal. The due, odue, ivl, factor and data, which holds the custom
+    data, of each card are written as gzipped CSV rows, a chunk of cards at a time.
+    Old journals are pruned after writing, see prune_journals.
+    :param revlog: Also save the factors of the cards' revlog entries, for the ease adjustments
+                   that rewrite them.
+    :param card_filter: SQL condition on the cards table selecting the cards, instead of
+                        card_ids, for jobs going through more cards than they load at once.
+    :param automatic: Whether the job runs on its own instead of as a command, see
+                      AUTOMATIC_JOURNAL_DIR.
+    :return: The path of the journal.
+    """
+    directory = journal_dir(automatic)
+    os.makedirs(directory, exist_ok=True)
+    created = int_time()
+    path = _journal_path(directory, label, created)
+    header = {
+        "version": JOURNAL_VERSION,
+        "label": label,
+        "created": created,
+        "profile": mw.pm.name,
+    }
+    # Written under a temporary name, so that a journal that was cut short isn't listed
+    partial_path = path + ".partial"
+    with gzip.open(partial_path, "wt", newline="", compresslevel=5) as journal_file:
+        journal_file.write(json.dumps(header) + "\n")
+        writer = csv.writer(journal_file)
+        for rows in _journal_card_rows(card_ids, card_filter):
+            writer.writerows([CARD_ROW] + row for row in rows)
+            if revlog:
+                chunk = ids2str(row[0] for row in rows)
+                writer.writerows(
+                    [REVLOG_ROW] + row
+                    for row in mw.col.db.all(
+                        f"SELECT id, factor FROM revlog WHERE cid IN {chunk}"
+                    )
+                )
+    os.replace(partial_path, path)
+    prune_journals(directory)
+    return path
+
+
+def journal_paths(directory: str) -> list[str]:
+    """The journals in the folder, newest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        (
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.endswith(JOURNAL_EXT)
+        ),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+
+
+def prune_journals(directory: str):
+    """
+    Delete the journals of the folder beyond the newest JOURNAL_KEEP_COUNT or older than
+    JOURNAL_KEEP_DAYS.
+    """
+    oldest_kept = time.time() - JOURNAL_KEEP_DAYS * 86400
+    for index, path in enumerate(journal_paths(directory)):
+        if index >= JOURNAL_KEEP_COUNT or os.path.getmtime(path) < oldest_kept:
+            os.remove(path)
+
+
+def read_journal_header(path: str) -> dict:
+    """
+    :raises ValueError: If the file isn't a journal of a version that can be restored, or it
+                        was saved in another profile.
+    """
+    with gzip.open(path, "rt", newline="") as journal_file:
+        try:
+            header = json.loads(journal_file.readline())
+        except (OSError, ValueError):
+            raise ValueError(f"{os.path.basename(path)} is not a schedule journal")
+    if not isinstance(header, dict) or header.get("version") != JOURNAL_VERSION:
+        raise ValueError(f"{os.path.basename(path)} is not a schedule journal")
+    if header.get("profile", mw.pm.name) != mw.pm.name:
+        raise ValueError(
+            f"{os.path.basename(path)} was saved in the profile {header['profile']},"
+            " switch to it to restore the journal"
+        )
+    return header
+
+
+def _load_journal(path: str):
+    """Load the rows of the journal into the temp tables, a chunk at a time."""
+    mw.col.db.execute(f"""
+        CREATE TABLE {JOURNAL_CARDS_TABLE} (
+            id INTEGER PRIMARY KEY,
+            due INTEGER,
+            odue INTEGER,
+            ivl INTEGER,
+            factor INTEGER,
+            data TEXT
+        )
+    """)
+    mw.col.db.execute(
+        f"CREATE TABLE {JOURNAL_REVLOG_TABLE} (id INTEGER PRIMARY KEY, factor INTEGER)"
+    )
+    with gzip.open(path, "rt", newline="") as journal_file:
+        journal_file.readline()
+        card_rows = []
+        revlog_rows = []
+
+        def flush():
+            mw.col.db.executemany(
+                f"INSERT OR REPLACE INTO {JOURNAL_CARDS_TABLE} VALUES (?, ?, ?, ?, ?, ?)",
+                card_rows,
+            )
+            mw.col.db.executemany(
+                f"INSERT OR REPLACE INTO {JOURNAL_REVLOG_TABLE} VALUES (?, ?)", revlog_rows
+            )
+            card_rows.clear()
+            revlog_rows.clear()
+
+        for row in csv.reader(journal_file):
+            if len(row) == 0:
+                continue
+            if row[0] == CARD_ROW:
+                cid, due, odue, ivl, factor, data = row[1:]
+                card_rows.append((int(cid), int(due), int(odue), int(ivl), int(factor), data))
+            elif row[0] == REVLOG_ROW:
+                rid, factor = row[1:]
+                revlog_rows.append((int(rid), int(factor)))
+            if len(card_rows) + len(revlog_rows) >= JOURNAL_CHUNK_SIZE:
+                flush()
+        flush()
+
+
+def restore_journal(path: str) -> str:
+    """
+    Put the cards, and revlog factors if saved, back to their state in the journal with one
+    UPDATE for each, joined against the journal loaded into temp tables. Cards deleted since
+    are skipped. Like the deck ease adjustment, this writes directly and can't be undone.
+    Nothing is written if the journal can't be read to the end.
+    :raises ValueError: If a row of the journal is malformed.
+    """
+    try:
+        _load_journal(path)
+        card_cnt = mw.col.db.scalar(
+            f"SELECT count() FROM cards WHERE id IN (SELECT id FROM {JOURNAL_CARDS_TABLE})"
+        )
+        mw.col.db.execute(f"""
+            UPDATE cards
+            SET (due, odue, ivl, factor, data) = (
+                SELECT due, odue, ivl, factor, data
+                FROM {JOURNAL_CARDS_TABLE} AS journal
+                WHERE journal.id = cards.id
+            ),
+            mod = {int_time()},
+            usn = {mw.col.usn()}
+            WHERE id IN (SELECT id FROM {JOURNAL_CARDS_TABLE})
+        """)
+        revlog_cnt = mw.col.db.scalar(
+            f"SELECT count() FROM revlog WHERE id IN (SELECT id FROM {JOURNAL_REVLOG_TABLE})"
+        )
+        mw.col.db.execute(f"""
+            UPDATE revlog
+            SET factor = (
+                SELECT factor
+                FROM {JOURNAL_REVLOG_TABLE} AS journal
+                WHERE journal.id = revlog.id
+            )
+            WHERE id IN (SELECT id FROM {JOURNAL_REVLOG_TABLE})
+        """)
+    finally:
+        mw.col.db.execute(f"DROP TABLE IF EXISTS {JOURNAL_CARDS_TABLE}")
+        mw.col.db.execute(f"DROP TABLE IF EXISTS {JOURNAL_REVLOG_TABLE}")
+    # The cached histories may have the replaced revlog factors
+    card_histories.clear()
+    return f"Restored {card_cnt} cards and {revlog_cnt} revlog factors"
+
+
+def restore_journal_command(did=None):
+    path = getFile(
+        mw,
+        "Restore schedule from journal",
+        None,
+        filter=f"*{JOURNAL_EXT}",
+        dir=journal_dir(),
+        key="csh_journal",
+    )
+    if not path:
+        return
+    try:
+        header = read_journal_header(path)
+    except ValueError as err:
+        showWarning(str(err))
+        return
+    created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(header["created"]))
+    if not askUser(
+        f"Restore the cards saved before \"{header['label']}\" on {created}?"
+        " Changes made to them since then are lost, and the restore can't be undone."
+    ):
+        return
+    start_time = time.time()
+
+    def on_done(future):
+        try:
+            result = future.result()
+        except (OSError, EOFError, ValueError, csv.Error) as err:
+            showWarning(f"The journal could not be restored: {err}")
+            return
+        tooltip(f"{result} in {time.time() - start_time:.2f} seconds")
+        mw.reset()
+
+    run_job("restore_journal", lambda _: restore_journal(path), on_done, key=None)
+
+
+def journal_before_job(
+    label: str,
+    card_ids: Iterable[int] = (),
+    revlog: bool = False,
+    card_filter: Optional[str] = None,
+    automatic: bool = False,
+) -> Optional[str]:
+    """
+    write_journal for a job about to start. Failing to write the journal, like with a full
+    disk, is reported on the console instead of stopping the job.
+    """
+    try:
+        return write_journal(label, card_ids, revlog, card_filter, automatic)
+    except OSError as err:
+        print(f"Custom Schedule Helper: could not write the journal of {label}: {err}")
+        return None
@@ -0,0 +1,16 @@
+import importlib
+from typing import Callable
+
+
+def lazy(module: str, name: str, package: str) -> Callable:
+    """
+    A stub for the function name of the module, which imports the module the first time the
+    stub is called. Menu actions and hooks are registered with stubs, so that the modules of the
+    commands, and numpy, aren't imported when the add-on starts but when they are first used.
+    :param module: The module, relative to package like in a from import.
+    """
+
+    def stub(*args, **kwargs):
+        return getattr(importlib.import_module(module, package), name)(*args, **kwargs)
+
+    return stub
@@ -1,6 +1,9 @@
 from aqt.gui_hooks import reviewer_did_answer_card
-from .disperse_siblings import disperse_siblings_when_review
+
+from ..lazy import lazy
 
 
 def init_schedule_review_hook():
-    reviewer_did_answer_card.append(disperse_siblings_when_review)
+    reviewer_did_answer_card.append(
+        lazy(".disperse_siblings", "disperse_siblings_when_review", __name__)
+    )
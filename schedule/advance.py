@@ -8,11 +8,17 @@ from anki.utils import ids2str
 from aqt import mw
 from aqt.utils import tooltip, getText, showWarning
 
+from .scoring import score_cards
+from ..job_queue import run_job
+from ..journal import journal_before_job
 from ..utils import (
+    BackgroundProgress,
+    card_snapshot,
     RepresentsInt,
-    get_last_review_date,
     update_card_due_ivl,
     write_custom_data,
+    review_id_to_date,
+    LAST_REVIEW_ID_SQL,
 )
 
 
@@ -29,7 +35,15 @@ def get_desired_advance_cnt_with_response(safe_cnt, did):
     return (None, r)
 
 
-def advance(did):
+# Number of cards written with one update_cards call
+ADVANCE_BATCH_SIZE = 500
+
+
+def get_advance_candidates(did):
+    """
+    Load the undue review cards ranked by advance damage, with the real elapsed days since
+    their last review, so the ranking and the interval applied use the same last review date.
+    """
     DM = DeckManager(mw.col)
     if did is not None:
         did_list = ids2str(DM.deck_and_child_ids(did))
@@ -42,11 +56,12 @@ def advance(did):
             THEN did
             ELSE odid
             END,
-            ivl,
             factor,
+            ivl,
+            {LAST_REVIEW_ID_SQL},
             CASE WHEN odid==0
-            THEN {mw.col.sched.today} - (due - ivl)
-            ELSE {mw.col.sched.today} - (odue - ivl)
+            THEN due
+            ELSE odue
             END
         FROM cards
         WHERE due > {mw.col.sched.today}
@@ -58,41 +73,82 @@ def advance(did):
     # x[1]: did
     # x[2]: factor
     # x[3]: interval
-    # x[4]: elapsed days
-
-    # sort by (elapsed_days / interval - 1), -interval (ascending)
-    cards = sorted(cards, key=lambda x: (x[4] / x[3] - 1, -x[3]))
-    safe_cnt = len(list(filter(lambda x: x[4] / x[3] - 1 - 1 < 0.15, cards)))
-
-    (desired_advance_cnt, resp) = get_desired_advance_cnt_with_response(safe_cnt, did)
-    if desired_advance_cnt is None:
-        if resp:
-            showWarning("Please enter the number of cards you want to advance.")
-        return
-    else:
-        if desired_advance_cnt <= 0:
-            showWarning("Please enter a positive integer.")
+    # x[4]: elapsed days since the last review
+    # x[5]: last review date
+    for x in cards:
+        last_review = review_id_to_date(x[4], x[5], x[3])
+        x[4] = mw.col.sched.today - last_review
+        x[5] = last_review
+    _, _, damages = score_cards(
+        [x[4] for x in cards], [x[3] for x in cards], [x[2] for x in cards]
+    )
+
+    # sort by advance damage, -interval (ascending)
+    order = sorted(range(len(cards)), key=lambda i: (damages[i], -cards[i][3]))
+    return [cards[i] for i in order]
+
+
+def advance(did):
+    def on_candidates_loaded(future):
+        cards = future.result()
+        safe_cnt = len(list(filter(lambda x: x[4] / x[3] - 1 - 1 < 0.15, cards)))
+
+        (desired_advance_cnt, resp) = get_desired_advance_cnt_with_response(safe_cnt, did)
+        if desired_advance_cnt is None:
+            if resp:
+                showWarning("Please enter the number of cards you want to advance.")
             return
+        else:
+            if desired_advance_cnt <= 0:
+                showWarning("Please enter a positive integer.")
+                return
 
-    undo_entry = mw.col.add_custom_undo_entry("Advance")
+        start_time = time.time()
+
+        def on_done(future):
+            mw.progress.finish()
+            tooltip(f"""{future.result()} in {time.time() - start_time:.2f} seconds.""")
+            mw.reset()
 
-    mw.progress.start()
-    start_time = time.time()
+        run_job(
+            "advance",
+            lambda _: advance_background(cards[:desired_advance_cnt]),
+            on_done,
+            # The cards to advance are picked by the user, so it's never merged
+            key=None,
+        )
+
+    return mw.taskman.run_in_background(
+        lambda: get_advance_candidates(did),
+        on_candidates_loaded,
+    )
+
+
+def advance_background(cards):
+    journal_before_job("Advance", [x[0] for x in cards])
+    undo_entry = mw.col.add_custom_undo_entry("Advance")
+    progress = BackgroundProgress("Advancing", max=len(cards))
 
     cnt = 0
-    for cid, _, _, _, _ in cards:
-        if cnt >= desired_advance_cnt:
+    skipped = 0
+    for batch_start in range(0, len(cards), ADVANCE_BATCH_SIZE):
+        batch = []
+        for cid, _, _, _, _, last_review in cards[batch_start : batch_start + ADVANCE_BATCH_SIZE]:
+            card = mw.col.get_card(cid)
+            snapshot = card_snapshot(card)
+            new_ivl = mw.col.sched.today - last_review
+            card = update_card_due_ivl(card, new_ivl, last_review)
+            write_custom_data(card, "v", "a")
+            if card_snapshot(card) == snapshot:
+                skipped += 1
+            else:
+                batch.append(card)
+        if len(batch) > 0:
+            mw.col.update_cards(batch)
+            mw.col.merge_undo_entries(undo_entry)
+        cnt += len(batch)
+        progress.update(value=cnt + skipped, label=f"{cnt} cards advanced")
+        if progress.cancelled:
             break
 
-        card = mw.col.get_card(cid)
-        last_review = get_last_review_date(card)
-        new_ivl = mw.col.sched.today - last_review
-        card = update_card_due_ivl(card, new_ivl)
-        write_custom_data(card, "v", "a")
-        mw.col.update_card(card)
-        mw.col.merge_undo_entries(undo_entry)
-        cnt += 1
-
-    tooltip(f"""{cnt} cards advanced in {time.time() - start_time:.2f} seconds.""")
-    mw.progress.finish()
-    mw.reset()
+    return f"{cnt} cards advanced, {skipped} unchanged"
@@ -1,5 +1,5 @@
 import time
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 from anki.cards import Card
 from anki.consts import CARD_TYPE_REV
@@ -7,14 +7,15 @@ from anki.utils import ids2str
 from aqt import mw
 from aqt.utils import tooltip
 
-from ..configuration import Config
-
-enable_load_balance = None
-free_days = None
-version = None
+from ..card_history import CardHistory, CardHistoryCache, card_histories
+from ..configuration import config
+from ..day_calendar import DayCalendar
+from ..job_queue import run_job
+from ..journal import journal_before_job
 from ..utils import (
-    filter_revlogs,
-    get_last_review_date,
+    BackgroundProgress,
+    card_snapshot,
+    review_id_to_date,
     update_card_due_ivl,
     write_custom_data,
     get_fuzz_range,
@@ -74,8 +75,6 @@ def get_siblings(config, did=None, filter_flag=False, filtered_nid_string=""):
 
 
 def get_siblings_when_review(card: Card):
-    config = Config()
-    config.load()
     siblings = mw.col.db.all(
         f"""
     SELECT 
@@ -103,19 +102,15 @@ def get_siblings_when_review(card: Card):
     return list(siblings)
 
 
-def get_due_range(cid, ivl, due, desired_retention, maximum_interval):
-    card = mw.col.get_card(cid)
-    last_review = get_last_review_date(card)
+def get_due_range(history: CardHistory, ivl, due, desired_retention, maximum_interval):
+    last_review = review_id_to_date(history.last_rated_id(), due, ivl)
     new_ivl = int(round(9 * ivl * (1 / desired_retention - 1)))
     new_ivl = min(new_ivl, maximum_interval)
 
     if new_ivl <= 2.5:
         return (due, due), last_review
 
-    revlogs = filter_revlogs(mw.col.card_stats_data(cid).revlog)
-    last_elapsed_days = (
-        int((revlogs[0].time - revlogs[1].time) / 86400) if len(revlogs) >= 2 else 0
-    )
+    last_elapsed_days = history.last_elapsed_days()
     min_ivl, max_ivl = get_fuzz_range(new_ivl, last_elapsed_days)
     if due >= mw.col.sched.today:
         due_range = (
@@ -129,10 +124,33 @@ def get_due_range(cid, ivl, due, desired_retention, maximum_interval):
     return due_range, last_review
 
 
-def disperse(siblings):
+def avoid_free_day(due, due_range, calendar: DayCalendar):
+    """Move the due to the closest day in due_range that isn't free, if there is one."""
+    if not calendar.is_free(due):
+        return due
+    candidates = [
+        day
+        for day in (calendar.next_non_free_day(due, -1), calendar.next_non_free_day(due))
+        if due_range[0] <= day <= due_range[1]
+    ]
+    if len(candidates) == 0:
+        return due
+    return min(candidates, key=lambda day: abs(day - due))
+
+
+def disperse(
+    siblings,
+    calendar: Optional[DayCalendar] = None,
+    histories: Optional[CardHistoryCache] = None,
+):
+    """
+    :param histories: Cache to get the siblings' histories from, they are loaded without
+                      caching if None.
+    """
+    get_history = histories.get if histories is not None else CardHistory.load
     due_ranges_last_review = {
-        cid: get_due_range(cid, ivl, due, dr, max_ivl)
-        for cid, _, ivl, due, dr, max_ivl in siblings
+        cid: get_due_range(get_history(cid, did), ivl, due, dr, max_ivl)
+        for cid, did, ivl, due, dr, max_ivl in siblings
     }
     due_ranges = {
         cid: due_range for cid, (due_range, _) in due_ranges_last_review.items()
@@ -144,6 +162,9 @@ def disperse(siblings):
     due_ranges[-1] = (latest_review, latest_review)
     min_gap, best_due_dates = maximize_siblings_due_gap(due_ranges)
     best_due_dates.pop(-1)
+    if calendar is not None and calendar.free:
+        for cid, due in best_due_dates.items():
+            best_due_dates[cid] = avoid_free_day(due, due_ranges[cid], calendar)
     return best_due_dates, due_ranges, min_gap
 
 
@@ -157,73 +178,68 @@ def disperse_siblings(
         tooltip(f"{future.result()} in {time.time() - start_time:.2f} seconds")
         mw.reset()
 
-    fut = mw.taskman.run_in_background(
-        lambda: disperse_siblings_backgroud(
+    run_job(
+        "disperse_siblings",
+        lambda _: disperse_siblings_backgroud(
             did, filter_flag, filtered_nid_string, text_from_reschedule
         ),
         on_done,
+        key=(did, filter_flag, filtered_nid_string),
+        whole_collection=did is None and not filter_flag,
     )
 
-    return fut
-
 
 def disperse_siblings_backgroud(
     did, filter_flag=False, filtered_nid_string="", text_from_reschedule=""
 ):
-    config = Config()
-    config.load()
-    global enable_load_balance, free_days
-    enable_load_balance = config.load_balance
-    free_days = config.free_days
-
     card_cnt = 0
+    skipped = 0
     note_cnt = 0
+    calendar = DayCalendar.for_config(config)
     nid_siblings = get_siblings(config, did, filter_flag, filtered_nid_string)
     siblings_cnt = len(nid_siblings)
 
-    undo_entry = mw.col.add_custom_undo_entry("Disperse Siblings")
-    mw.taskman.run_on_main(
-        lambda: mw.progress.start(
-            label="Siblings Dispersing", max=siblings_cnt, immediate=False
-        )
+    journal_before_job(
+        "Disperse siblings",
+        [sibling[0] for siblings in nid_siblings.values() for sibling in siblings],
     )
+    undo_entry = mw.col.add_custom_undo_entry("Disperse Siblings")
+    progress = BackgroundProgress("Siblings Dispersing", max=siblings_cnt)
 
     for nid, siblings in nid_siblings.items():
-        best_due_dates, _, _ = disperse(siblings)
+        best_due_dates, _, _ = disperse(siblings, calendar, card_histories)
         for cid, due in best_due_dates.items():
             card = mw.col.get_card(cid)
-            last_review = get_last_review_date(card)
-            card = update_card_due_ivl(card, due - last_review)
+            snapshot = card_snapshot(card)
+            # The history was cached by disperse
+            history = card_histories.get_for_card(card)
+            last_review = review_id_to_date(
+                history.last_rated_id(), card.odue if card.odid else card.due, card.ivl
+            )
+            card = update_card_due_ivl(card, due - last_review, last_review)
             write_custom_data(card, "v", "d")
+            if card_snapshot(card) == snapshot:
+                skipped += 1
+                continue
             mw.col.update_card(card)
             mw.col.merge_undo_entries(undo_entry)
             card_cnt += 1
         note_cnt += 1
 
         if note_cnt % 500 == 0:
-            mw.taskman.run_on_main(
-                lambda: mw.progress.update(
-                    label=f"{note_cnt}/{len(nid_siblings)} notes dispersed",
-                    value=note_cnt,
-                    max=siblings_cnt,
-                )
+            progress.update(
+                value=note_cnt, label=f"{note_cnt}/{len(nid_siblings)} notes dispersed"
             )
-            if mw.progress.want_cancel():
+            if progress.cancelled:
                 break
 
-    return f"{text_from_reschedule + ', ' if text_from_reschedule != '' else ''}{card_cnt} cards in {note_cnt} notes dispersed"
+    return f"{text_from_reschedule + ', ' if text_from_reschedule != '' else ''}{card_cnt} cards in {note_cnt} notes dispersed, {skipped} unchanged"
 
 
 def disperse_siblings_when_review(reviewer, card: Card, ease):
-    config = Config()
-    config.load()
     if not config.auto_disperse:
         return
 
-    global enable_load_balance, free_days
-    enable_load_balance = config.load_balance
-    free_days = config.free_days
-
     siblings = get_siblings_when_review(card)
 
     if len(siblings) <= 1:
@@ -232,27 +248,38 @@ def disperse_siblings_when_review(reviewer, card: Card, ease):
     messages = []
 
     card_cnt = 0
+    calendar = DayCalendar.for_config(config)
     undo_entry = mw.col.undo_status().last_step
-    best_due_dates, due_ranges, min_gap = disperse(siblings)
+    best_due_dates, due_ranges, min_gap = disperse(siblings, calendar, card_histories)
 
     for cid, due in best_due_dates.items():
         due = max(due, mw.col.sched.today + 1)
         card = mw.col.get_card(cid)
         old_due = card.odue if card.odid else card.due
-        last_review = get_last_review_date(card)
-        card = update_card_due_ivl(card, due - last_review)
+        history = card_histories.get_for_card(card)
+        last_review = review_id_to_date(history.last_rated_id(), old_due, card.ivl)
+        snapshot = card_snapshot(card)
+        card = update_card_due_ivl(card, due - last_review, last_review)
         write_custom_data(card, "v", "d")
+        if card_snapshot(card) == snapshot:
+            continue
         mw.col.update_card(card)
         mw.col.merge_undo_entries(undo_entry)
         card_cnt += 1
-        message = f"Dispersed card {card.id} from {due_to_date(old_due)} to {due_to_date(due)}"
+        message = (
+            f"Dispersed card {card.id} from {due_to_date(old_due, calendar)}"
+            f" to {due_to_date(due, calendar)}"
+        )
         messages.append(message)
 
     if config.debug_notify:
         text = ""
         if min_gap == 0:
             for cid, due_range in due_ranges.items():
-                text += f"Card {cid} due range: {due_to_date(due_range[0])} - {due_to_date(due_range[1])}<br/>"
+                text += (
+                    f"Card {cid} due range: {due_to_date(due_range[0], calendar)}"
+                    f" - {due_to_date(due_range[1], calendar)}<br/>"
+                )
             text = "Due dates are too close to disperse:}<br/>" + text
         tooltip(text + "<br/>".join(messages))
 
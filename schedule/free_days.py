@@ -1,47 +1,154 @@
-from ..configuration import Config
-from .reschedule import reschedule
+import time
+
+from anki.consts import CARD_TYPE_REV
 from anki.utils import ids2str
-import re
-from aqt.utils import tooltip, getText, showWarning, askUser, showText
-from collections import OrderedDict
-from anki.stats_pb2 import CardStatsResponse
-from anki.cards import Card
 from aqt import mw
-import json
-import math
-import random
-import time
-from datetime import datetime, timedelta
+from aqt.utils import tooltip
+
+from ..configuration import config
+from ..custom_data_index import marker_query, refresh_marker_index
+from ..day_calendar import ALL_WEEKDAYS_MASK, DayCalendar
+from ..job_queue import run_job
+from ..journal import journal_before_job
+from ..utils import BackgroundProgress, card_snapshot, get_fuzz_range, write_custom_data
+from .reschedule import Scheduler
+
+# Number of cards written with one update_cards call
+FREE_DAYS_BATCH_SIZE = 500
 
 
 def free_days(did):
-    config = Config()
-    config.load()
     if not config.load_balance:
         tooltip("Please enable load balance first")
         return
-    if len(config.free_days) == 0:
+    calendar = DayCalendar.for_config(config)
+    if not calendar.free:
         tooltip("Please select free days first")
         return
-    today = mw.col.sched.today
-    due_days = []
-    for day_offset in range(365):
-        if (datetime.now() + timedelta(days=day_offset)).weekday() in config.free_days:
-            due_days.append(today + day_offset)
-
-    # find cards that are due in free days in the next 365 days
-    due_in_free_days_cids = mw.col.db.list(
-        f"""SELECT id
+    if calendar.free.weekday_mask == ALL_WEEKDAYS_MASK:
+        tooltip("Please leave at least one day of the week that isn't free")
+        return
+
+    start_time = time.time()
+
+    def on_done(future):
+        mw.progress.finish()
+        tooltip(f"{future.result()} in {time.time() - start_time:.2f} seconds")
+        mw.reset()
+
+    run_job(
+        "free_days",
+        lambda _: free_days_background(did, calendar),
+        on_done,
+        key=did,
+        whole_collection=did is None,
+    )
+
+
+def get_cards_due_in_free_days(did, calendar: DayCalendar):
+    """
+    Find the review cards due on a free day, from today onwards, using the day number of due
+    (or odue for cards in filtered decks) modulo 7 to get the weekday, and the day number ranges
+    of the free dates.
+    """
+    today = calendar.today
+    true_due = "CASE WHEN odid==0 THEN due ELSE odue END"
+
+    free_day_queries = [
+        f"{true_due} BETWEEN {start} AND {end}" for start, end in calendar.free.holidays_from(today)
+    ]
+    if len(calendar.free_weekdays) > 0:
+        free_day_queries.append(
+            f"({true_due} - {today} + {calendar.today_weekday}) % 7"
+            f" IN {ids2str(calendar.free_weekdays)}"
+        )
+    if len(free_day_queries) == 0:
+        return []
+
+    did_query = None
+    if did is not None:
+        did_list = ids2str(mw.col.decks.deck_and_child_ids(did))
+        did_query = f"AND (CASE WHEN odid==0 THEN did ELSE odid END) IN {did_list}"
+
+    refresh_marker_index()
+    return mw.col.db.all(
+        f"""SELECT
+            id,
+            {true_due},
+            ivl
         FROM cards
-        WHERE data != '' 
-        AND json_extract(data, '$.cd') IS NOT NULL
-        AND due IN {ids2str(due_days)}
+        WHERE {marker_query("has_cd")}
+        AND type = {CARD_TYPE_REV}
+        AND queue != -1
+        AND {true_due} >= {today}
+        AND ({" OR ".join(free_day_queries)})
+        {did_query if did_query is not None else ""}
         """
     )
 
-    reschedule(
-        None,
-        recent=False,
-        filter_flag=True,
-        filtered_cids=set(due_in_free_days_cids),
+
+def free_days_background(did, calendar: DayCalendar):
+    scheduler = Scheduler()
+    scheduler.set_load_balance()
+    scheduler.calendar = calendar
+
+    cards = get_cards_due_in_free_days(did, calendar)
+
+    # The new dues are picked first, with the due counts updated as the cards move so that they
+    # spread out, and then the moved cards are written in batches
+    today = calendar.today
+    moves = []
+    skipped = 0
+    for cid, due, ivl in cards:
+        min_ivl, max_ivl = get_fuzz_range(ivl, 0)
+        # Short intervals have a narrow fuzz range and free dates can cover the whole range,
+        # so widen it to the closest days that aren't free on both sides
+        min_ivl = max(1, min(min_ivl, calendar.next_non_free_day(due, -1) - due + ivl))
+        max_ivl = max(max_ivl, calendar.next_non_free_day(due) - due + ivl)
+        # Never move the card into the past
+        min_ivl = max(min_ivl, today - due + ivl)
+        best_ivl = scheduler.least_loaded_ivl(ivl, min_ivl, max_ivl, due, ivl)
+        if best_ivl == ivl:
+            # No day in the range that isn't free
+            skipped += 1
+            continue
+
+        new_due = due + best_ivl - ivl
+        scheduler.due_cnt_perday_from_first_day[due] -= 1
+        scheduler.due_cnt_perday_from_first_day[new_due] = (
+            scheduler.due_cnt_perday_from_first_day.get(new_due, 0) + 1
+        )
+        moves.append((cid, new_due))
+
+    journal_before_job("Apply free days", [cid for cid, _ in moves])
+    undo_entry = mw.col.add_custom_undo_entry("Apply free days")
+    progress = BackgroundProgress("Applying free days", max=len(moves))
+
+    cnt = 0
+    unchanged = 0
+    for batch_start in range(0, len(moves), FREE_DAYS_BATCH_SIZE):
+        batch = []
+        for cid, new_due in moves[batch_start : batch_start + FREE_DAYS_BATCH_SIZE]:
+            card = mw.col.get_card(cid)
+            snapshot = card_snapshot(card)
+            if card.odid:
+                card.odue = new_due
+            else:
+                card.due = new_due
+            write_custom_data(card, "v", "r")
+            if card_snapshot(card) == snapshot:
+                unchanged += 1
+            else:
+                batch.append(card)
+        if len(batch) > 0:
+            mw.col.update_cards(batch)
+            mw.col.merge_undo_entries(undo_entry)
+        cnt += len(batch)
+        progress.update(value=cnt + unchanged, label=f"{cnt} cards moved off free days")
+        if progress.cancelled:
+            break
+
+    return (
+        f"{cnt} cards moved off free days, {unchanged} unchanged,"
+        f" {skipped} skipped with no day nearby that isn't free"
     )
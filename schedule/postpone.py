@@ -18,11 +18,18 @@ from aqt.qt import (
 )
 from aqt.utils import tooltip, getText, showWarning
 
+from .scoring import score_cards
+from ..configuration import config
+from ..custom_data_index import marker_query, refresh_marker_index
+from ..id_sets import id_set
+from ..journal import journal_before_job
+from ..day_calendar import DayCalendar
 from ..utils import (
     write_custom_data,
     RepresentsInt,
     update_card_due_ivl,
-    get_last_review_date,
+    review_id_to_date,
+    LAST_REVIEW_ID_SQL,
 )
 
 WARNING_TEXT = (
@@ -113,53 +120,49 @@ def postpone(did=None, card_ids=None, parent=None):
     if did is not None:
         did_list = ids2str(DM.deck_and_child_ids(did))
 
-    if card_ids is not None:
-        cid_list = ids2str(card_ids)
-
-    # json_extract(data, '$.dr')
-    # WHERE data != ''
-    cards = mw.col.db.all(f"""
-        SELECT 
-            id, 
-            CASE WHEN odid==0
-            THEN did
-            ELSE odid
-            END,
-            factor,
-            ivl,
-            CASE WHEN odid==0
-            THEN {mw.col.sched.today} - (due - ivl)
-            ELSE {mw.col.sched.today} - (odue - ivl)
-            END,
-            CASE WHEN odid==0
-            THEN due
-            ELSE odue
-            END
-        FROM cards
-        WHERE queue = {QUEUE_TYPE_REV}
-        {f"AND due <= {mw.col.sched.today}" if card_ids is None else ""}
-        AND json_extract(json_extract(data, '$.cd'), '$.v') != 'p'
-        {"AND id IN %s" % cid_list if card_ids is not None else ""}
-        {"AND did IN %s" % did_list if did is not None else ""}
-    """)
+    refresh_marker_index()
+    # The browser selection can be any number of cards
+    with id_set(card_ids if card_ids is not None else ()) as cid_list:
+        cards = mw.col.db.all(f"""
+            SELECT 
+                id, 
+                CASE WHEN odid==0
+                THEN did
+                ELSE odid
+                END,
+                factor,
+                ivl,
+                {LAST_REVIEW_ID_SQL},
+                CASE WHEN odid==0
+                THEN due
+                ELSE odue
+                END
+            FROM cards
+            WHERE queue = {QUEUE_TYPE_REV}
+            {f"AND due <= {mw.col.sched.today}" if card_ids is None else ""}
+            AND {marker_query("v != 'p'")}
+            {"AND id IN %s" % cid_list if card_ids is not None else ""}
+            {"AND did IN %s" % did_list if did is not None else ""}
+        """)
     # x[0]: cid
     # x[1]: did
     # x[2]: factor
     # x[3]: interval
-    # x[4]: elapsed days
+    # x[4]: elapsed days since the last review
     # x[5]: due
     # x[6]: max interval
-    cards = map(
-        lambda x: (
-            x
-            + [
-                DM.config_dict_for_deck_id(x[1])["rev"]["maxIvl"],
-            ]
-        ),
-        cards,
+    # x[7]: last review date
+    for x in cards:
+        last_review = review_id_to_date(x[4], x[5], x[3])
+        x[4] = mw.col.sched.today - last_review
+        x.append(DM.config_dict_for_deck_id(x[1])["rev"]["maxIvl"])
+        x.append(last_review)
+    _, damages, _ = score_cards(
+        [x[4] for x in cards], [x[3] for x in cards], [x[2] for x in cards]
     )
-    # sort by interval (ascending)
-    cards = sorted(cards, key=lambda x: x[3])
+    # sort by postpone damage (descending), the least damaged cards are taken from the end
+    order = sorted(range(len(cards)), key=lambda i: (-damages[i], cards[i][3]))
+    cards = [cards[i] for i in order]
     safe_cnt = len(list(filter(lambda x: x[4] / x[3] - 1 < 0.25, cards)))
 
     # If we're in the card browser, don't show the dialog as we're selecting the cards to postpone there
@@ -193,6 +196,9 @@ def postpone(did=None, card_ids=None, parent=None):
             if desired_postpone_cnt < len(cards):
                 cards = cards[len(cards) - desired_postpone_cnt : len(cards)]
 
+    calendar = DayCalendar.for_config(config)
+
+    journal_before_job("Postpone", [x[0] for x in cards])
     undo_entry = mw.col.add_custom_undo_entry("Postpone")
 
     mw.progress.start()
@@ -201,11 +207,9 @@ def postpone(did=None, card_ids=None, parent=None):
     cnt = 0
     ivl_incr = 0
 
-    for cid, _, fct, ivl, elapsed_days, due, max_ivl in cards:
+    for cid, _, fct, ivl, elapsed_days, due, max_ivl, last_review in cards:
         card = mw.col.get_card(cid)
         random.seed(cid + ivl)
-        last_review = get_last_review_date(card)
-        elapsed_days = mw.col.sched.today - last_review
         due_days = max(due - mw.col.sched.today, 0)
         # For cards with ivl < 30, postpone by a percentage of the interval
         delay = elapsed_days - ivl
@@ -254,8 +258,12 @@ def postpone(did=None, card_ids=None, parent=None):
             # This card is postponed by 1 more day, the next by 2 more days, and so on.
             new_ivl = min(elapsed_days + ivl_incr + due_days, max_ivl)
             msg += f" Fixed increment, New IVL: {new_ivl}, IVL incr: {ivl_incr}"
+        # Don't postpone the card into a free day or vacation
+        if calendar.is_free(last_review + new_ivl):
+            new_ivl = min(calendar.next_non_free_day(last_review + new_ivl) - last_review, max_ivl)
+            msg += f", moved off free day to IVL: {new_ivl}"
         print(msg)
-        card = update_card_due_ivl(card, new_ivl)
+        card = update_card_due_ivl(card, new_ivl, last_review)
         write_custom_data(card, "v", "p")
         mw.col.update_card(card)
         mw.col.merge_undo_entries(undo_entry)
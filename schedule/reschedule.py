@@ -1,10 +1,8 @@
-import json
 import math
 import random
 import time
 from builtins import int
-from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import Dict, Optional
 
 from anki.cards import Card
 from anki.consts import (
@@ -14,15 +12,25 @@ from anki.consts import (
     QUEUE_TYPE_DAY_LEARN_RELEARN,
 )
 from anki.decks import DeckManager
-from anki.utils import ids2str, int_version
+from anki.utils import int_version
 from aqt import mw
 from aqt.utils import tooltip, showWarning
 
-from ..configuration import Config
+from ..card_history import CardHistory
+from ..configuration import config
+from ..custom_data_index import marker_query, refresh_marker_index
+from ..day_calendar import DayCalendar
+from ..id_sets import id_set
+from ..job_queue import run_job
+from ..journal import journal_before_job
 from ..utils import (
+    BackgroundProgress,
     get_rev_conf,
     get_fuzz_range,
     update_card_due_ivl,
+    card_snapshot,
+    read_custom_data,
+    review_id_to_date,
     rotate_number_by_k,
     write_custom_data,
     check_custom_scheduler,
@@ -43,19 +51,23 @@ class Scheduler:
     max_ivl: int
     days_upper: bool
     enable_load_balance: bool
-    free_days: List[int]
+    calendar: DayCalendar
     due_cnt_perday_from_first_day: Dict[int, int]
     learned_cnt_perday_from_today: Dict[int, int]
     card: Card
     elapsed_days: int
+    # Day of the card's last review, when next_interval was given it, so that the load balance
+    # counts the due from it instead of from the card's current due and interval
+    last_review_date: Optional[int]
 
     def __init__(self) -> None:
         self.max_ivl = 36500
         self.days_upper = 200
         self.min_again_mult = 0
         self.enable_load_balance = False
-        self.free_days = []
+        self.calendar = DayCalendar.for_collection()
         self.elapsed_days = 0
+        self.last_review_date = None
 
     def set_load_balance(self):
         self.enable_load_balance = True
@@ -103,38 +115,58 @@ class Scheduler:
             else:
                 return int(self.fuzz_factor * (max_ivl - min_ivl + 1) + min_ivl)
         else:
-            min_num_cards = 18446744073709551616
-            best_ivl = ivl
-            step = (max_ivl - min_ivl) // 100 + 1
+            if self.last_review_date is not None:
+                return self.least_loaded_ivl(ivl, min_ivl, max_ivl, self.last_review_date, 0)
             due = self.card.due if self.card.odid == 0 else self.card.odue
-            for check_ivl in reversed(range(min_ivl, max_ivl + step, step)):
-                check_due = due + check_ivl - self.card.ivl
-                day_offset = check_due - mw.col.sched.today
-                due_date = datetime.now() + timedelta(days=day_offset)
-                due_cards = self.due_cnt_perday_from_first_day.get(
-                    max(check_due, mw.col.sched.today), 0
-                )
-                rated_cards = (
-                    self.learned_cnt_perday_from_today.get(0, 0)
-                    if day_offset <= 0
-                    else 0
-                )
-                num_cards = due_cards + rated_cards
-                if (
-                    num_cards < min_num_cards
-                    and due_date.weekday() not in self.free_days
-                ):
-                    best_ivl = check_ivl
-                    min_num_cards = num_cards
-            return best_ivl
-
-    def next_interval(self, max_ivl):
+            return self.least_loaded_ivl(ivl, min_ivl, max_ivl, due, self.card.ivl)
+
+    def least_loaded_ivl(self, ivl, min_ivl, max_ivl, due, cur_ivl):
+        """
+        Return the interval between min_ivl and max_ivl whose due date has the least cards due
+        and isn't a free day. If every day in the range is a free day, ivl is returned.
+        :param due: The current due of the card, counted from its current interval cur_ivl.
+        """
+        min_num_cards = 18446744073709551616
+        best_ivl = ivl
+        step = (max_ivl - min_ivl) // 100 + 1
+        for check_ivl in reversed(range(min_ivl, max_ivl + step, step)):
+            check_due = due + check_ivl - cur_ivl
+            day_offset = check_due - mw.col.sched.today
+            due_cards = self.due_cnt_perday_from_first_day.get(
+                max(check_due, mw.col.sched.today), 0
+            )
+            rated_cards = (
+                self.learned_cnt_perday_from_today.get(0, 0)
+                if day_offset <= 0
+                else 0
+            )
+            num_cards = due_cards + rated_cards
+            if num_cards < min_num_cards and not self.calendar.is_free(check_due):
+                best_ivl = check_ivl
+                min_num_cards = num_cards
+        return best_ivl
+
+    def next_interval(
+        self,
+        max_ivl,
+        history: Optional[CardHistory] = None,
+        last_review_date: Optional[int] = None,
+    ):
+        """
+        :param history: The card's history, if it's already loaded, used instead of reading
+                        its revlog.
+        :param last_review_date: The day of the card's last review, if it's already known.
+        """
         card = self.card
+        self.last_review_date = last_review_date
 
         # Get all revs, including manual reschedules
-        revs = mw.col.db.all(
-            "SELECT ivl, ease, factor, type FROM revlog WHERE cid = ?", card.id
-        )
+        if history is not None:
+            revs = list(zip(history.ivls, history.eases, history.factors, history.types))
+        else:
+            revs = mw.col.db.all(
+                "SELECT ivl, ease, factor, type FROM revlog WHERE cid = ?", card.id
+            )
         if len(revs) > 1:
             prev_rev = revs[len(revs) - 1]
         else:
@@ -157,11 +189,8 @@ class Scheduler:
         # Again
         elif prev_rev_ease == 1:
             # Interval is adjusted downward further according to success rate
-            custom_data = None
-            if card.custom_data != "":
-                custom_data = json.loads(card.custom_data)
-            if custom_data and "sr" in custom_data:
-                success_rate = custom_data["sr"]
+            success_rate = read_custom_data(card.custom_data, "sr")
+            if success_rate is not None:
                 mod_again_mult = max(
                     rev_conf["deck_again_fct"] - (1 - success_rate), self.min_again_mult
                 )
@@ -238,42 +267,55 @@ def reschedule(did, recent=False, filter_flag=False, filtered_cids=[]):
             showWarning("\n".join(err_msgs))
         mw.reset()
 
-    fut = mw.taskman.run_in_background(
-        lambda: reschedule_background(did, recent, filter_flag, filtered_cids),
+    run_job(
+        "reschedule",
+        lambda cids: reschedule_background(
+            did, recent, filter_flag, cids if cids is not None else []
+        ),
         on_done,
+        card_ids=filtered_cids if filter_flag else None,
+        key=(did, recent, filter_flag),
+        whole_collection=did is None and not recent and not filter_flag,
     )
 
-    return fut
-
 
 RESCHEDULE_STOP_MSG = "Reschedule stopped due to error"
 
 
+def get_reschedule_parameters():
+    """
+    The deck parameters of the custom scheduler and the ids of the decks it skips.
+    :raises CustomSchedulerNotFoundError: If the custom scheduler isn't set.
+    :raises DeckParamError: If its deck parameters can't be read.
+    """
+    custom_scheduler = check_custom_scheduler(mw.col.all_config())
+    deck_parameters = get_deck_parameters(custom_scheduler)
+    skip_dids = {
+        mw.col.decks.by_name(skip_deck_name)["id"]: True
+        for skip_deck_name in get_skip_decks(custom_scheduler)
+    }
+    return deck_parameters, skip_dids
+
+
+def get_scheduler(config) -> Scheduler:
+    scheduler = Scheduler()
+    if config.load_balance:
+        scheduler.set_load_balance()
+        scheduler.calendar = DayCalendar.for_config(config)
+    return scheduler
+
+
 def reschedule_background(did, recent=False, filter_flag=False, filtered_cids=[]):
-    config = Config()
-    config.load()
     try:
-        custom_scheduler = check_custom_scheduler(mw.col.all_config())
-    except CustomSchedulerNotFoundError as err:
-        return (RESCHEDULE_STOP_MSG, [err.message])
-    try:
-        deck_parameters = get_deck_parameters(custom_scheduler)
-    except DeckParamError as err:
+        deck_parameters, skip_dids = get_reschedule_parameters()
+    except (CustomSchedulerNotFoundError, DeckParamError) as err:
         return (RESCHEDULE_STOP_MSG, [err.message])
 
-    skip_decks = get_skip_decks(custom_scheduler)
-
-    undo_entry = mw.col.add_custom_undo_entry("Reschedule")
-    mw.taskman.run_on_main(
-        lambda: mw.progress.start(label="Rescheduling", immediate=False)
-    )
+    progress = BackgroundProgress("Rescheduling")
 
     cnt = 0
+    skipped = 0
     err_msgs = []
-    skip_dids = {
-        mw.col.decks.by_name(skip_deck_name)["id"]: True
-        for skip_deck_name in skip_decks
-    }
 
     decks = sorted(
         filter(lambda d: not skip_dids.get(d["id"], False), mw.col.decks.all()),
@@ -281,13 +323,8 @@ def reschedule_background(did, recent=False, filter_flag=False, filtered_cids=[]
         reverse=True,
     )
 
-    scheduler = Scheduler()
-
-    if config.load_balance:
-        scheduler.set_load_balance()
-        scheduler.free_days = config.free_days
+    scheduler = get_scheduler(config)
 
-    cancelled = False
     DM = DeckManager(mw.col)
 
     # Is this a single deck reschedule from deck menu?
@@ -295,61 +332,72 @@ def reschedule_background(did, recent=False, filter_flag=False, filtered_cids=[]
     if did is not None:
         single_deck_name = mw.col.decks.get(did)["name"]
 
-    for deck in decks:
-        # IF we're targeting a single deck, skip all other decks except that one and its subdecks
-        if single_deck_name is not None and not deck["name"].startswith(
-            single_deck_name
-        ):
-            continue
+    recent_query = None
+    if recent:
+        today_cutoff = mw.col.sched.day_cutoff
+        day_before_cutoff = today_cutoff - (config.days_to_reschedule + 1) * 86400
+        recent_query = f"AND id IN (SELECT cid FROM revlog WHERE id >= {day_before_cutoff * 1000})"
+
+    not_already_rescheduled_query = None
+    # When doing auto reschedule, we don't want to reschedule cards that were already rescheduled
+    # or dispersed by another Anki instance running this addon
+    # But when running reschedule from the deck menu or main menu, we will reschedule again
+    if filter_flag:
+        refresh_marker_index()
+        not_already_rescheduled_query = "AND " + marker_query("v NOT IN ('r', 'd')")
+
+    # The cards of each deck are selected first, so that only the ones that get rescheduled are
+    # saved in the journal
+    deck_cards = []
+    with id_set(filtered_cids if filter_flag else ()) as filtered_cid_list:
+        filter_query = None
+        if filter_flag and len(filtered_cids) > 0:
+            filter_query = f"AND id IN {filtered_cid_list}"
 
-        cur_deck_param = get_current_deck_parameter(deck["name"], deck_parameters)
+        for deck in decks:
+            # IF we're targeting a single deck, skip all other decks except that one and its subdecks
+            if single_deck_name is not None and not deck["name"].startswith(
+                single_deck_name
+            ):
+                continue
 
-        if cur_deck_param is None:
-            err_msgs.append(
-                f"{SCHEDULER_NAME} ERROR: Deck parameter was not found for deck '{deck['name']}'"
+            cur_deck_param = get_current_deck_parameter(deck["name"], deck_parameters)
+
+            if cur_deck_param is None:
+                err_msgs.append(
+                    f"{SCHEDULER_NAME} ERROR: Deck parameter was not found for deck '{deck['name']}'"
+                )
+                break
+
+            cards = mw.col.db.all(
+                f"""
+                SELECT 
+                    id,
+                    CASE WHEN odid==0
+                    THEN did
+                    ELSE odid
+                    END
+                FROM cards
+                WHERE data != ''
+                AND queue IN ({QUEUE_TYPE_LRN}, {QUEUE_TYPE_REV}, {QUEUE_TYPE_DAY_LEARN_RELEARN})
+                AND did = {deck['id']}
+                {not_already_rescheduled_query if not_already_rescheduled_query is not None else ""}
+                {recent_query if recent_query is not None else ""}
+                {filter_query if filter_query is not None else ""}
+            """
             )
-            break
+            deck_cards.append((cur_deck_param, cards))
 
+    journal_before_job("Reschedule", [cid for _, cards in deck_cards for cid, _ in cards])
+    # Added after the selection, as writing the marker index and id set tables with SQL clears
+    # the undo queue
+    undo_entry = mw.col.add_custom_undo_entry("Reschedule")
+
+    for cur_deck_param, cards in deck_cards:
         # Set deck specific parameters
         scheduler.days_upper = cur_deck_param[DAYS_UPPER_PARAM]
         scheduler.min_again_mult = cur_deck_param[MIN_AGAIN_MULT_PARAM]
 
-        recent_query = None
-        if recent:
-            today_cutoff = mw.col.sched.day_cutoff
-            day_before_cutoff = today_cutoff - (config.days_to_reschedule + 1) * 86400
-            recent_query = f"AND id IN (SELECT cid FROM revlog WHERE id >= {day_before_cutoff * 1000})"
-
-        filter_query = None
-        if filter_flag and len(filtered_cids) > 0:
-            filter_query = f"AND id IN {ids2str(filtered_cids)}"
-
-        not_already_rescheduled_query = None
-        # When doing auto reschedule, we don't want to reschedule cards that were already rescheduled
-        # or dispersed by another Anki instance running this addon
-        # But when running reschedule from the deck menu or main menu, we will reschedule again
-        if filter_flag:
-            not_already_rescheduled_query = (
-                f"AND json_extract(json_extract(data, '$.cd'), '$.v') NOT IN ('r', 'd')"
-            )
-
-        cards = mw.col.db.all(
-            f"""
-            SELECT 
-                id,
-                CASE WHEN odid==0
-                THEN did
-                ELSE odid
-                END
-            FROM cards
-            WHERE data != ''
-            AND queue IN ({QUEUE_TYPE_LRN}, {QUEUE_TYPE_REV}, {QUEUE_TYPE_DAY_LEARN_RELEARN})
-            AND did = {deck['id']}
-            {not_already_rescheduled_query if not_already_rescheduled_query is not None else ""}
-            {recent_query if recent_query is not None else ""}
-            {filter_query if filter_query is not None else ""}
-        """
-        )
         # x[0]: cid
         # x[1]: did
         # x[2]: max interval
@@ -364,38 +412,53 @@ def reschedule_background(did, recent=False, filter_flag=False, filtered_cids=[]
         )
 
         for cid, _, max_interval in cards:
-            if cancelled:
+            if progress.cancelled:
                 break
             scheduler.max_ivl = max_interval
-            card = reschedule_card(cid, scheduler)
-            if card is None:
-                continue
-            mw.col.update_card(card)
-            mw.col.merge_undo_entries(undo_entry)
-            cnt += 1
-            if cnt % 500 == 0:
-                mw.taskman.run_on_main(
-                    lambda: mw.progress.update(
-                        value=cnt, label=f"{cnt} cards rescheduled"
-                    )
-                )
-                if mw.progress.want_cancel():
-                    cancelled = True
-
-    return (f"{cnt} cards rescheduled", err_msgs)
-
-
-def reschedule_card(cid, scheduler: Scheduler):
-    card = mw.col.get_card(cid)
+            card = mw.col.get_card(cid)
+            snapshot = card_snapshot(card)
+            reschedule_card(cid, scheduler, card)
+            if card_snapshot(card) == snapshot:
+                skipped += 1
+            else:
+                mw.col.update_card(card)
+                mw.col.merge_undo_entries(undo_entry)
+                cnt += 1
+            if (cnt + skipped) % 500 == 0:
+                progress.update(value=cnt + skipped, label=f"{cnt} cards rescheduled")
+
+    return (f"{cnt} cards rescheduled, {skipped} unchanged", err_msgs)
+
+
+def reschedule_card(
+    cid,
+    scheduler: Scheduler,
+    card: Optional[Card] = None,
+    history: Optional[CardHistory] = None,
+):
+    """
+    :param card: The card, if it's already loaded. It's changed in place, but not written.
+    :param history: The card's history, if it's already loaded, to compute the interval and
+                    the last review date from instead of reading the revlog.
+    """
+    if card is None:
+        card = mw.col.get_card(cid)
 
     write_custom_data(card, "v", "r")
 
     if card.type == CARD_TYPE_REV:
         scheduler.set_card(card)
         scheduler.set_fuzz_factor(cid, card.reps)
-        new_ivl = scheduler.next_interval(scheduler.max_ivl)
         due_before = max(card.odue if card.odid else card.due, mw.col.sched.today)
-        card = update_card_due_ivl(card, new_ivl)
+        last_review_date = (
+            review_id_to_date(
+                history.last_rated_id(), card.odue if card.odid else card.due, card.ivl
+            )
+            if history is not None
+            else None
+        )
+        new_ivl = scheduler.next_interval(scheduler.max_ivl, history, last_review_date)
+        card = update_card_due_ivl(card, new_ivl, last_review_date)
         due_after = max(card.odue if card.odid else card.due, mw.col.sched.today)
         if scheduler.enable_load_balance:
             scheduler.due_cnt_perday_from_first_day[due_before] -= 1
@@ -0,0 +1,64 @@
+from typing import Sequence, Tuple
+
+from ..utils import power_forgetting_curve
+
+try:
+    import numpy as np
+except ImportError:
+    # Anki doesn't bundle numpy, fall back to plain python when it isn't installed
+    np = None
+
+
+def _convert_factor(fct):
+    # FSRS factor, convert to an approximate ease factor
+    if fct < 1100:
+        difficulty = (fct - 100) / 1000
+        return 3000 - 1700 * difficulty
+    return fct
+
+
+def _score_card(elapsed_days, ivl, fct) -> Tuple[float, float, float]:
+    # The interval was chosen so that retrievability would be ~0.9 when the card becomes due,
+    # which is what the power forgetting curve gives when stability equals the interval
+    stability = max(ivl, 1)
+    elapsed_days = max(elapsed_days, 0)
+    retrievability = power_forgetting_curve(elapsed_days, stability)
+    # Postpone delays the card by roughly fct / 15000 of the elapsed days, at least one day
+    delay = max(1, elapsed_days * max(0.05, _convert_factor(fct) / 15000))
+    postpone_damage = retrievability - power_forgetting_curve(elapsed_days + delay, stability)
+    # Reviewing early wastes the part of retrievability that would have been lost by the due date
+    advance_damage = max(retrievability - power_forgetting_curve(stability, stability), 0)
+    return retrievability, postpone_damage, advance_damage
+
+
+def score_cards(
+    elapsed_days: Sequence[int], ivls: Sequence[int], factors: Sequence[int]
+) -> Tuple[Sequence[float], Sequence[float], Sequence[float]]:
+    """
+    Score a batch of cards for postponing and advancing.
+    :param elapsed_days: Days since the real last review of each card.
+    :param ivls: The interval of each card.
+    :param factors: The factor of each card.
+    :return: The retrievability, postpone damage and advance damage of each card, in the same
+             order as the input. The damage is the retrievability lost by postponing a card or
+             wasted by advancing it, so the cards with the least damage should be picked first.
+    """
+    if np is None:
+        scores = [_score_card(e, i, f) for e, i, f in zip(elapsed_days, ivls, factors)]
+        return (
+            [s[0] for s in scores],
+            [s[1] for s in scores],
+            [s[2] for s in scores],
+        )
+
+    elapsed_days = np.maximum(np.asarray(elapsed_days, dtype=np.float64), 0)
+    stability = np.maximum(np.asarray(ivls, dtype=np.float64), 1)
+    factors = np.asarray(factors, dtype=np.float64)
+    factors = np.where(factors < 1100, 3000 - 1700 * ((factors - 100) / 1000), factors)
+    retrievability = power_forgetting_curve(elapsed_days, stability)
+    delay = np.maximum(1, elapsed_days * np.maximum(0.05, factors / 15000))
+    postpone_damage = retrievability - power_forgetting_curve(elapsed_days + delay, stability)
+    advance_damage = np.maximum(
+        retrievability - power_forgetting_curve(stability, stability), 0
+    )
+    return retrievability, postpone_damage, advance_damage
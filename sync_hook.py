@@ -1,111 +1,258 @@
+import time
 from typing import List
 
-from anki.utils import ids2str
+from anki.consts import QUEUE_TYPE_DAY_LEARN_RELEARN, QUEUE_TYPE_LRN, QUEUE_TYPE_REV
 from aqt import mw
 from aqt.gui_hooks import sync_will_start, sync_did_finish
-from aqt.utils import tooltip
+from aqt.utils import tooltip, showWarning
 
-from .configuration import Config
-from .ease.auto_ease_factor import adjust_ease
-from .schedule.disperse_siblings import disperse_siblings
-from .schedule.reschedule import reschedule
+from .card_history import CardHistoryCache
+from .configuration import Config, config
+from .day_calendar import DayCalendar
+from .id_sets import id_set
+from .job_queue import run_job
+from .journal import journal_before_job
+from .utils import (
+    BackgroundProgress,
+    CustomSchedulerNotFoundError,
+    card_snapshot,
+    DeckParamError,
+    DAYS_UPPER_PARAM,
+    MIN_AGAIN_MULT_PARAM,
+    SCHEDULER_NAME,
+    get_current_deck_parameter,
+    read_custom_data_batch,
+    review_id_to_date,
+    update_card_due_ivl,
+    write_custom_data,
+)
 
+class RevlogWatermark:
+    """
+    Watermark of the revlog's usn before a sync, to find the entries the sync added without
+    copying or scanning the revlog, using its usn index. Synced entries have the usn of the
+    sync that sent them, so the ones the sync added have a usn above the highest one before it.
+    The local entries that weren't synced yet, with usn -1, get the new usn as they're sent, so
+    their ids are recorded and left out.
+    """
 
-def create_comparelog(local_rids: List[int], texts: List[str]) -> None:
-    texts.clear()
-    local_rids.clear()
-    local_rids.extend([id for id in mw.col.db.list("SELECT id FROM revlog")])
+    def __init__(self) -> None:
+        self.max_usn = 0
+        self.local_ids = []
 
+    def snapshot(self):
+        self.max_usn = mw.col.db.scalar("SELECT max(usn) FROM revlog") or 0
+        self.local_ids = mw.col.db.list("SELECT id FROM revlog WHERE usn = -1")
 
-def review_cid_remote(remote_reviewed_cids: List[int], local_rids: List[int]):
-    local_rid_string = ids2str(local_rids)
-    remote_reviewed_cids.extend(
-        [
-            cid for cid in mw.col.db.list(f"""SELECT DISTINCT cid
-            FROM revlog
-            WHERE id NOT IN {local_rid_string}
-            AND type < 4
+    def new_reviewed_cids(self) -> list[int]:
+        """Cards of the review entries added since the snapshot."""
+        with id_set(self.local_ids) as local_id_list:
+            return mw.col.db.list(f"""
+                SELECT DISTINCT cid
+                FROM revlog
+                WHERE usn > {self.max_usn}
+                AND id NOT IN {local_id_list}
+                AND type < 4
             """)  # type: 0=Learning, 1=Review, 2=relearn, 3=filtered, 4=Manual
-        ]
-    )
 
 
-def auto_reschedule(remote_reviewed_cids: List[int], texts: List[str]):
-    if len(remote_reviewed_cids) == 0:
-        return
-    config = Config()
-    config.load()
-    if not config.auto_reschedule_after_sync:
-        return
+def create_comparelog(watermark: RevlogWatermark) -> None:
+    watermark.snapshot()
 
-    fut = reschedule(
-        None,
-        recent=False,
-        filter_flag=True,
-        filtered_cids=set(remote_reviewed_cids),
-    )
 
-    if fut:
-        # wait for reschedule to finish
-        (reschedule_result_msg, _) = fut.result()
-        texts.append(reschedule_result_msg)
+def review_cid_remote(remote_reviewed_cids: List[int], watermark: RevlogWatermark):
+    remote_reviewed_cids.clear()
+    remote_reviewed_cids.extend(watermark.new_reviewed_cids())
 
 
-def auto_disperse(remote_reviewed_cids: List[int], texts: List[str]):
-    if len(remote_reviewed_cids) == 0:
-        return
-    config = Config()
-    config.load()
-    if not config.auto_disperse_after_sync:
-        return
+def true_due(card) -> int:
+    return card.odue if card.odid else card.due
+
+
+def adjust_after_sync_background(config: Config, remote_reviewed_cids: List[int]):
+    """
+    Adjust the ease of, reschedule and disperse the siblings of the cards reviewed on other
+    devices, in that order and as enabled in the config, in one pass. The cards, their siblings
+    and the histories of both are loaded once, each step changes the loaded cards, so the later
+    steps start from the earlier ones, and every changed card is written once at the end under
+    one undo entry. The revlog factors rewritten by the ease adjustment are written before
+    rescheduling, which reads them, and can't be undone like with the other ease adjustments.
+    :return: The combined summary of the steps and their error messages.
+    """
+    # Imported here, so that the hooks of this module don't import them when the add-on starts
+    from .ease.auto_ease_factor import adjust_ease_of_cards
+    from .schedule.disperse_siblings import disperse, get_siblings
+    from .schedule.reschedule import (
+        RESCHEDULE_STOP_MSG,
+        get_reschedule_parameters,
+        get_scheduler,
+        reschedule_card,
+    )
 
-    remote_reviewed_cid_string = ids2str(remote_reviewed_cids)
-    remote_reviewed_nids = [nid for nid in mw.col.db.list(f"""SELECT DISTINCT nid 
-            FROM cards 
-            WHERE id IN {remote_reviewed_cid_string}
-        """)]
-    remote_reviewed_nid_string = ids2str(remote_reviewed_nids)
-
-    fut = disperse_siblings(
-        None,
-        filter_flag=True,
-        filtered_nid_string=remote_reviewed_nid_string,
-        text_from_reschedule="<br>".join(texts),
+    progress = BackgroundProgress("Adjusting cards reviewed on other devices")
+    # The revlog entries of cards deleted since their review are left behind, so only the cards
+    # that still exist are loaded
+    with id_set(remote_reviewed_cids) as cid_list:
+        existing_cids = mw.col.db.list(f"SELECT id FROM cards WHERE id IN {cid_list}")
+    cards = {cid: mw.col.get_card(cid) for cid in existing_cids}
+    snapshots = {cid: card_snapshot(card) for cid, card in cards.items()}
+    deck_ids = {cid: card.odid if card.odid else card.did for cid, card in cards.items()}
+    nid_siblings = {}
+    if config.auto_disperse_after_sync:
+        with id_set({card.nid for card in cards.values()}) as nid_list:
+            nid_siblings = get_siblings(config, filter_flag=True, filtered_nid_string=nid_list)
+        for siblings in nid_siblings.values():
+            for cid, did, *_ in siblings:
+                deck_ids[cid] = did
+    histories = CardHistoryCache(size=len(deck_ids))
+    histories.preload(deck_ids)
+    journal_before_job(
+        "Adjust after sync",
+        deck_ids.keys(),
+        revlog=config.auto_adjust_ease_after_sync,
+        automatic=True,
     )
 
-    if fut:
-        # Disperse siblings is the last operation, so we can show the result now
-        # Instead of returning the future, we show a tooltip with the result so
-        # we can set our own period
-        tooltip(
-            fut.result(),
-            period=10000,
+    changed_cids = set()
+    messages = []
+    err_msgs = []
+
+    if config.auto_adjust_ease_after_sync:
+        progress.update(value=0, label="Adjusting ease")
+        # Only the cards marked as not adjusted yet, like adjust_ease(marked_only=True)
+        ease_markers = read_custom_data_batch((card.custom_data for card in cards.values()), ("e",))
+        ease_cards = [
+            card
+            for card, (ease_marker,) in zip(cards.values(), ease_markers)
+            if card.queue in (QUEUE_TYPE_LRN, QUEUE_TYPE_REV, QUEUE_TYPE_DAY_LEARN_RELEARN)
+            and ease_marker == 0
+        ]
+        new_histories = adjust_ease_of_cards(
+            config, ease_cards, [histories.get_for_card(card) for card in ease_cards]
         )
+        for history in new_histories:
+            histories.put(history)
+        changed_cids.update(card.id for card in ease_cards)
+        messages.append(f"Adjusted ease for {len(ease_cards)} cards")
 
+    if config.auto_reschedule_after_sync and not progress.cancelled:
+        progress.update(value=0, label="Rescheduling")
+        try:
+            deck_parameters, skip_dids = get_reschedule_parameters()
+        except (CustomSchedulerNotFoundError, DeckParamError) as err:
+            deck_parameters = None
+            messages.append(RESCHEDULE_STOP_MSG)
+            err_msgs.append(err.message)
+        if deck_parameters is not None:
+            scheduler = get_scheduler(config)
+            cnt = 0
+            versions = read_custom_data_batch((card.custom_data for card in cards.values()), ("v",))
+            for card, (version,) in zip(cards.values(), versions):
+                # Same cards as reschedule(filter_flag=True), which skips the ones already
+                # rescheduled or dispersed by another Anki instance running this addon, and like
+                # its v NOT IN ('r', 'd') the ones without v
+                if (
+                    card.custom_data == ""
+                    or card.queue
+                    not in (QUEUE_TYPE_LRN, QUEUE_TYPE_REV, QUEUE_TYPE_DAY_LEARN_RELEARN)
+                    or skip_dids.get(card.did, False)
+                    or version is None
+                    or version in ("r", "d")
+                ):
+                    continue
+                deck_name = mw.col.decks.name(card.did)
+                cur_deck_param = get_current_deck_parameter(deck_name, deck_parameters)
+                if cur_deck_param is None:
+                    err_msgs.append(
+                        f"{SCHEDULER_NAME} ERROR: Deck parameter was not found for deck"
+                        f" '{deck_name}'"
+                    )
+                    break
+                scheduler.days_upper = cur_deck_param[DAYS_UPPER_PARAM]
+                scheduler.min_again_mult = cur_deck_param[MIN_AGAIN_MULT_PARAM]
+                scheduler.max_ivl = mw.col.decks.config_dict_for_deck_id(deck_ids[card.id])[
+                    "rev"
+                ]["maxIvl"]
+                reschedule_card(card.id, scheduler, card, histories.get_for_card(card))
+                changed_cids.add(card.id)
+                cnt += 1
+            messages.append(f"{cnt} cards rescheduled")
+
+    if config.auto_disperse_after_sync and not progress.cancelled:
+        progress.update(value=0, label="Siblings Dispersing")
+        calendar = DayCalendar.for_config(config)
+        card_cnt = 0
+        for siblings in nid_siblings.values():
+            # The siblings that were loaded are dispersed from their due after the steps above
+            siblings = [
+                (
+                    (cid, did, cards[cid].ivl, true_due(cards[cid]), dr, max_ivl)
+                    if cid in cards
+                    else (cid, did, ivl, due, dr, max_ivl)
+                )
+                for cid, did, ivl, due, dr, max_ivl in siblings
+            ]
+            best_due_dates, _, _ = disperse(siblings, calendar, histories)
+            for cid, due in best_due_dates.items():
+                if cid not in cards:
+                    cards[cid] = mw.col.get_card(cid)
+                    snapshots[cid] = card_snapshot(cards[cid])
+                card = cards[cid]
+                old_due = true_due(card)
+                history = histories.get_for_card(card)
+                last_review = review_id_to_date(history.last_rated_id(), old_due, card.ivl)
+                update_card_due_ivl(card, due - last_review, last_review)
+                write_custom_data(card, "v", "d")
+                changed_cids.add(cid)
+                card_cnt += 1
+        messages.append(f"{card_cnt} cards in {len(nid_siblings)} notes dispersed")
+
+    # The steps can leave a card as it was, like a reschedule to the same due
+    changed_cards = [
+        cards[cid] for cid in changed_cids if card_snapshot(cards[cid]) != snapshots[cid]
+    ]
+    if len(changed_cards) > 0:
+        undo_entry = mw.col.add_custom_undo_entry("Adjust cards reviewed on other devices")
+        mw.col.update_cards(changed_cards)
+        mw.col.merge_undo_entries(undo_entry)
+    messages.append(
+        f"{len(changed_cards)} cards updated, {len(changed_cids) - len(changed_cards)} unchanged"
+    )
+    return ", ".join(messages), err_msgs
 
-def auto_adjust_ease(remote_reviewed_cids: List[int], texts: List[str]):
+
+def adjust_after_sync(remote_reviewed_cids: List[int]):
     if len(remote_reviewed_cids) == 0:
         return
+    if not (
+        config.auto_adjust_ease_after_sync
+        or config.auto_reschedule_after_sync
+        or config.auto_disperse_after_sync
+    ):
+        return
+    start_time = time.time()
 
-    fut = adjust_ease(
-        recent=False,
-        marked_only=True,
-        card_ids=set(remote_reviewed_cids),
-    )
+    def on_done(future):
+        mw.progress.finish()
+        (result_msg, err_msgs) = future.result()
+        tooltip(f"{result_msg} in {time.time() - start_time:.2f} seconds", period=10000)
+        if len(err_msgs) > 0:
+            showWarning("\n".join(err_msgs))
+        mw.reset()
 
-    if fut:
-        # wait for adjustment to finish
-        texts.append(fut.result())
+    # Syncs done while the job of an earlier one is waiting are merged into it
+    run_job(
+        "adjust_after_sync",
+        lambda cids: adjust_after_sync_background(config, list(cids)),
+        on_done,
+        card_ids=remote_reviewed_cids,
+    )
 
 
 def init_sync_hook():
-    local_rids = []
+    watermark = RevlogWatermark()
     remote_reviewed_cids = []
-    texts = []
-
-    sync_will_start.append(lambda: create_comparelog(local_rids, texts))
-    sync_did_finish.append(lambda: review_cid_remote(remote_reviewed_cids, local_rids))
 
-    # sync_did_finish.append(lambda: auto_adjust_ease(remote_reviewed_cids, texts))
-    sync_did_finish.append(lambda: auto_reschedule(remote_reviewed_cids, texts))
-    sync_did_finish.append(lambda: auto_disperse(remote_reviewed_cids, texts))
+    sync_will_start.append(lambda: create_comparelog(watermark))
+    sync_did_finish.append(lambda: review_cid_remote(remote_reviewed_cids, watermark))
+    sync_did_finish.append(lambda: adjust_after_sync(remote_reviewed_cids))
@@ -2,9 +2,9 @@ import json
 import math
 import base64
 import re
+import threading
 from collections import OrderedDict
-from datetime import datetime, timedelta
-from typing import List, Union, Optional, TypedDict, Literal
+from typing import Iterable, List, Literal, Optional, Sequence, TypedDict, Union
 
 from anki.cards import Card
 from anki.stats import (
@@ -17,6 +17,8 @@ from anki.stats_pb2 import CardStatsResponse
 from aqt import mw
 from aqt.utils import showWarning
 
+from .day_calendar import DayCalendar
+
 SCHEDULER_NAME = "Custom Scheduler"
 CUR_SCHEDULER_VERSION = (1, 0, 0)
 CUR_SCHEDULER_VERSION_STR = ".".join(map(str, CUR_SCHEDULER_VERSION))
@@ -194,6 +196,34 @@ def get_skip_decks(custom_scheduler):
     return decks
 
 
+class BackgroundProgress:
+    """
+    Progress dialog for a job running in a mw.taskman background thread.
+    Qt and mw.progress must only be used from the main thread, so the updates and the cancel
+    check are queued there and the result of the cancel check is passed back with an Event.
+    The job's on_done callback, which runs on the main thread, should call mw.progress.finish().
+    """
+
+    def __init__(self, label: str, max: int = 0) -> None:
+        self.max = max
+        self._cancelled = threading.Event()
+        mw.taskman.run_on_main(
+            lambda: mw.progress.start(label=label, max=max, immediate=False)
+        )
+
+    def update(self, value: int, label: str):
+        def update_on_main():
+            mw.progress.update(value=value, label=label, max=self.max)
+            if mw.progress.want_cancel():
+                self._cancelled.set()
+
+        mw.taskman.run_on_main(update_on_main)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+
 def RepresentsInt(s):
     try:
         return int(s)
@@ -237,10 +267,29 @@ def get_last_review_date(card: Card):
     return last_review_date
 
 
-def update_card_due_ivl(card: Card, new_ivl: int):
+# Id of the card's latest rated review, for use as a column in queries selecting from cards.
+# Uses the revlog cid index, so it's a single lookup per card instead of a card_stats_data call.
+LAST_REVIEW_ID_SQL = "(SELECT max(id) FROM revlog WHERE cid = cards.id AND ease >= 1)"
+
+
+def review_id_to_date(review_id: Optional[int], due: int, ivl: int) -> int:
+    """
+    Convert the revlog id selected with LAST_REVIEW_ID_SQL into a day number,
+    matching what get_last_review_date returns for the same card.
+    :param review_id: The revlog id of the last rated review, None if there isn't one.
+    :param due: The card's due, or odue if the card is in a filtered deck.
+    :param ivl: The card's interval, used for the fallback when there is no review.
+    """
+    if review_id is None:
+        return due - ivl
+    return math.ceil((review_id // 1000 - mw.col.sched.day_cutoff) / 86400) + mw.col.sched.today
+
+
+def update_card_due_ivl(card: Card, new_ivl: int, last_review_date: Optional[int] = None):
     # Don't change ivl, it leads to ever-increasing ivl when reschedule is applied repeatedly
     # card.ivl = new_ivl
-    last_review_date = get_last_review_date(card)
+    if last_review_date is None:
+        last_review_date = get_last_review_date(card)
     if card.odid:
         card.odue = max(last_review_date + new_ivl, 1)
     else:
@@ -278,10 +327,11 @@ def get_fuzz_range(interval, elapsed_days):
     return min_ivl, max_ivl
 
 
-def due_to_date(due: int) -> str:
-    offset = due - mw.col.sched.today
-    today_date = datetime.today()
-    return (today_date + timedelta(days=offset)).strftime("%Y-%m-%d")
+def due_to_date(due: int, calendar: Optional[DayCalendar] = None) -> str:
+    """Return the date of a due day number as YYYY-MM-DD, pass a DayCalendar when converting many."""
+    if calendar is None:
+        calendar = DayCalendar.for_collection()
+    return calendar.date_str(due)
 
 
 def power_forgetting_curve(elapsed_days, stability):
@@ -315,6 +365,130 @@ class KeyValueDict(TypedDict):
     new_key: Optional[str]
 
 
+def card_snapshot(card: Card) -> tuple:
+    """
+    The fields of the card the add-on changes. If they're the same before and after changing
+    the card, writing it would only bump its mod and usn, and so the write is skipped.
+    """
+    return (card.due, card.odue, card.ivl, card.factor, card.custom_data)
+
+
+# Size limit of card.custom_data, in bytes of its JSON
+CUSTOM_DATA_LIMIT = 100
+
+# Keys custom_scheduler.js and the add-on write to the custom data, which always hold a number or
+# a short string, so they are read and replaced in the JSON text without parsing all of it
+FIXED_KEYS = ("e", "v", "s", "sr", "es")
+
+# Keys of caches the add-on can compute again, removed in this order when writing the custom
+# data would exceed CUSTOM_DATA_LIMIT
+DROPPABLE_KEYS = ("es",)
+
+# The value of each of FIXED_KEYS in the compact JSON, after the { or , before the key
+FIXED_VALUE_PATTERNS = {
+    key: re.compile(
+        rf'([{{,])"{key}":'
+        r'("[^"\\]*"|-?[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|true|false|null)(?=[,}])'
+    )
+    for key in FIXED_KEYS
+}
+
+
+_LITERAL_TOKENS = {"true": True, "false": False, "null": None}
+
+
+def _token_value(token: str):
+    """The value of a token matched by FIXED_VALUE_PATTERNS, which has no escapes in strings."""
+    if token[0] == '"':
+        return token[1:-1]
+    if token in _LITERAL_TOKENS:
+        return _LITERAL_TOKENS[token]
+    if "." in token or "e" in token or "E" in token:
+        return float(token)
+    return int(token)
+
+
+def read_custom_data(custom_data_json: str, key: str):
+    """
+    The value of a key of the custom data JSON, None if it isn't set.
+    The keys of FIXED_KEYS are read without parsing the whole JSON.
+    """
+    if custom_data_json == "":
+        return None
+    if key in FIXED_KEYS:
+        match = FIXED_VALUE_PATTERNS[key].search(custom_data_json)
+        if match is not None:
+            return _token_value(match.group(2))
+        if f'"{key}":' not in custom_data_json:
+            return None
+    return json.loads(custom_data_json).get(key)
+
+
+def read_custom_data_batch(custom_data_jsons: Iterable[str], keys: Sequence[str]) -> list[tuple]:
+    """read_custom_data of the keys for many cards, a tuple of the values of each card."""
+    return [
+        tuple(read_custom_data(custom_data_json, key) for key in keys)
+        for custom_data_json in custom_data_jsons
+    ]
+
+
+def _json_value(value) -> str:
+    """The JSON of a number, string or bool, the same as json.dumps gives but faster for numbers."""
+    if type(value) is int or (type(value) is float and math.isfinite(value)):
+        return repr(value)
+    return json.dumps(value)
+
+
+def _updated_fixed_key(custom_data_json: str, key: str, value) -> Optional[str]:
+    """
+    The custom data JSON with a key of FIXED_KEYS set to a number, string or bool value,
+    or removed if the value is None, by editing the JSON text.
+    :return: None if the JSON isn't in the compact form this handles.
+    """
+    if custom_data_json == "":
+        custom_data_json = "{}" if value is not None else ""
+    match = FIXED_VALUE_PATTERNS[key].search(custom_data_json)
+    if match is None:
+        if value is None:
+            return None if f'"{key}":' in custom_data_json else custom_data_json
+        if f'"{key}":' in custom_data_json or not custom_data_json.endswith("}"):
+            return None
+        separator = "," if custom_data_json != "{}" else ""
+        return f'{custom_data_json[:-1]}{separator}"{key}":{_json_value(value)}}}'
+    if value is None:
+        start, end = match.span()
+        if match.group(1) == "{":
+            # The first key, so the comma after it is removed instead of the one before
+            return "{" + custom_data_json[end + 1 if custom_data_json[end] == "," else end :]
+        return custom_data_json[:start] + custom_data_json[end:]
+    value_json = _json_value(value)
+    if match.group(2) == value_json:
+        return custom_data_json
+    return custom_data_json[: match.start(2)] + value_json + custom_data_json[match.end(2) :]
+
+
+def fit_custom_data(custom_data_json: str, original_json: str) -> str:
+    """
+    The custom data JSON if it fits in CUSTOM_DATA_LIMIT, otherwise with the keys of
+    DROPPABLE_KEYS removed until it fits. If it still doesn't fit, the rest is data of the
+    scheduler or other add-ons that can't be dropped, so the original JSON is kept and the write
+    is skipped instead of failing the hook or job writing it.
+    """
+    if len(custom_data_json.encode()) <= CUSTOM_DATA_LIMIT:
+        return custom_data_json
+    custom_data = json.loads(custom_data_json)
+    for key in DROPPABLE_KEYS:
+        if custom_data.pop(key, None) is not None:
+            custom_data_json = json.dumps(custom_data, separators=(",", ":"))
+            if len(custom_data_json.encode()) <= CUSTOM_DATA_LIMIT:
+                return custom_data_json
+    print(
+        f"Custom Schedule Helper: custom data {custom_data_json} exceeds {CUSTOM_DATA_LIMIT}"
+        " bytes, not written"
+    )
+    return original_json
+
+
 def write_custom_data(
     card: Card,
     key: Optional[str] = None,
@@ -333,24 +507,95 @@ def write_custom_data(
     :param key_values: A list of (key, value, new key) tuples. Used for performance as calling
                 this function multiple times would perform json.loads and json.dumps multiple times.
     """
-    if card.custom_data != "":
-        custom_data = json.loads(card.custom_data)
+    card.custom_data = updated_custom_data(card.custom_data, key, value, new_key, key_values)
+
+
+def updated_custom_data(
+    custom_data_json: str,
+    key: Optional[str] = None,
+    value: Optional[Union[str, int, float, bool]] = None,
+    new_key: Optional[str] = None,
+    key_values: Optional[list[KeyValueDict]] = None,
+) -> str:
+    """
+    Return the custom data JSON with the keys written, same as write_custom_data does to a card.
+    Setting or removing keys of FIXED_KEYS, and removing keys that aren't there, edits the JSON
+    text, other writes parse and dump it.
+    Keys are dropped or the write is skipped if the result doesn't fit, see fit_custom_data.
+    """
+    if key_values is None:
+        key_values = [{"key": key, "value": value, "new_key": new_key}]
+    updated = custom_data_json
+    removed = set()
+    readded = False
+    for kv in key_values:
+        if kv.get("new_key") is None and kv.get("value") is None and (
+            updated == "" or f'"{kv.get("key")}":' not in updated
+        ):
+            # Removing a key that isn't there, which is what most removals of other keys do
+            continue
+        if kv.get("new_key") is not None or kv.get("key") not in FIXED_KEYS:
+            break
+        updated = _updated_fixed_key(updated, kv.get("key"), kv.get("value"))
+        if updated is None:
+            break
+        if kv.get("value") is None:
+            removed.add(kv.get("key"))
+        elif kv.get("key") in removed:
+            readded = True
     else:
-        custom_data = {}
-    if key_values is not None:
-        for kv in key_values:
-            add_dict_key_value(
-                custom_data,
-                kv.get("key"),
-                kv.get("value"),
-                kv.get("new_key"),
-            )
+        if updated == custom_data_json:
+            return custom_data_json
+        # A key removed and set again moves to the end, which is no change if the values are the
+        # same, like keys set and then removed from empty custom data
+        if (readded or custom_data_json == "") and json.loads(updated) == (
+            json.loads(custom_data_json) if custom_data_json != "" else {}
+        ):
+            return custom_data_json
+        return fit_custom_data(updated, custom_data_json)
+
+    if custom_data_json != "":
+        custom_data = json.loads(custom_data_json)
     else:
-        add_dict_key_value(custom_data, key, value, new_key)
-    compressed_data = json.dumps(custom_data, separators=(",", ":"))
-    if len(compressed_data) > 100:
-        raise ValueError("Custom data exceeds 100 bytes after compression.")
-    card.custom_data = compressed_data
+        custom_data = {}
+    original = dict(custom_data)
+    for kv in key_values:
+        add_dict_key_value(
+            custom_data,
+            kv.get("key"),
+            kv.get("value"),
+            kv.get("new_key"),
+        )
+    if custom_data == original:
+        # Nothing changed, keep the JSON as it is so that the card isn't seen as changed
+        return custom_data_json
+    return fit_custom_data(json.dumps(custom_data, separators=(",", ":")), custom_data_json)
+
+
+def updated_card_data(data_json: str, key_values: list[KeyValueDict]) -> str:
+    """
+    Return the JSON of the data column of the cards table with the custom data keys written,
+    for writing custom data with SQL without loading the card. The custom data is stored in
+    it as a JSON string under "cd".
+    """
+    data = json.loads(data_json) if data_json != "" else {}
+    custom_data = data.get("cd", "")
+    data["cd"] = updated_custom_data(custom_data, key_values=key_values)
+    if data["cd"] == custom_data:
+        return data_json
+    if data["cd"] == "{}":
+        del data["cd"]
+    return json.dumps(data, separators=(",", ":")) if len(data) > 0 else ""
+
+
+def updated_card_data_batch(
+    data_jsons: Sequence[str], key_values: Sequence[list[KeyValueDict]]
+) -> list[str]:
+    """updated_card_data for many cards, with the keys to write to each card."""
+    return [
+        updated_card_data(data_json, card_key_values)
+        for data_json, card_key_values in zip(data_jsons, key_values)
+    ]
 
 
 def rotate_number_by_k(N, K):